@@ -0,0 +1,385 @@
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+import datetime
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+
+from . import keys
+from .models import Datalogger, Location
+from .storage import STORAGES
+from .validation import validate_record
+
+
+class BenchError(RuntimeError):
+    # A benchmark request or record was refused, the timings would be wrong
+    pass
+
+
+def _check(response):
+    if response.status_code != 200:
+        raise BenchError(
+            f"{response.request['REQUEST_METHOD']} {response.request['PATH_INFO']} "
+            f"answered {response.status_code}: {response.content.decode()[:500]}"
+        )
+
+
+def synthetic_records(dataloggers, count, start=None, interval=600, seed=0):
+    # Deterministic fleet: same arguments always produce the same records
+    rng = random.Random(seed)
+    if start is None:
+        start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    fleet = [
+        (
+            str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            {
+                "lat": round(rng.uniform(42.0, 51.0), 6),
+                "lng": round(rng.uniform(0.0, 8.0), 6),
+            },
+        )
+        for _ in range(dataloggers)
+    ]
+
+    for i in range(count):
+        datalogger, location = fleet[i % dataloggers]
+        at = start + datetime.timedelta(seconds=interval * (i // dataloggers))
+        yield {
+            "at": at.isoformat(),
+            "datalogger": datalogger,
+            "location": location,
+            "measurements": [
+                {"label": "temp", "value": round(rng.uniform(-20, 40), 1)},
+                {"label": "rain", "value": round(rng.randrange(0, 11) * 0.2, 1)},
+                {"label": "hum", "value": round(rng.uniform(20, 100), 1)},
+            ],
+        }
+
+
+def bench_ingest(count=1000, batch_size=500, dataloggers=10, seed=0):
+    client = Client()
+    records = list(synthetic_records(dataloggers, count, seed=seed))
+
+    # One HTTP request per record through the historical endpoint
+    url = reverse("ingest_data")
+    started = time.perf_counter()
+    for record in records:
+        response = client.post(url, json.dumps(record), content_type="application/json")
+        _check(response)
+    single_elapsed = time.perf_counter() - started
+
+    # Same records, shifted to other dataloggers, through the batch endpoint
+    records = list(synthetic_records(dataloggers, count, seed=seed + 1))
+    url = reverse("ingest_data_batch")
+    started = time.perf_counter()
+    for offset in range(0, count, batch_size):
+        response = client.post(
+            url,
+            json.dumps(records[offset : offset + batch_size]),
+            content_type="application/json",
+        )
+        _check(response)
+    batch_elapsed = time.perf_counter() - started
+
+    return {
+        "records": count,
+        "batch_size": batch_size,
+        "single": {
+            "seconds": single_elapsed,
+            "records_per_second": count / single_elapsed,
+        },
+        "batch": {
+            "seconds": batch_elapsed,
+            "records_per_second": count / batch_elapsed,
+        },
+        "speedup": single_elapsed / batch_elapsed,
+    }
+
+
+def bench_validation(count=5000, dataloggers=10, seed=0):
+    # Validation alone, no HTTP or database: the records are valid so the
+    # fast path never falls back to the serializer
+    records = json.loads(
+        json.dumps(list(synthetic_records(dataloggers, count, seed=seed)))
+    )
+
+    result = {"records": count}
+    for name, fast in [("serializer", False), ("fast", True)]:
+        started = time.perf_counter()
+        for record in records:
+            validated, errors = validate_record(record, fast=fast)
+            if errors is not None:
+                raise BenchError(f"Invalid synthetic record: {errors}")
+        elapsed = time.perf_counter() - started
+        result[name] = {"seconds": elapsed, "us_per_record": elapsed / count * 1e6}
+    result["speedup"] = result["serializer"]["seconds"] / result["fast"]["seconds"]
+    return result
+
+
+def storage_size(model):
+    # Bytes used by the table of model and by its indexes
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT pg_table_size(%s), pg_indexes_size(%s)", [table, table]
+            )
+            return cursor.fetchone()
+
+        # SQLite, needs the dbstat virtual table
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s",
+            [table],
+        )
+        indexes = [name for name, in cursor.fetchall()]
+        cursor.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+        sizes = dict(cursor.fetchall())
+    return sizes.get(table, 0), sum(sizes.get(name, 0) for name in indexes)
+
+
+def _timings_ms(client, url, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(url, params)
+        timings.append((time.perf_counter() - started) * 1000)
+        _check(response)
+    return timings
+
+
+def _median_ms(client, url, params, repeat):
+    return statistics.median(_timings_ms(client, url, params, repeat))
+
+
+def _percentiles(timings):
+    if len(timings) < 2:
+        return {"p50": timings[0], "p95": timings[0], "p99": timings[0]}
+    cuts = statistics.quantiles(timings, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def bench_storage(count=1000, dataloggers=10, repeat=5, seed=0):
+    client = Client()
+    records = list(synthetic_records(dataloggers, count, seed=seed))
+    # Window slightly wider than the data: summaries mix rollups and raw edges
+    since = datetime.datetime.fromisoformat(records[0]["at"])
+    before = datetime.datetime.fromisoformat(records[-1]["at"])
+    window = {
+        "datalogger": records[0]["datalogger"],
+        "since": (since - datetime.timedelta(minutes=30)).isoformat(),
+        "before": (before + datetime.timedelta(minutes=30)).isoformat(),
+    }
+    endpoints = {
+        "data": ("fetch_data_raw", {}),
+        "summary": ("fetch_data_aggregates", {}),
+        "summary_hour": ("fetch_data_aggregates", {"span": "hour"}),
+        "summary_day": ("fetch_data_aggregates", {"span": "day"}),
+    }
+
+    result = {"records": count}
+    for layout, storage in STORAGES.items():
+        with override_settings(
+            MEASUREMENTS_STORAGE=layout, MEASUREMENTS_CACHE_ENABLED=False
+        ):
+            for offset in range(0, count, 500):
+                response = client.post(
+                    reverse("ingest_data_batch"),
+                    json.dumps(records[offset : offset + 500]),
+                    content_type="application/json",
+                )
+                _check(response)
+
+            table_bytes, index_bytes = storage_size(storage.model)
+            result[layout] = {
+                "rows": storage.model.objects.count(),
+                "table_bytes": table_bytes,
+                "index_bytes": index_bytes,
+                "latency_ms": {
+                    name: _median_ms(
+                        client, reverse(view), dict(window, **params), repeat
+                    )
+                    for name, (view, params) in endpoints.items()
+                },
+            }
+
+        # Start the next layout from an empty database
+        Datalogger.objects.all().delete()
+        Location.objects.all().delete()
+        keys.clear()
+
+    return result
+
+
+def bench_suite(
+    dataloggers=5, days=(1, 7), interval=600, ingest_records=200, repeat=20, seed=0
+):
+    # History grows to each size of days in turn. At every size the last
+    # ingest_records records go through /api/ingest one request at a time,
+    # the others are loaded through /api/ingest/batch, then reads of the
+    # whole history of one datalogger are timed.
+    client = Client()
+    days = sorted(days)
+    per_day = 86400 // interval
+    records = list(
+        synthetic_records(
+            dataloggers, dataloggers * per_day * days[-1], interval=interval, seed=seed
+        )
+    )
+    start = datetime.datetime.fromisoformat(records[0]["at"])
+    endpoints = {
+        "data": ("fetch_data_raw", {}),
+        "summary": ("fetch_data_aggregates", {}),
+        "summary_hour": ("fetch_data_aggregates", {"span": "hour"}),
+        "summary_day": ("fetch_data_aggregates", {"span": "day"}),
+    }
+
+    result = {
+        "parameters": {
+            "dataloggers": dataloggers,
+            "days": days,
+            "interval": interval,
+            "ingest_records": ingest_records,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "database": connection.vendor,
+        "sizes": [],
+    }
+    loaded = 0
+    with override_settings(MEASUREMENTS_CACHE_ENABLED=False):
+        for size in days:
+            target = dataloggers * per_day * size
+            timed = min(ingest_records, target - loaded)
+
+            for offset in range(loaded, target - timed, 500):
+                response = client.post(
+                    reverse("ingest_data_batch"),
+                    json.dumps(records[offset : min(offset + 500, target - timed)]),
+                    content_type="application/json",
+                )
+                _check(response)
+
+            url = reverse("ingest_data")
+            started = time.perf_counter()
+            for record in records[target - timed : target]:
+                response = client.post(
+                    url, json.dumps(record), content_type="application/json"
+                )
+                _check(response)
+            elapsed = time.perf_counter() - started
+            loaded = target
+
+            window = {
+                "datalogger": records[0]["datalogger"],
+                "since": (start - datetime.timedelta(minutes=30)).isoformat(),
+                "before": (start + datetime.timedelta(days=size)).isoformat(),
+            }
+            result["sizes"].append(
+                {
+                    "days": size,
+                    "records": target,
+                    "ingest": {
+                        "records": timed,
+                        "seconds": elapsed,
+                        "records_per_second": timed / elapsed if elapsed else None,
+                    },
+                    "latency_ms": {
+                        name: _percentiles(
+                            _timings_ms(
+                                client, reverse(view), dict(window, **params), repeat
+                            )
+                        )
+                        for name, (view, params) in endpoints.items()
+                    },
+                }
+            )
+
+    return result
+
+
+def _post_batches(url, batches, barrier, errors):
+    # Writer thread: its own client and database connections
+    client = Client()
+    try:
+        barrier.wait()
+        for batch in batches:
+            response = client.post(url, batch, content_type="application/json")
+            _check(response)
+    except Exception as exc:
+        errors.append(exc)
+    finally:
+        connections.close_all()
+
+
+def bench_shards(
+    shard_counts=(1, 2, 4), writers=4, dataloggers=16, count=4000, batch_size=50, seed=0
+):
+    # Write throughput of concurrent /api/ingest/batch clients, each sending
+    # the readings of its own dataloggers, with readings spread over each
+    # number of shards in turn. Needs databases on disk: an in-memory SQLite
+    # database is shared by all connections through a single lock.
+    url = reverse("ingest_data_batch")
+    records = list(synthetic_records(dataloggers, count, seed=seed))
+    # The first record of each datalogger creates its keys, not timed
+    warmup, records = records[:dataloggers], records[dataloggers:]
+    batches = []
+    for writer in range(writers):
+        own = [
+            record
+            for i, record in enumerate(records)
+            if i % dataloggers % writers == writer
+        ]
+        batches.append(
+            [
+                json.dumps(own[offset : offset + batch_size])
+                for offset in range(0, len(own), batch_size)
+            ]
+        )
+
+    result = {
+        "records": len(records),
+        "writers": writers,
+        "batch_size": batch_size,
+        "shards": {},
+    }
+    for shards in shard_counts:
+        aliases = [f"shard{shard}" for shard in range(shards)]
+        with override_settings(MEASUREMENTS_SHARDS=aliases):
+            response = Client().post(
+                url, json.dumps(warmup), content_type="application/json"
+            )
+            _check(response)
+
+            barrier = threading.Barrier(writers + 1)
+            errors = []
+            threads = [
+                threading.Thread(target=_post_batches, args=(url, own, barrier, errors))
+                for own in batches
+            ]
+            for thread in threads:
+                thread.start()
+            barrier.wait()
+            started = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            if errors:
+                raise errors[0]
+
+            result["shards"][shards] = {
+                "seconds": elapsed,
+                "records_per_second": len(records) / elapsed,
+            }
+
+        # Start the next shard count from empty databases
+        for alias in [DEFAULT_DB_ALIAS, *aliases]:
+            Datalogger.objects.using(alias).all().delete()
+            Location.objects.using(alias).all().delete()
+        keys.clear()
+
+    return result
@@ -0,0 +1,275 @@
+from django.conf import settings
+from django.db import close_old_connections, connections
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from . import sharding
+from .ingest import ingest_records
+
+logger = logging.getLogger(__name__)
+
+# Attempts at writing a batch in a row, SQLite may report the database as
+# locked while another request writes. A batch failing all of them stays at
+# the head of the queue and is retried after a delay doubling up to
+# MAX_RETRY_DELAY seconds. Once shutdown has waited
+# MEASUREMENTS_INGEST_QUEUE_SHUTDOWN_TIMEOUT seconds the records left are
+# given up.
+WRITE_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30
+
+
+class BufferFull(Exception):
+    pass
+
+
+class BufferClosed(Exception):
+    pass
+
+
+class BufferStuck(Exception):
+    # A batch cannot be written, records are refused until it is
+    def __init__(self, retry_after):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+_lock = threading.Lock()
+_queue = None
+_writer = None
+_closed = threading.Event()
+_stats = {}
+# Batch failing to be written, taken again before the queue, and the delay
+# before its next retry
+_stuck = None
+_delay = RETRY_DELAY
+# Time after which shutdown gives up on the records it could not write
+_deadline = None
+
+
+def _new_stats():
+    return {
+        "accepted": 0,
+        "rejected": 0,
+        "written": 0,
+        "failed": 0,
+        "batches": 0,
+        "last_batch_size": 0,
+        "last_flush_latency": None,
+        "max_flush_latency": None,
+    }
+
+
+def _get_queue():
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = queue.Queue(maxsize=settings.MEASUREMENTS_INGEST_QUEUE_SIZE)
+        return _queue
+
+
+def _start_writer():
+    global _writer
+    with _lock:
+        if _writer is None and not _closed.is_set():
+            _writer = threading.Thread(
+                target=_run, name="measurements-ingest-writer", daemon=True
+            )
+            _writer.start()
+            atexit.register(shutdown)
+
+
+def put(record):
+    # Queues a validated DataRecordRequest payload, raises BufferFull when
+    # the queue is at capacity, BufferStuck while a batch cannot be written
+    # and BufferClosed once shutdown has started
+    if _closed.is_set():
+        raise BufferClosed()
+    with _lock:
+        if _stuck is not None:
+            _stats["rejected"] += 1
+            raise BufferStuck(_delay)
+    if settings.MEASUREMENTS_INGEST_QUEUE_WRITER:
+        _start_writer()
+
+    try:
+        _get_queue().put_nowait((time.monotonic(), record))
+    except queue.Full:
+        with _lock:
+            _stats["rejected"] += 1
+        raise BufferFull()
+    with _lock:
+        _stats["accepted"] += 1
+
+
+def _take(timeout):
+    # The stuck batch if any, otherwise waits up to timeout for a first
+    # record, then gathers more until the batch is full or the oldest record
+    # has waited for the flush interval
+    with _lock:
+        if _stuck is not None:
+            return _stuck
+    buffer = _get_queue()
+    try:
+        batch = [buffer.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+
+    deadline = batch[0][0] + settings.MEASUREMENTS_INGEST_QUEUE_FLUSH_INTERVAL
+    while len(batch) < settings.MEASUREMENTS_INGEST_QUEUE_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining <= 0 or _closed.is_set():
+                batch.append(buffer.get_nowait())
+            else:
+                batch.append(buffer.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _write(batch):
+    # Returns whether the batch was written, a failed one becomes the stuck
+    # batch. Ingest is idempotent, retrying a batch never stores it twice.
+    global _stuck, _delay
+    records = [record for _, record in batch]
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            with sharding.atomic():
+                ingest_records(records)
+            break
+        except Exception:
+            if attempt == WRITE_ATTEMPTS:
+                logger.exception(
+                    "Writing %d buffered records failed, retrying in %ss",
+                    len(records),
+                    _delay,
+                )
+                with _lock:
+                    _stuck = batch
+                return False
+            time.sleep(RETRY_DELAY * attempt)
+
+    # Time between the arrival of the oldest record and its commit
+    latency = time.monotonic() - batch[0][0]
+    with _lock:
+        _stuck = None
+        _delay = RETRY_DELAY
+        _stats["written"] += len(records)
+        _stats["batches"] += 1
+        _stats["last_batch_size"] = len(records)
+        _stats["last_flush_latency"] = latency
+        _stats["max_flush_latency"] = max(latency, _stats["max_flush_latency"] or 0)
+    return True
+
+
+def _back_off():
+    # Waits before the stuck batch is retried, doubling the next delay. During
+    # shutdown the wait ends at the deadline, past it the stuck batch and the
+    # queued records are dropped and counted as failed.
+    global _delay
+    with _lock:
+        delay = _delay
+        _delay = min(_delay * 2, MAX_RETRY_DELAY)
+    if _deadline is not None:
+        remaining = _deadline - time.monotonic()
+        if remaining <= 0:
+            _give_up()
+            return
+        delay = min(delay, remaining)
+    time.sleep(delay)
+
+
+def _give_up():
+    global _stuck
+    with _lock:
+        dropped = len(_stuck or [])
+        _stuck = None
+    buffer = _get_queue()
+    while True:
+        try:
+            buffer.get_nowait()
+        except queue.Empty:
+            break
+        dropped += 1
+    logger.error("Giving up on %d buffered records at shutdown", dropped)
+    with _lock:
+        _stats["failed"] += dropped
+
+
+def flush():
+    # Writes everything queued so far from the calling thread, stopping at a
+    # batch that cannot be written. Returns the number of records written.
+    count = 0
+    while True:
+        batch = _take(timeout=0)
+        if not batch or not _write(batch):
+            return count
+        count += len(batch)
+
+
+def _run():
+    # Also runs during shutdown until everything is written or given up, the
+    # records were accepted
+    try:
+        while True:
+            close_old_connections()
+            batch = _take(timeout=settings.MEASUREMENTS_INGEST_QUEUE_FLUSH_INTERVAL)
+            if batch:
+                if not _write(batch):
+                    _back_off()
+            elif _closed.is_set():
+                return
+    finally:
+        connections.close_all()
+
+
+def shutdown():
+    # Refuses new records and waits until the queued ones are written or the
+    # shutdown timeout has passed
+    global _writer, _deadline
+    _deadline = time.monotonic() + settings.MEASUREMENTS_INGEST_QUEUE_SHUTDOWN_TIMEOUT
+    _closed.set()
+    with _lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.join()
+    # Without the writer thread the queue is written from here
+    while True:
+        flush()
+        with _lock:
+            if _stuck is None:
+                return
+        _back_off()
+
+
+def reset():
+    # Forgets queued records and counters, the writer must not be running
+    global _queue, _stuck, _delay, _deadline
+    with _lock:
+        _queue = None
+        _stuck = None
+        _delay = RETRY_DELAY
+        _deadline = None
+        _stats.clear()
+        _stats.update(_new_stats())
+    _closed.clear()
+
+
+def stats():
+    buffer = _get_queue()
+    with _lock:
+        return {
+            "depth": buffer.qsize() + len(_stuck or []),
+            "stuck": len(_stuck or []),
+            "capacity": buffer.maxsize,
+            "batch_size": settings.MEASUREMENTS_INGEST_QUEUE_BATCH_SIZE,
+            "flush_interval": settings.MEASUREMENTS_INGEST_QUEUE_FLUSH_INTERVAL,
+            **_stats,
+        }
+
+
+reset()
@@ -0,0 +1,167 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.utils import timezone
+import datetime
+import threading
+
+from . import sharding
+from .rollups import truncate
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Width of a cache entry per kind of data: raw rows are cached per hour,
+# hourly aggregates per day and daily aggregates per 30 days. Blocks are
+# aligned on the epoch so a bucket always belongs to a single block.
+BLOCK_WIDTHS = {
+    "data": datetime.timedelta(hours=1),
+    "hour": datetime.timedelta(days=1),
+    "day": datetime.timedelta(days=30),
+}
+
+# Number of blocks fetched from the cache per round trip
+GET_MANY_SIZE = 64
+
+_stats_lock = threading.Lock()
+_stats = {kind: {"hits": 0, "misses": 0} for kind in BLOCK_WIDTHS}
+
+
+def get_cache():
+    return caches[settings.MEASUREMENTS_CACHE_ALIAS]
+
+
+def shared():
+    # Whether the processes of a server see the same cache, in-memory ones
+    # are per process
+    return not isinstance(get_cache(), (LocMemCache, DummyCache))
+
+
+def stats():
+    with _stats_lock:
+        return {kind: dict(counters) for kind, counters in _stats.items()}
+
+
+def reset_stats():
+    with _stats_lock:
+        for counters in _stats.values():
+            counters["hits"] = counters["misses"] = 0
+
+
+def _count(kind, hits, misses):
+    with _stats_lock:
+        _stats[kind]["hits"] += hits
+        _stats[kind]["misses"] += misses
+
+
+def block_floor(value, kind):
+    width = BLOCK_WIDTHS[kind]
+    return EPOCH + ((value - EPOCH) // width) * width
+
+
+def block_ceil(value, kind):
+    floor = block_floor(value, kind)
+    return floor if floor == value else floor + BLOCK_WIDTHS[kind]
+
+
+def block_key(datalogger_id, kind, block):
+    return f"measurements:{kind}:{datalogger_id}:{int(block.timestamp())}"
+
+
+def cached_range(datalogger_id, kind, start, end, fetch, time_field):
+    # Yields the items of [start, end), fetch(lo, hi) returns the sorted
+    # items of [lo, hi) whose time is stored under time_field. Blocks fully
+    # covered by the range are served from the cache, the partial blocks at
+    # both ends always go to fetch.
+    if not settings.MEASUREMENTS_CACHE_ENABLED:
+        yield from fetch(start, end)
+        return
+
+    width = BLOCK_WIDTHS[kind]
+    first = block_ceil(start, kind)
+    last = block_floor(end, kind)
+    if first >= last:
+        yield from fetch(start, end)
+        return
+
+    if start < first:
+        yield from fetch(start, first)
+
+    cache = get_cache()
+    now = timezone.now()
+    # A replica may not have the readings its primary stored, and dropped
+    # from the cache, yet: blocks read from it are not cached
+    replica = sharding.reader(datalogger_id) != sharding.shard_for(datalogger_id)
+    block = first
+    while block < last:
+        blocks = []
+        while block < last and len(blocks) < GET_MANY_SIZE:
+            blocks.append(block)
+            block += width
+
+        keys = [block_key(datalogger_id, kind, block) for block in blocks]
+        found = cache.get_many(keys)
+        _count(kind, len(found), len(keys) - len(found))
+
+        # Consecutive missing blocks are fetched with a single query
+        missing = [block for block, key in zip(blocks, keys) if key not in found]
+        runs = []
+        for block_start in missing:
+            if runs and runs[-1][1] == block_start:
+                runs[-1][1] = block_start + width
+            else:
+                runs.append([block_start, block_start + width])
+
+        fetched = {}
+        for run_start, run_end in runs:
+            for item in fetch(run_start, run_end):
+                block_start = block_floor(item[time_field], kind)
+                fetched.setdefault(block_start, []).append(item)
+
+        closed = {}
+        for block_start in missing:
+            items = fetched.get(block_start, [])
+            key = block_key(datalogger_id, kind, block_start)
+            found[key] = items
+            if replica:
+                continue
+            if block_start + width > now:
+                # Still receiving readings, keep it only briefly
+                cache.set(key, items, settings.MEASUREMENTS_CACHE_OPEN_TIMEOUT)
+            else:
+                closed[key] = items
+        if closed:
+            cache.set_many(closed, settings.MEASUREMENTS_CACHE_CLOSED_TIMEOUT)
+
+        for key in keys:
+            yield from found[key]
+
+    if last < end:
+        yield from fetch(last, end)
+
+
+def invalidate(measurements):
+    tz = timezone.get_current_timezone()
+    seen = set()
+    keys = set()
+    for measurement in measurements:
+        datalogger_id = measurement.datalogger_id
+        recorded_at = measurement.recorded_at
+        # Readings of a record share their blocks
+        if (datalogger_id, recorded_at) in seen:
+            continue
+        seen.add((datalogger_id, recorded_at))
+        keys.add(block_key(datalogger_id, "data", block_floor(recorded_at, "data")))
+        for span in ["hour", "day"]:
+            bucket = truncate(recorded_at, span, tz)
+            keys.add(block_key(datalogger_id, span, block_floor(bucket, span)))
+
+    if not keys:
+        return
+
+    cache = get_cache()
+    cache.delete_many(keys)
+    # A reader may have cached the blocks again from a snapshot taken before
+    # the commit, drop them once more when the data becomes visible
+    transaction.on_commit(lambda: cache.delete_many(keys))
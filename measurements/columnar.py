@@ -0,0 +1,110 @@
+# Columnar binary encoding of raw readings, served by /api/data with
+# Accept: application/x-measurements-columnar or ?format=columnar.
+#
+# Layout, all integers little-endian:
+#   magic "PCWC", uint16 version, uint16 label count, uint32 row count
+#   for each label: uint8 byte length followed by the UTF-8 name
+#   zero padding up to a multiple of 8 bytes
+#   int64[rows]   recorded_at, microseconds since 1970-01-01T00:00:00Z
+#   float64[rows] value
+#   uint8[rows]   index of the label in the label list
+#
+# decode() only needs the standard library so this module can be copied into
+# analytics jobs as is. With NumPy the columns can also be mapped without a
+# copy, e.g. numpy.frombuffer(payload, "<i8", rows, offset).
+from array import array
+import datetime
+import struct
+import sys
+
+MAGIC = b"PCWC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _little_endian(column):
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def _padding(size):
+    return -size % 8
+
+
+def encode(rows):
+    # rows are (label, recorded_at, value) tuples, recorded_at an aware
+    # datetime, as yielded by Storage.stream()
+    labels = {}
+    timestamps = array("q")
+    values = array("d")
+    codes = array("B")
+    for label, recorded_at, value in rows:
+        code = labels.get(label)
+        if code is None:
+            code = labels[label] = len(labels)
+        delta = recorded_at - EPOCH
+        timestamps.append(
+            (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        )
+        values.append(value)
+        codes.append(code)
+
+    parts = [HEADER.pack(MAGIC, VERSION, len(labels), len(codes))]
+    for label in labels:
+        name = label.encode()
+        parts.append(bytes([len(name)]) + name)
+    size = sum(len(part) for part in parts)
+    parts.append(b"\0" * _padding(size))
+    parts.append(_little_endian(timestamps).tobytes())
+    parts.append(_little_endian(values).tobytes())
+    parts.append(codes.tobytes())
+    return b"".join(parts)
+
+
+def decode(payload):
+    # Returns the label list and the three columns as arrays
+    payload = memoryview(payload)
+    magic, version, label_count, rows = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a columnar measurements payload")
+
+    offset = HEADER.size
+    labels = []
+    for _ in range(label_count):
+        length = payload[offset]
+        labels.append(bytes(payload[offset + 1 : offset + 1 + length]).decode())
+        offset += 1 + length
+    offset += _padding(offset)
+
+    columns = []
+    for typecode in ["q", "d", "B"]:
+        column = array(typecode)
+        end = offset + rows * column.itemsize
+        column.frombytes(payload[offset:end])
+        columns.append(_little_endian(column))
+        offset = end
+
+    timestamps, values, codes = columns
+    return {
+        "labels": labels,
+        "recorded_at": timestamps,
+        "value": values,
+        "label": codes,
+    }
+
+
+def iter_rows(payload):
+    # Yields (label, recorded_at, value) tuples, recorded_at as UTC datetimes
+    columns = decode(payload)
+    labels = columns["labels"]
+    for timestamp, value, code in zip(
+        columns["recorded_at"], columns["value"], columns["label"]
+    ):
+        yield (
+            labels[code],
+            EPOCH + datetime.timedelta(microseconds=timestamp),
+            value,
+        )
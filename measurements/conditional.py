@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.db.models import Count, F, Max, Sum
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from functools import wraps
+import hashlib
+import uuid
+
+from . import replicas
+from .models import Datalogger
+
+
+def touch(datalogger_ids=None):
+    # Invalidates the validators of the dataloggers, of all of them when None
+    queryset = Datalogger.objects.all()
+    if datalogger_ids is not None:
+        queryset = queryset.filter(id__in=datalogger_ids)
+    queryset.update(version=F("version") + 1, modified_at=timezone.now())
+    replicas.written(datalogger_ids)
+
+
+def validators(request):
+    # (etag, last modified timestamp) of a read request, None when its
+    # datalogger parameters are invalid and left to the view to report. The
+    # ids of the requested dataloggers are kept on the request for the view.
+    # Regions are resolved by the view, any datalogger may be inside them
+    fleet = request.GET.get("fleet") in ["1", "true"]
+    if fleet or "bbox" in request.GET or "cells" in request.GET:
+        # A single aggregate rather than a row per datalogger, versions only
+        # grow so their sum changes with any of them
+        totals = Datalogger.objects.aggregate(
+            count=Count("id"),
+            last_id=Max("id"),
+            versions=Sum("version"),
+            modified_at=Max("modified_at"),
+        )
+        versions = [f"{totals['count']}:{totals['last_id']}:{totals['versions']}"]
+        modified = [totals["modified_at"]] if totals["modified_at"] else []
+    else:
+        try:
+            uuids = {
+                uuid.UUID(value)
+                for param in request.GET.getlist("datalogger")
+                for value in param.split(",")
+                if value
+            }
+        except ValueError:
+            return None
+        if not uuids or len(uuids) > settings.MEASUREMENTS_SUMMARY_MAX_DATALOGGERS:
+            return None
+        rows = sorted(
+            Datalogger.objects.filter(uuid__in=uuids).values_list(
+                "id", "uuid", "version", "modified_at"
+            )
+        )
+        request.dataloggers = {datalogger: pk for pk, datalogger, _, _ in rows}
+        versions = [f"{pk}:{version}" for pk, _, version, _ in rows]
+        modified = [modified_at for _, _, _, modified_at in rows if modified_at]
+
+    # Responses also depend on the representation and the storage layout,
+    # compacting the readings of a datalogger bumps its version
+    state = [
+        request.get_full_path(),
+        request.META.get("HTTP_ACCEPT", ""),
+        settings.MEASUREMENTS_STORAGE,
+        *versions,
+    ]
+    etag = hashlib.sha1("\n".join(state).encode()).hexdigest()
+
+    # Last-Modified has whole seconds: while the current second may still
+    # see changes, a client sending it back as If-Modified-Since would miss
+    # them, so it is only given for earlier seconds
+    last_modified = int(max(modified).timestamp()) if modified else None
+    if last_modified is not None and last_modified >= int(timezone.now().timestamp()):
+        last_modified = None
+    return f'"{etag}"', last_modified
+
+
+def conditional(view):
+    # Answers If-None-Match and If-Modified-Since with 304 from a single
+    # lookup of the requested dataloggers, before the view runs any
+    # measurement query
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ["GET", "HEAD"]:
+            return view(request, *args, **kwargs)
+        if not settings.MEASUREMENTS_CONDITIONAL_GET:
+            return view(request, *args, **kwargs)
+        found = validators(request)
+        if found is None:
+            return view(request, *args, **kwargs)
+
+        etag, last_modified = found
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response.headers["ETag"] = etag
+        if last_modified is not None:
+            response.headers["Last-Modified"] = http_date(last_modified)
+        patch_vary_headers(response, ["Accept"])
+        return response
+
+    return wrapper
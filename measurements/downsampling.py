@@ -0,0 +1,89 @@
+from heapq import merge
+from itertools import islice
+
+from .storage import LABELS, get_storage
+
+
+def _area(a, b, c):
+    # Twice the area of the triangle between points a, b and c
+    return abs((a[0] - c[0]) * (b[1] - a[1]) - (a[0] - b[0]) * (c[1] - a[1]))
+
+
+def lttb(points, count, threshold):
+    # Largest-Triangle-Three-Buckets over (x, y, item) points ordered by x,
+    # count being their number. Yields the items of at most threshold points
+    # in a single pass holding two buckets of points at a time.
+    points = iter(points)
+    if count <= threshold or threshold < 3:
+        for _, _, item in points:
+            yield item
+        return
+
+    # The first and last points are kept, the others are split in
+    # threshold - 2 buckets of [bound(i), bound(i + 1)) indexes
+    def bound(i):
+        return i * (count - 2) // (threshold - 2) + 1
+
+    selected = next(points, None)
+    if selected is None:
+        return
+    yield selected[2]
+
+    current = list(islice(points, bound(1) - bound(0)))
+    for i in range(threshold - 2):
+        if i + 1 < threshold - 2:
+            following = list(islice(points, bound(i + 2) - bound(i + 1)))
+        else:
+            following = list(islice(points, 1))
+        if not current or not following:
+            # Fewer points than counted, rows were deleted meanwhile
+            for _, _, item in current + following:
+                yield item
+            return
+
+        average = (
+            sum(point[0] for point in following) / len(following),
+            sum(point[1] for point in following) / len(following),
+        )
+        selected = max(current, key=lambda point: _area(selected, point, average))
+        yield selected[2]
+        current = following
+
+    yield current[0][2]
+
+
+def _series(storage, datalogger_id, label, count, since, before, max_points, chunk):
+    rows = storage.series(datalogger_id, label, since, before, chunk)
+    points = (
+        (recorded_at.timestamp(), value, (label, recorded_at, value))
+        for recorded_at, value in rows
+    )
+    return lttb(points, count, max_points)
+
+
+def downsample(datalogger_id, since, before, max_points, chunk_size):
+    # Yields (label, recorded_at, value) rows ordered by recorded_at like
+    # Storage.stream, with at most max_points rows per label. Each label is
+    # read from its own cursor and the series are merged on the fly.
+    if datalogger_id is None:
+        return
+
+    storage = get_storage()
+    counts = storage.label_counts(datalogger_id, since, before)
+    yield from merge(
+        *[
+            _series(
+                storage,
+                datalogger_id,
+                label,
+                counts[label],
+                since,
+                before,
+                max_points,
+                chunk_size,
+            )
+            for label in LABELS
+            if counts.get(label)
+        ],
+        key=lambda row: row[1],
+    )
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db import transaction
+
+from . import caching, keys, latest, live, rollups
+from .conditional import touch
+from .models import Measurement
+from .storage import get_storage
+
+
+def build_measurements(records):
+    # records are validated DataRecordRequest payloads
+    datalogger_ids = keys.datalogger_ids({record["datalogger"] for record in records})
+    location_ids = keys.location_ids(
+        {(record["location"]["lat"], record["location"]["lng"]) for record in records}
+    )
+
+    keys.datalogger_locations(
+        {
+            (
+                datalogger_ids[record["datalogger"]],
+                location_ids[(record["location"]["lat"], record["location"]["lng"])],
+            )
+            for record in records
+        }
+    )
+
+    measurements = []
+    for record in records:
+        datalogger_id = datalogger_ids[record["datalogger"]]
+        location_id = location_ids[
+            (record["location"]["lat"], record["location"]["lng"])
+        ]
+        for measurement_data in record["measurements"]:
+            measurements.append(
+                Measurement(
+                    label=measurement_data["label"],
+                    value=measurement_data["value"],
+                    recorded_at=record["at"],
+                    datalogger_id=datalogger_id,
+                    location_id=location_id,
+                )
+            )
+
+    return measurements
+
+
+def ingest_records(records):
+    # Callers wrap this in a transaction so derived data stays consistent
+    return save_measurements(build_measurements(records))
+
+
+def save_measurements(measurements):
+    # Returns the measurements actually stored by the configured layout
+    measurements = get_storage().save(measurements)
+    measurements_saved(measurements)
+    return measurements
+
+
+def measurements_saved(measurements):
+    # Keeps everything derived from raw measurements in sync with them
+    rollups.record(measurements)
+    latest.record(measurements)
+    caching.invalidate(measurements)
+    if measurements:
+        datalogger_ids = {measurement.datalogger_id for measurement in measurements}
+        if settings.MEASUREMENTS_SHARDS:
+            # Versions live in the default database, bumped once the shards
+            # committed so ingest never waits for it while holding them
+            transaction.on_commit(lambda: touch(datalogger_ids))
+        else:
+            touch(datalogger_ids)
+        transaction.on_commit(lambda: live.publish(measurements))
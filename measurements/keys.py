@@ -0,0 +1,154 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+import threading
+
+from . import sharding
+from .models import Datalogger, DataloggerLocation, Location
+from .regions import cell
+
+# Maximum number of conditions per lookup query
+LOOKUP_CHUNK_SIZE = 200
+
+_lock = threading.Lock()
+_datalogger_ids = {}
+_location_ids = {}
+_datalogger_locations = {}
+
+
+def _remember(cache, resolved):
+    # Ids are only cached once committed: a rolled back transaction must not
+    # leave ids pointing to rows that do not exist
+    def remember():
+        with _lock:
+            for key, value in resolved.items():
+                if len(cache) >= settings.MEASUREMENTS_KEY_CACHE_SIZE:
+                    # Dicts keep insertion order, drop the oldest entry
+                    cache.pop(next(iter(cache)))
+                cache[key] = value
+
+    transaction.on_commit(remember)
+
+
+def clear():
+    with _lock:
+        _datalogger_ids.clear()
+        _location_ids.clear()
+        _datalogger_locations.clear()
+
+
+def datalogger_id(datalogger_uuid):
+    # Id of an existing datalogger, None when it never sent any reading
+    resolved = _datalogger_ids.get(datalogger_uuid)
+    if resolved is None:
+        resolved = (
+            Datalogger.objects.filter(uuid=datalogger_uuid)
+            .values_list("id", flat=True)
+            .first()
+        )
+        if resolved is not None:
+            _remember(_datalogger_ids, {datalogger_uuid: resolved})
+    return resolved
+
+
+def datalogger_uuids(uuids=None):
+    # Maps the id of each existing datalogger among uuids, of every datalogger
+    # when None, to its uuid
+    queryset = Datalogger.objects.all()
+    if uuids is not None:
+        queryset = queryset.filter(uuid__in=uuids)
+    return dict(queryset.values_list("id", "uuid"))
+
+
+def datalogger_ids(uuids):
+    # Maps each uuid to its datalogger id, creating missing dataloggers
+    resolved = {}
+    missing = set()
+    for datalogger_uuid in uuids:
+        found = _datalogger_ids.get(datalogger_uuid)
+        if found is None:
+            missing.add(datalogger_uuid)
+        else:
+            resolved[datalogger_uuid] = found
+
+    if missing:
+        Datalogger.objects.bulk_create(
+            [Datalogger(uuid=datalogger_uuid) for datalogger_uuid in missing],
+            batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        found = {}
+        missing = list(missing)
+        for offset in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+            found.update(
+                Datalogger.objects.filter(
+                    uuid__in=missing[offset : offset + LOOKUP_CHUNK_SIZE]
+                ).values_list("uuid", "id")
+            )
+        sharding.replicate(
+            Datalogger,
+            [
+                {"id": found_id, "uuid": datalogger_uuid}
+                for datalogger_uuid, found_id in found.items()
+            ],
+        )
+        _remember(_datalogger_ids, found)
+        resolved.update(found)
+
+    return resolved
+
+
+def location_ids(locations):
+    # Maps each (lat, lng) pair to its location id, creating missing ones
+    resolved = {}
+    missing = set()
+    for location in locations:
+        found = _location_ids.get(location)
+        if found is None:
+            missing.add(location)
+        else:
+            resolved[location] = found
+
+    if missing:
+        Location.objects.bulk_create(
+            [Location(lat=lat, lng=lng, cell=cell(lat, lng)) for lat, lng in missing],
+            batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        found = {}
+        missing = list(missing)
+        for offset in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+            condition = Q()
+            for lat, lng in missing[offset : offset + LOOKUP_CHUNK_SIZE]:
+                condition |= Q(lat=lat, lng=lng)
+            for location_id, lat, lng in Location.objects.filter(condition).values_list(
+                "id", "lat", "lng"
+            ):
+                found[(lat, lng)] = location_id
+        sharding.replicate(
+            Location,
+            [
+                {"id": location_id, "lat": lat, "lng": lng, "cell": cell(lat, lng)}
+                for (lat, lng), location_id in found.items()
+            ],
+        )
+        _remember(_location_ids, found)
+        resolved.update(found)
+
+    return resolved
+
+
+def datalogger_locations(pairs):
+    # Records the (datalogger id, location id) pairs of ingested readings,
+    # only pairs not seen since the process started cost a query
+    missing = [pair for pair in pairs if pair not in _datalogger_locations]
+    if missing:
+        DataloggerLocation.objects.bulk_create(
+            [
+                DataloggerLocation(datalogger_id=datalogger_id, location_id=location_id)
+                for datalogger_id, location_id in missing
+            ],
+            batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        _remember(_datalogger_locations, dict.fromkeys(missing, True))
@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.db import transaction
+from collections import OrderedDict
+import threading
+import time
+
+from . import sharding
+from .models import LatestReading
+
+_lock = threading.Lock()
+# Datalogger id -> (expiry, readings), least recently used first
+_cache = OrderedDict()
+# Bumped by every invalidation: a read overlapping one may have seen the
+# readings it replaced and is not cached
+_generation = 0
+
+
+def record(measurements):
+    # Keeps the most recent reading of each (datalogger, label) of the new
+    # measurements, in the shard of each datalogger. Readings uploaded out of
+    # order never replace a more recent one.
+    latest = {}
+    for measurement in measurements:
+        key = (measurement.datalogger_id, measurement.label)
+        found = latest.get(key)
+        if found is None or measurement.recorded_at > found[0]:
+            latest[key] = (measurement.recorded_at, measurement.value)
+    if not latest:
+        return
+
+    shards = {}
+    for key, reading in latest.items():
+        shards.setdefault(sharding.shard_for(key[0]), {})[key] = reading
+    for alias in sorted(shards, key=sharding.shards().index):
+        sharding.writing(alias)
+        merge(alias, shards[alias])
+
+    datalogger_ids = {key[0] for key in latest}
+    transaction.on_commit(lambda: invalidate(datalogger_ids))
+
+
+def merge(alias, readings):
+    # Stores (recorded_at, value) readings keyed by (datalogger_id, label) in
+    # a database where they are more recent than the stored ones. Runs in the
+    # ingest transaction like rollups.merge.
+    existing = (
+        LatestReading.objects.using(alias)
+        .select_for_update()
+        .filter(datalogger_id__in={key[0] for key in readings})
+    )
+    existing = {(reading.datalogger_id, reading.label): reading for reading in existing}
+
+    created = []
+    updated = []
+    for (datalogger_id, label), (recorded_at, value) in readings.items():
+        reading = existing.get((datalogger_id, label))
+        if reading is None:
+            created.append(
+                LatestReading(
+                    datalogger_id=datalogger_id,
+                    label=label,
+                    recorded_at=recorded_at,
+                    value=value,
+                )
+            )
+        elif recorded_at > reading.recorded_at:
+            reading.recorded_at = recorded_at
+            reading.value = value
+            updated.append(reading)
+
+    LatestReading.objects.using(alias).bulk_create(
+        created, batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE
+    )
+    LatestReading.objects.using(alias).bulk_update(
+        updated,
+        ["recorded_at", "value"],
+        batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE,
+    )
+
+
+def invalidate(datalogger_ids=None):
+    # Drops the cached readings of the dataloggers, of all of them when None
+    global _generation
+    with _lock:
+        _generation += 1
+        if datalogger_ids is None:
+            _cache.clear()
+        else:
+            for datalogger_id in datalogger_ids:
+                _cache.pop(datalogger_id, None)
+
+
+def _fetch(alias, datalogger_ids):
+    return (
+        LatestReading.objects.using(alias)
+        .filter(datalogger_id__in=datalogger_ids)
+        .order_by("datalogger_id", "label")
+        .values_list("datalogger_id", "label", "recorded_at", "value")
+    )
+
+
+def readings(datalogger_ids):
+    # Maps each datalogger id to its latest readings ordered by label, from
+    # the in-process LRU cache or, for those missing, one query per shard.
+    # Entries are dropped when this process stores readings and expire after
+    # MEASUREMENTS_LATEST_CACHE_TIMEOUT seconds for those of the others.
+    now = time.monotonic()
+    found = {}
+    missing = []
+    with _lock:
+        generation = _generation
+        for datalogger_id in datalogger_ids:
+            entry = _cache.get(datalogger_id)
+            if entry is not None and entry[0] > now:
+                _cache.move_to_end(datalogger_id)
+                found[datalogger_id] = entry[1]
+            else:
+                missing.append(datalogger_id)
+    if not missing:
+        return found
+
+    fetched = {datalogger_id: [] for datalogger_id in missing}
+    for rows in sharding.fan_out(_fetch, missing):
+        for datalogger_id, label, recorded_at, value in rows:
+            fetched[datalogger_id].append(
+                {"label": label, "recorded_at": recorded_at, "value": value}
+            )
+    found.update(fetched)
+
+    expiry = now + settings.MEASUREMENTS_LATEST_CACHE_TIMEOUT
+    with _lock:
+        if generation == _generation:
+            for datalogger_id, items in fetched.items():
+                _cache[datalogger_id] = (expiry, items)
+                _cache.move_to_end(datalogger_id)
+            while len(_cache) > settings.MEASUREMENTS_LATEST_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return found
@@ -0,0 +1,201 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework.utils import json
+from collections import deque
+import asyncio
+import threading
+
+from .storage import get_storage
+from .streaming import format_datetime
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_subscribers = {}
+_stats = {"subscribers": 0, "published": 0, "overflows": 0}
+
+
+class Subscription:
+    # Events of one datalogger for one stream. They are pushed from any
+    # thread through the event loop of the reader, an idle subscriber is a
+    # coroutine waiting on an asyncio.Event. Events past the buffer size are
+    # dropped and the stream closed: the client resumes from its last event.
+    def __init__(self, datalogger_id):
+        self.datalogger_id = datalogger_id
+        self.loop = asyncio.get_running_loop()
+        self.size = settings.MEASUREMENTS_LIVE_BUFFER_SIZE
+        self.events = deque()
+        self.overflowed = False
+        self.ready = asyncio.Event()
+
+    def push(self, event):
+        # Runs on the event loop of the reader
+        if len(self.events) >= self.size:
+            if not self.overflowed:
+                self.overflowed = True
+                with _lock:
+                    _stats["overflows"] += 1
+        else:
+            self.events.append(event)
+        self.ready.set()
+
+    async def get(self, timeout):
+        # Buffered (recorded_at, data) events, empty after timeout seconds
+        # without any
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.ready.clear()
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+
+def subscribe(datalogger_id):
+    with _lock:
+        if _stats["subscribers"] >= settings.MEASUREMENTS_LIVE_MAX_SUBSCRIBERS:
+            raise TooManySubscribers()
+        subscription = Subscription(datalogger_id)
+        _subscribers.setdefault(datalogger_id, set()).add(subscription)
+        _stats["subscribers"] += 1
+    return subscription
+
+
+def unsubscribe(subscription):
+    with _lock:
+        subscriptions = _subscribers.get(subscription.datalogger_id, set())
+        if subscription in subscriptions:
+            subscriptions.discard(subscription)
+            _stats["subscribers"] -= 1
+        if not subscriptions:
+            _subscribers.pop(subscription.datalogger_id, None)
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
+
+
+def _data(readings):
+    return json.dumps(
+        [
+            {
+                "label": label,
+                "recorded_at": format_datetime(recorded_at),
+                "value": value,
+            }
+            for label, recorded_at, value in readings
+        ]
+    )
+
+
+def publish(measurements):
+    # Fans committed measurements out to the subscribers of their datalogger,
+    # one event per datalogger and time, from any thread. Each event is
+    # serialized once whatever the number of subscribers.
+    with _lock:
+        if not _subscribers:
+            return
+        subscribers = {
+            datalogger_id: list(_subscribers[datalogger_id])
+            for datalogger_id in {m.datalogger_id for m in measurements}
+            if datalogger_id in _subscribers
+        }
+    if not subscribers:
+        return
+
+    records = {}
+    for measurement in measurements:
+        if measurement.datalogger_id in subscribers:
+            key = (measurement.datalogger_id, measurement.recorded_at)
+            records.setdefault(key, []).append(
+                (measurement.label, measurement.recorded_at, measurement.value)
+            )
+
+    for (datalogger_id, recorded_at), readings in sorted(records.items()):
+        event = (recorded_at, _data(readings))
+        for subscription in subscribers[datalogger_id]:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, event)
+            except RuntimeError:
+                # The loop of a stream being torn down is closed
+                pass
+    with _lock:
+        _stats["published"] += len(records)
+
+
+async def _replay(datalogger_id, since):
+    # (recorded_at, data) events of the stored readings after since, read
+    # chunk by chunk with keyset pagination
+    storage = get_storage()
+    chunk_size = settings.MEASUREMENTS_STREAM_CHUNK_SIZE
+    after = None
+    readings = []
+    while True:
+        rows = await sync_to_async(storage.rows)(
+            datalogger_id, lower=since, after=after, limit=chunk_size
+        )
+        for row in rows:
+            if readings and row["recorded_at"] != readings[0][1]:
+                yield readings[0][1], _data(readings)
+                readings = []
+            readings.append((row["label"], row["recorded_at"], row["value"]))
+        if len(rows) < chunk_size:
+            break
+        after = (rows[-1]["recorded_at"], rows[-1]["id"])
+    if readings:
+        yield readings[0][1], _data(readings)
+
+
+def _event(recorded_at, data):
+    return f"id: {format_datetime(recorded_at)}\ndata: {data}\n\n"
+
+
+async def events(subscription, since=None):
+    # Server-sent events of the readings of the subscribed datalogger
+    # recorded after since, stored ones first. The id of an event is its time
+    # and events only move forward: readings committed later with an older
+    # time are left to /api/data, like a client polling with since would
+    # miss them. Ends the subscription when done.
+    try:
+        # Subscribed before the replay so nothing committed meanwhile is lost
+        yield ": subscribed\n\n"
+        if since is not None:
+            async for recorded_at, data in _replay(subscription.datalogger_id, since):
+                since = recorded_at
+                yield _event(recorded_at, data)
+
+        while True:
+            events = await subscription.get(settings.MEASUREMENTS_LIVE_KEEPALIVE)
+            chunk = []
+            for recorded_at, data in events:
+                if since is None or recorded_at > since:
+                    since = recorded_at
+                    chunk.append(_event(recorded_at, data))
+            if chunk:
+                yield "".join(chunk)
+            if subscription.overflowed:
+                return
+            if not events:
+                # Keeps proxies from closing idle streams
+                yield ": keepalive\n\n"
+    finally:
+        unsubscribe(subscription)
+
+
+class Stream:
+    # Streaming content of a subscription taken before the response starts,
+    # closing the response ends it even when nothing was sent
+    def __init__(self, subscription, since=None):
+        self.subscription = subscription
+        self.since = since
+
+    def __aiter__(self):
+        return events(self.subscription, self.since)
+
+    def close(self):
+        unsubscribe(self.subscription)
@@ -0,0 +1,204 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+from contextlib import contextmanager
+import json
+import os
+import tempfile
+
+from measurements import bench
+from measurements.storage import STORAGES
+
+
+@contextmanager
+def throwaway_databases(aliases=(DEFAULT_DB_ALIAS,), directory=None):
+    # Run against throwaway databases so the real ones are left untouched,
+    # in files of directory when given rather than in memory
+    setup_test_environment()
+    created = []
+    try:
+        for alias in aliases:
+            connection = connections[alias]
+            if directory is not None:
+                connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                    directory, f"{alias}.sqlite3"
+                )
+            old_name = connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False
+            )
+            created.append((connection, old_name))
+        yield
+    finally:
+        for connection, old_name in reversed(created):
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark scenarios: suite (ingest throughput and read latency at "
+        "several history sizes, as JSON), ingest (single vs batch ingest), "
+        "storage (narrow vs wide layouts), validation (serializer vs fast "
+        "path) and shards (concurrent writers over 1, 2, 4... shards)"
+    )
+
+    def add_arguments(self, parser):
+        scenarios = parser.add_subparsers(dest="scenario", required=True)
+
+        suite = scenarios.add_parser(
+            "suite", help="Measure /api/ingest and /api/data and /api/summary"
+        )
+        suite.add_argument("--dataloggers", type=int, default=5)
+        suite.add_argument("--days", type=int, nargs="+", default=[1, 7])
+        suite.add_argument(
+            "--interval", type=int, default=600, help="Seconds between readings"
+        )
+        suite.add_argument("--ingest-records", type=int, default=200)
+        suite.add_argument("--repeat", type=int, default=20)
+        suite.add_argument("--seed", type=int, default=0)
+        suite.add_argument("--output", help="File to write, standard output if unset")
+
+        ingest = scenarios.add_parser(
+            "ingest", help="Compare /api/ingest and /api/ingest/batch"
+        )
+        ingest.add_argument("--records", type=int, default=1000)
+        ingest.add_argument("--batch-size", type=int, default=500)
+        ingest.add_argument("--dataloggers", type=int, default=10)
+        ingest.add_argument("--seed", type=int, default=0)
+
+        storage = scenarios.add_parser(
+            "storage", help="Compare the narrow and wide storage layouts"
+        )
+        storage.add_argument("--records", type=int, default=2000)
+        storage.add_argument("--dataloggers", type=int, default=10)
+        storage.add_argument("--repeat", type=int, default=5)
+        storage.add_argument("--seed", type=int, default=0)
+
+        validation = scenarios.add_parser(
+            "validation", help="Compare the serializer and fast validation paths"
+        )
+        validation.add_argument("--records", type=int, default=5000)
+        validation.add_argument("--dataloggers", type=int, default=10)
+        validation.add_argument("--seed", type=int, default=0)
+
+        shards = scenarios.add_parser(
+            "shards", help="Measure concurrent ingest over several shard counts"
+        )
+        shards.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+        shards.add_argument("--writers", type=int, default=4)
+        shards.add_argument("--dataloggers", type=int, default=16)
+        shards.add_argument("--records", type=int, default=4000)
+        shards.add_argument("--batch-size", type=int, default=50)
+        shards.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            getattr(self, f"handle_{options['scenario']}")(options)
+        except bench.BenchError as exc:
+            raise CommandError(str(exc))
+
+    def handle_suite(self, options):
+        with throwaway_databases():
+            result = bench.bench_suite(
+                dataloggers=options["dataloggers"],
+                days=options["days"],
+                interval=options["interval"],
+                ingest_records=options["ingest_records"],
+                repeat=options["repeat"],
+                seed=options["seed"],
+            )
+
+        output = json.dumps(result, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def handle_ingest(self, options):
+        with throwaway_databases():
+            result = bench.bench_ingest(
+                count=options["records"],
+                batch_size=options["batch_size"],
+                dataloggers=options["dataloggers"],
+                seed=options["seed"],
+            )
+
+        self.stdout.write(
+            f"single: {result['single']['records_per_second']:.0f} records/s "
+            f"({result['single']['seconds']:.2f}s)"
+        )
+        self.stdout.write(
+            f"batch:  {result['batch']['records_per_second']:.0f} records/s "
+            f"({result['batch']['seconds']:.2f}s, batch size {result['batch_size']})"
+        )
+        self.stdout.write(f"speedup: x{result['speedup']:.1f}")
+
+    def handle_storage(self, options):
+        with throwaway_databases():
+            result = bench.bench_storage(
+                count=options["records"],
+                dataloggers=options["dataloggers"],
+                repeat=options["repeat"],
+                seed=options["seed"],
+            )
+
+        latencies = list(result["narrow"]["latency_ms"])
+        self.stdout.write(
+            f"{'layout':<8}{'rows':>8}{'table KiB':>11}{'index KiB':>11}"
+            + "".join(f"{name + ' ms':>16}" for name in latencies)
+        )
+        for layout in STORAGES:
+            stats = result[layout]
+            self.stdout.write(
+                f"{layout:<8}{stats['rows']:>8}"
+                f"{stats['table_bytes'] / 1024:>11.0f}"
+                f"{stats['index_bytes'] / 1024:>11.0f}"
+                + "".join(f"{stats['latency_ms'][name]:>16.2f}" for name in latencies)
+            )
+
+    def handle_validation(self, options):
+        # No database access, records are only validated
+        result = bench.bench_validation(
+            count=options["records"],
+            dataloggers=options["dataloggers"],
+            seed=options["seed"],
+        )
+
+        for name in ["serializer", "fast"]:
+            self.stdout.write(
+                f"{name + ':':<12}{result[name]['us_per_record']:.1f} us/record "
+                f"({result[name]['seconds']:.2f}s)"
+            )
+        self.stdout.write(f"speedup: x{result['speedup']:.1f}")
+
+    def handle_shards(self, options):
+        aliases = [f"shard{shard}" for shard in range(max(options["shards"]))]
+        missing = [alias for alias in aliases if alias not in connections]
+        if missing:
+            raise CommandError(f"Unknown databases: {', '.join(missing)}")
+
+        # Database files so that writers do not share a single lock
+        with tempfile.TemporaryDirectory() as directory:
+            with throwaway_databases([DEFAULT_DB_ALIAS, *aliases], directory):
+                result = bench.bench_shards(
+                    shard_counts=options["shards"],
+                    writers=options["writers"],
+                    dataloggers=options["dataloggers"],
+                    count=options["records"],
+                    batch_size=options["batch_size"],
+                    seed=options["seed"],
+                )
+
+        baseline = None
+        for shards, timing in result["shards"].items():
+            baseline = baseline or timing["records_per_second"]
+            self.stdout.write(
+                f"{shards} shards: {timing['records_per_second']:.0f} records/s "
+                f"({timing['seconds']:.2f}s, "
+                f"x{timing['records_per_second'] / baseline:.1f})"
+            )
+        self.stdout.write(
+            f"{result['records']} records, {result['writers']} writers, "
+            f"batch size {result['batch_size']}"
+        )
@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from measurements import caching, retention, rollups, sharding
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete raw measurements older than MEASUREMENTS_RAW_RETENTION_DAYS, "
+        "keeping their hourly and daily rollups"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.MEASUREMENTS_COMPACT_CHUNK_SIZE,
+            help="Number of raw rows deleted per transaction",
+        )
+        parser.add_argument(
+            "--vacuum-pages",
+            type=int,
+            default=1000,
+            help="Number of free pages released per incremental vacuum step",
+        )
+        parser.add_argument(
+            "--enable-incremental-vacuum",
+            action="store_true",
+            help="Switch the SQLite database to incremental auto vacuum first, "
+            "this rewrites the whole file once",
+        )
+
+    def handle(self, *args, **options):
+        horizon = rollups.retention_horizon()
+        if horizon is None:
+            raise CommandError(
+                "Set MEASUREMENTS_RAW_RETENTION_DAYS to compact raw measurements"
+            )
+        if options["chunk_size"] < 1 or options["vacuum_pages"] < 1:
+            raise CommandError("--chunk-size and --vacuum-pages must be positive")
+
+        created, deleted = retention.compact(horizon, options["chunk_size"])
+        if deleted:
+            # Cached /api/data blocks still hold the deleted rows
+            caching.get_cache().clear()
+        self.stdout.write(
+            f"{deleted} raw rows recorded before {horizon.isoformat()} deleted, "
+            f"{created} missing rollups created"
+        )
+
+        # Raw readings live on the shards
+        shards = sharding.shards()
+        for alias in shards:
+            prefix = f"{alias}: " if len(shards) > 1 else ""
+            self.stdout.write(prefix + self.vacuum(alias, options))
+
+    def vacuum(self, alias, options):
+        mode = retention.auto_vacuum(alias)
+        if mode is None:
+            return "Space is reclaimed by the database autovacuum"
+        if mode != "incremental" and options["enable_incremental_vacuum"]:
+            retention.enable_incremental_vacuum(alias)
+            mode = retention.auto_vacuum(alias)
+        if mode != "incremental":
+            return (
+                f"SQLite auto_vacuum is {mode}, run with "
+                "--enable-incremental-vacuum once to release free pages"
+            )
+        pages = retention.vacuum(options["vacuum_pages"], alias)
+        return f"{pages} free pages released"
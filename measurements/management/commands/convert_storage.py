@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from measurements import caching, rollups, sharding
+from measurements.conditional import touch
+from measurements.storage import STORAGES, get_storage
+
+
+def convert(target, chunk_size):
+    # Moves the readings stored in the other layout into target, one
+    # transaction per datalogger on its shard
+    target = get_storage(target)
+    moved = 0
+    for source in STORAGES.values():
+        if source is target:
+            continue
+        for datalogger_id in list(source.datalogger_ids()):
+            with transaction.atomic(using=sharding.shard_for(datalogger_id)):
+                read = stored = 0
+                batch = []
+                for measurement in source.measurements(datalogger_id, chunk_size):
+                    # Readings of one time must be saved together, the wide
+                    # layout would otherwise split them over two rows
+                    if (
+                        len(batch) >= chunk_size
+                        and measurement.recorded_at != batch[-1].recorded_at
+                    ):
+                        stored += len(target.save(batch))
+                        batch = []
+                    measurement.pk = None
+                    batch.append(measurement)
+                    read += 1
+                stored += len(target.save(batch))
+                source.delete(datalogger_id)
+                if stored != read:
+                    # Duplicate labels were merged, the rollups counted them
+                    rollups.rebuild(datalogger_id, target.name)
+            moved += stored
+    return moved
+
+
+class Command(BaseCommand):
+    help = "Move raw readings to the narrow or wide storage layout"
+
+    def add_arguments(self, parser):
+        parser.add_argument("layout", choices=sorted(STORAGES))
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.MEASUREMENTS_STREAM_CHUNK_SIZE,
+            help="Number of measurements written per bulk insert",
+        )
+
+    def handle(self, *args, **options):
+        count = convert(options["layout"], options["chunk_size"])
+        # Cached blocks hold row ids of the previous layout
+        caching.get_cache().clear()
+        touch()
+
+        self.stdout.write(
+            f"{count} measurements moved to the {options['layout']} layout"
+        )
+        if settings.MEASUREMENTS_STORAGE != options["layout"]:
+            self.stdout.write(
+                f"Set MEASUREMENTS_STORAGE = {options['layout']!r} to serve them"
+            )
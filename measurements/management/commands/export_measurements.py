@@ -0,0 +1,101 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+import time
+import uuid
+
+from measurements.models import Datalogger, Measurement
+from measurements.transfer import EXPORT_FORMATS, export_measurements
+
+
+class Command(BaseCommand):
+    help = "Export raw measurements as CSV or NDJSON records"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            nargs="?",
+            default="-",
+            help="Output file, standard output by default",
+        )
+        parser.add_argument(
+            "--format",
+            choices=sorted(EXPORT_FORMATS),
+            help="File format, guessed from the extension by default",
+        )
+        parser.add_argument(
+            "--datalogger",
+            action="append",
+            help="Only export this datalogger, can be repeated",
+        )
+        parser.add_argument("--since", help="Only export readings recorded after")
+        parser.add_argument("--before", help="Only export readings recorded before")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        export_format = options["format"]
+        if export_format is None:
+            export_format = "csv" if path.endswith(".csv") else "ndjson"
+
+        datalogger_ids = None
+        if options["datalogger"] is not None:
+            try:
+                uuids = {uuid.UUID(value) for value in options["datalogger"]}
+            except ValueError:
+                raise CommandError("Invalid datalogger ID format")
+            datalogger_ids = list(
+                Datalogger.objects.filter(uuid__in=uuids).values_list("id", flat=True)
+            )
+            if len(datalogger_ids) != len(uuids):
+                raise CommandError("Unknown datalogger")
+
+        # Same formats as the since and before query parameters
+        bounds = {"since": None, "before": None}
+        field = Measurement._meta.get_field("recorded_at")
+        for name in bounds:
+            if options[name] is not None:
+                try:
+                    bounds[name] = field.to_python(options[name])
+                except ValidationError:
+                    raise CommandError(f"Invalid --{name} value")
+                if timezone.is_naive(bounds[name]):
+                    bounds[name] = timezone.make_aware(bounds[name])
+
+        started = last = time.perf_counter()
+
+        def progress(stats):
+            nonlocal last
+            now = time.perf_counter()
+            if now - last >= 1:
+                last = now
+                self.stderr.write(self._summary(stats, now - started))
+
+        if path == "-":
+            output = None
+            write = lambda chunk: self.stdout.write(chunk, ending="")
+        else:
+            output = open(path, "w", newline="", encoding="utf-8")
+            write = output.write
+        try:
+            count = export_measurements(
+                write,
+                export_format,
+                datalogger_ids,
+                bounds["since"],
+                bounds["before"],
+                progress=progress,
+            )
+        finally:
+            if output is not None:
+                output.close()
+
+        self.stderr.write(
+            self._summary({"measurements": count}, time.perf_counter() - started)
+        )
+
+    def _summary(self, stats, elapsed):
+        rate = stats["measurements"] / elapsed if elapsed else 0
+        return (
+            f"{stats['measurements']} measurements exported in {elapsed:.1f}s "
+            f"({rate:.0f} measurements/s)"
+        )
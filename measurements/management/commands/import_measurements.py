@@ -0,0 +1,91 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import sys
+import time
+
+from measurements.transfer import READERS, InvalidRecords, import_measurements
+
+
+class Command(BaseCommand):
+    help = (
+        "Import records from a CSV or NDJSON file, as exported by export_measurements"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import, - for the standard input")
+        parser.add_argument(
+            "--format",
+            choices=sorted(READERS),
+            help="File format, guessed from the extension by default",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.MEASUREMENTS_IMPORT_BATCH_SIZE,
+            help="Number of records stored per transaction",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes parsing and validating records",
+        )
+        parser.add_argument(
+            "--skip-invalid",
+            action="store_true",
+            help="Report invalid records and import the others",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        import_format = options["format"]
+        if import_format is None:
+            import_format = "csv" if path.endswith(".csv") else "ndjson"
+        if options["batch_size"] < 1 or options["workers"] < 1:
+            raise CommandError("--batch-size and --workers must be positive")
+
+        started = last = time.perf_counter()
+
+        def progress(stats):
+            nonlocal last
+            now = time.perf_counter()
+            if now - last >= 1:
+                last = now
+                self.stderr.write(self._summary(stats, now - started))
+
+        def invalid(errors):
+            for error in errors:
+                self.stderr.write(f"Line {error['line']}: {error['errors']}")
+
+        stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        try:
+            stats = import_measurements(
+                stream,
+                import_format,
+                options["batch_size"],
+                workers=options["workers"],
+                skip_invalid=options["skip_invalid"],
+                progress=progress,
+                invalid=invalid,
+            )
+        except InvalidRecords as exc:
+            invalid(exc.errors)
+            raise CommandError(
+                f"{exc}, records of earlier batches were imported. "
+                "Use --skip-invalid to import the valid ones."
+            )
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stdout.write(self._summary(stats, time.perf_counter() - started))
+
+    def _summary(self, stats, elapsed):
+        rate = stats["measurements"] / elapsed if elapsed else 0
+        summary = (
+            f"{stats['records']} records, {stats['measurements']} measurements "
+            f"imported in {elapsed:.1f}s ({rate:.0f} measurements/s)"
+        )
+        if stats["invalid"]:
+            summary += f", {stats['invalid']} invalid records skipped"
+        return summary
@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from itertools import islice
+
+from measurements import caching, latest, rollups, sharding
+from measurements.conditional import touch
+from measurements.models import (
+    Datalogger,
+    LatestReading,
+    Location,
+    Measurement,
+    MeasurementRecord,
+    MeasurementRollup,
+)
+
+# Fields copied to every shard, the others only matter in the default database
+REPLICATED_FIELDS = {
+    Datalogger: ["id", "uuid"],
+    Location: ["id", "lat", "lng", "cell"],
+}
+
+# Rows moved with their datalogger, raw readings of both layouts included
+MOVED_MODELS = [Measurement, MeasurementRecord, MeasurementRollup, LatestReading]
+ROLLUP_FIELDS = ["count", "total", "minimum", "maximum"]
+
+
+def _chunks(iterator, chunk_size):
+    while chunk := list(islice(iterator, chunk_size)):
+        yield chunk
+
+
+def replicate(chunk_size):
+    # Dataloggers and locations created before a shard was added
+    for model, fields in REPLICATED_FIELDS.items():
+        rows = model.objects.order_by("id").values(*fields)
+        for chunk in _chunks(rows.iterator(chunk_size=chunk_size), chunk_size):
+            sharding.replicate(model, chunk)
+
+
+def move(model, datalogger_id, source, target, chunk_size):
+    # Copies the rows of a datalogger one transaction per chunk, then deletes
+    # them from source. Rows get new ids on target, a run interrupted before
+    # the deletion skips the ones already copied when started again.
+    rows = model.objects.using(source).filter(datalogger_id=datalogger_id)
+    count = 0
+    for chunk in _chunks(
+        rows.order_by("id").iterator(chunk_size=chunk_size), chunk_size
+    ):
+        for row in chunk:
+            row.pk = None
+        with transaction.atomic(using=target):
+            model.objects.using(target).bulk_create(chunk, ignore_conflicts=True)
+        count += len(chunk)
+    with transaction.atomic(using=source):
+        rows.delete()
+    return count
+
+
+def move_rollups(datalogger_id, source, target, chunk_size):
+    # Rollups of a bucket stored on both sides, when readings were ingested
+    # on the target before the move, are added up like ingest does. Each
+    # chunk is deleted from source right after being merged.
+    rows = MeasurementRollup.objects.using(source).filter(datalogger_id=datalogger_id)
+    rows = rows.order_by("id").values_list(
+        "id", "span", "bucket", "label", *ROLLUP_FIELDS
+    )
+    count = 0
+    for chunk in _chunks(rows.iterator(chunk_size=chunk_size), chunk_size):
+        groups = {
+            (datalogger_id, span, bucket, label): list(values)
+            for _, span, bucket, label, *values in chunk
+        }
+        with transaction.atomic(using=target):
+            rollups.merge(target, groups)
+        with transaction.atomic(using=source):
+            MeasurementRollup.objects.using(source).filter(
+                id__in=[row[0] for row in chunk]
+            ).delete()
+        count += len(chunk)
+    return count
+
+
+def move_latest(datalogger_id, source, target):
+    # A datalogger has a latest reading per label, the most recent of both
+    # sides is kept
+    rows = LatestReading.objects.using(source).filter(datalogger_id=datalogger_id)
+    readings = {
+        (datalogger_id, label): (recorded_at, value)
+        for label, recorded_at, value in rows.values_list(
+            "label", "recorded_at", "value"
+        )
+    }
+    with transaction.atomic(using=target):
+        latest.merge(target, readings)
+    with transaction.atomic(using=source):
+        rows.delete()
+    return len(readings)
+
+
+def rebalance(sources, chunk_size):
+    # Moves every row found on another database than the shard of its
+    # datalogger there. Returns the number of rows moved per datalogger.
+    replicate(chunk_size)
+    moved = {}
+    for source in sources:
+        for model in MOVED_MODELS:
+            datalogger_ids = (
+                model.objects.using(source)
+                .order_by()
+                .values_list("datalogger_id", flat=True)
+                .distinct()
+            )
+            for datalogger_id in list(datalogger_ids):
+                target = sharding.shard_for(datalogger_id)
+                if target == source:
+                    continue
+                if model is MeasurementRollup:
+                    count = move_rollups(datalogger_id, source, target, chunk_size)
+                elif model is LatestReading:
+                    count = move_latest(datalogger_id, source, target)
+                else:
+                    count = move(model, datalogger_id, source, target, chunk_size)
+                    moved[datalogger_id] = moved.get(datalogger_id, 0) + count
+    return moved
+
+
+class Command(BaseCommand):
+    help = (
+        "Move raw readings, rollups and latest readings to the shard of their "
+        "datalogger after MEASUREMENTS_SHARDS changed, with ingest stopped"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source",
+            nargs="+",
+            default=[],
+            help="Databases no longer in MEASUREMENTS_SHARDS to empty as well",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.MEASUREMENTS_BULK_BATCH_SIZE,
+            help="Number of rows copied per transaction",
+        )
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        sources = list(
+            dict.fromkeys([DEFAULT_DB_ALIAS, *sharding.shards(), *options["source"]])
+        )
+        unknown = [alias for alias in sources if alias not in settings.DATABASES]
+        if unknown:
+            raise CommandError(f"Unknown databases: {', '.join(unknown)}")
+
+        moved = rebalance(sources, options["chunk_size"])
+        if moved:
+            # Moved rows have new ids, cached blocks and validators hold the
+            # old ones
+            caching.get_cache().clear()
+            latest.invalidate()
+            touch(list(moved))
+        self.stdout.write(
+            f"{sum(moved.values())} rows of {len(moved)} dataloggers moved "
+            f"across {len(sharding.shards())} shards"
+        )
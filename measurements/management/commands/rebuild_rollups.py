@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+import uuid
+
+from measurements import rollups
+from measurements.conditional import touch
+from measurements.models import Datalogger
+
+
+class Command(BaseCommand):
+    help = "Recompute the hourly and daily rollups from raw measurements"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--datalogger", help="Only rebuild the rollups of this datalogger"
+        )
+
+    def handle(self, *args, **options):
+        datalogger_id = None
+        if options["datalogger"] is not None:
+            try:
+                datalogger = Datalogger.objects.get(
+                    uuid=uuid.UUID(options["datalogger"])
+                )
+            except ValueError:
+                raise CommandError("Invalid datalogger ID format")
+            except Datalogger.DoesNotExist:
+                raise CommandError("Unknown datalogger")
+            datalogger_id = datalogger.id
+
+        count = rollups.rebuild(datalogger_id)
+        touch(None if datalogger_id is None else [datalogger_id])
+        self.stdout.write(f"{count} rollups rebuilt")
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+import time
+
+from measurements import replicas
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the default and shard SQLite databases into their replicas listed "
+        "in MEASUREMENTS_REPLICAS, once or every --interval seconds"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Seconds between copies, keeps running when given",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.MEASUREMENTS_REPLICAS:
+            raise CommandError("Set POCW_REPLICAS to copy the databases to replicas")
+        for alias in settings.MEASUREMENTS_REPLICAS:
+            if connections[alias].vendor != "sqlite":
+                raise CommandError(
+                    f"{alias} is a {connections[alias].vendor} database, its "
+                    "replicas are kept in sync by the database server"
+                )
+        if options["interval"] is not None and options["interval"] <= 0:
+            raise CommandError("--interval must be positive")
+
+        while True:
+            started = time.perf_counter()
+            for alias, copies in settings.MEASUREMENTS_REPLICAS.items():
+                for replica in copies:
+                    replicas.sync(alias, replica)
+                self.stdout.write(f"{alias} copied to {', '.join(copies)}")
+            if options["interval"] is None:
+                return
+            time.sleep(max(0, options["interval"] - (time.perf_counter() - started)))
@@ -0,0 +1,295 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from contextlib import ExitStack
+import logging
+import threading
+import time
+
+from . import buffering, caching, live, replicas, sharding
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Length of the SQL statements quoted by the slow request log
+SLOW_SQL_LENGTH = 500
+
+_lock = threading.Lock()
+_endpoints = {}
+
+
+def _endpoint_stats():
+    return {
+        "buckets": [0] * len(LATENCY_BUCKETS),
+        "count": 0,
+        "seconds": 0.0,
+        "queries": 0,
+        "query_seconds": 0.0,
+        "rows": 0,
+        "render_seconds": 0.0,
+    }
+
+
+def reset():
+    with _lock:
+        _endpoints.clear()
+
+
+def stats():
+    with _lock:
+        return {
+            endpoint: dict(values, buckets=list(values["buckets"]))
+            for endpoint, values in _endpoints.items()
+        }
+
+
+def _rows(response):
+    # Items returned by DRF responses: a list, a page of results or lists
+    # keyed by datalogger. Streamed bodies are not counted.
+    data = getattr(response, "data", None)
+    if isinstance(data, list):
+        return len(data)
+    if isinstance(data, dict):
+        if isinstance(data.get("results"), list):
+            return len(data["results"])
+        if data and all(isinstance(value, list) for value in data.values()):
+            return sum(len(value) for value in data.values())
+    return 0
+
+
+class RequestMetrics:
+    # Collects the SQL of a single request, installed as a database execute
+    # wrapper. Statements are only kept when the slow request log is on.
+    def __init__(self, keep_sql):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.render_started = None
+        self.render_seconds = 0.0
+        self.statements = [] if keep_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.query_seconds += elapsed
+            if self.statements is not None:
+                self.statements.append((elapsed, sql))
+
+    def rendering(self, response):
+        self.render_started = time.perf_counter()
+        response.add_post_render_callback(self.rendered)
+
+    def rendered(self, response):
+        self.render_seconds = time.perf_counter() - self.render_started
+
+    def finish(self, request, response):
+        elapsed = time.perf_counter() - self.started
+        match = request.resolver_match
+        if match is None or match.url_name is None:
+            # Unknown URLs would make the endpoint label unbounded
+            return
+        rows = _rows(response)
+
+        with _lock:
+            values = _endpoints.get(match.url_name)
+            if values is None:
+                values = _endpoints[match.url_name] = _endpoint_stats()
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    values["buckets"][index] += 1
+                    break
+            values["count"] += 1
+            values["seconds"] += elapsed
+            values["queries"] += self.queries
+            values["query_seconds"] += self.query_seconds
+            values["rows"] += rows
+            values["render_seconds"] += self.render_seconds
+
+        threshold = settings.MEASUREMENTS_SLOW_REQUEST_SECONDS
+        if threshold is not None and elapsed >= threshold:
+            self._log_slow(request, response, elapsed)
+
+    def _log_slow(self, request, response, elapsed):
+        lines = [
+            f"Slow request {request.method} {request.get_full_path()} "
+            f"{response.status_code} in {elapsed * 1000:.1f}ms: "
+            f"{self.queries} queries in {self.query_seconds * 1000:.1f}ms, "
+            f"rendered in {self.render_seconds * 1000:.1f}ms"
+        ]
+        for query_seconds, sql in self.statements or []:
+            lines.append(f"  {query_seconds * 1000:.1f}ms {sql[:SLOW_SQL_LENGTH]}")
+        logger.warning("\n".join(lines))
+
+
+class MetricsMiddleware:
+    # Times every request routed to a named URL. Synchronous requests also
+    # count their SQL on the default database, the shards and the replicas,
+    # except the queries fanned out to the shard thread pool, and record
+    # their rendering time. Async views only record their latency since
+    # their queries run in other threads.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.MEASUREMENTS_METRICS_ENABLED:
+            return self.get_response(request)
+
+        request.metrics = RequestMetrics(
+            settings.MEASUREMENTS_SLOW_REQUEST_SECONDS is not None
+        )
+        with ExitStack() as stack:
+            aliases = [DEFAULT_DB_ALIAS, *sharding.shards(), *replicas.aliases()]
+            for alias in dict.fromkeys(aliases):
+                stack.enter_context(connections[alias].execute_wrapper(request.metrics))
+            response = self.get_response(request)
+        request.metrics.finish(request, response)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.MEASUREMENTS_METRICS_ENABLED:
+            return await self.get_response(request)
+
+        request.metrics = RequestMetrics(False)
+        response = await self.get_response(request)
+        request.metrics.finish(request, response)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns
+        metrics = getattr(request, "metrics", None)
+        if metrics is not None:
+            metrics.rendering(response)
+        return response
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric(lines, name, kind, help_text, samples):
+    # samples are (suffix, labels, value), labels a list of (name, value)
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for suffix, labels, value in samples:
+        labels = ",".join(f'{key}="{_escape(label)}"' for key, label in labels)
+        if labels:
+            lines.append(f"{name}{suffix}{{{labels}}} {value}")
+        else:
+            lines.append(f"{name}{suffix} {value}")
+
+
+def render():
+    # Prometheus text exposition format, version 0.0.4
+    endpoints = sorted(stats().items())
+    lines = []
+
+    samples = []
+    for endpoint, values in endpoints:
+        labels = [("endpoint", endpoint)]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, values["buckets"]):
+            cumulative += count
+            samples.append(("_bucket", labels + [("le", repr(bound))], cumulative))
+        samples.append(("_bucket", labels + [("le", "+Inf")], values["count"]))
+        samples.append(("_sum", labels, values["seconds"]))
+        samples.append(("_count", labels, values["count"]))
+    _metric(
+        lines,
+        "measurements_request_duration_seconds",
+        "histogram",
+        "Request latency per endpoint.",
+        samples,
+    )
+
+    for name, key, help_text in [
+        ("sql_queries_total", "queries", "SQL queries run per endpoint."),
+        ("sql_seconds_total", "query_seconds", "Time spent in SQL per endpoint."),
+        ("rows_total", "rows", "Items returned in response bodies per endpoint."),
+        (
+            "serialization_seconds_total",
+            "render_seconds",
+            "Time spent rendering response bodies per endpoint.",
+        ),
+    ]:
+        _metric(
+            lines,
+            f"measurements_{name}",
+            "counter",
+            help_text,
+            [
+                ("", [("endpoint", endpoint)], values[key])
+                for endpoint, values in endpoints
+            ],
+        )
+
+    cache = caching.stats()
+    for name in ["hits", "misses"]:
+        _metric(
+            lines,
+            f"measurements_cache_{name}_total",
+            "counter",
+            f"Read cache {name} per kind of block.",
+            [
+                ("", [("kind", kind)], counters[name])
+                for kind, counters in cache.items()
+            ],
+        )
+
+    queue = buffering.stats()
+    _metric(
+        lines,
+        "measurements_ingest_queue_depth",
+        "gauge",
+        "Records waiting for the buffered ingest writer.",
+        [("", [], queue["depth"])],
+    )
+    _metric(
+        lines,
+        "measurements_ingest_queue_stuck",
+        "gauge",
+        "Records of the batch the buffered ingest writer is retrying.",
+        [("", [], queue["stuck"])],
+    )
+    for name in ["accepted", "rejected", "written", "failed"]:
+        _metric(
+            lines,
+            f"measurements_ingest_queue_{name}_total",
+            "counter",
+            f"Buffered ingest records {name}.",
+            [("", [], queue[name])],
+        )
+
+    subscribers = live.stats()
+    _metric(
+        lines,
+        "measurements_live_subscribers",
+        "gauge",
+        "Open /api/stream subscriptions.",
+        [("", [], subscribers["subscribers"])],
+    )
+    for name, help_text in [
+        ("published", "Events published to /api/stream subscribers."),
+        ("overflows", "Subscriptions closed for falling behind."),
+    ]:
+        _metric(
+            lines,
+            f"measurements_live_{name}_total",
+            "counter",
+            help_text,
+            [("", [], subscribers[name])],
+        )
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,88 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:08
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncDay, TruncHour
+
+BATCH_SIZE = 500
+
+
+def fill(apps, schema_editor):
+    # Rollups of the measurements stored before the table existed, ingest
+    # only updates them for new readings
+    db = schema_editor.connection.alias
+    Measurement = apps.get_model("measurements", "Measurement")
+    MeasurementRollup = apps.get_model("measurements", "MeasurementRollup")
+    for span, trunc in [("hour", TruncHour), ("day", TruncDay)]:
+        groups = (
+            Measurement.objects.using(db)
+            .annotate(bucket=trunc("recorded_at"))
+            .values("datalogger", "bucket", "label")
+            .annotate(
+                count=Count("id"),
+                total=Sum("value"),
+                minimum=Min("value"),
+                maximum=Max("value"),
+            )
+            .order_by()
+        )
+        MeasurementRollup.objects.using(db).bulk_create(
+            (MeasurementRollup(span=span, **group) for group in groups),
+            batch_size=BATCH_SIZE,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("measurements", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MeasurementRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "span",
+                    models.CharField(
+                        choices=[("hour", "Hour"), ("day", "Day")], max_length=4
+                    ),
+                ),
+                ("bucket", models.DateTimeField()),
+                ("datalogger", models.UUIDField()),
+                (
+                    "label",
+                    models.CharField(
+                        choices=[
+                            ("temp", "Temperature"),
+                            ("rain", "Rainfall"),
+                            ("hum", "Humidity"),
+                        ],
+                        max_length=4,
+                    ),
+                ),
+                ("count", models.PositiveIntegerField()),
+                ("total", models.FloatField()),
+                ("minimum", models.FloatField()),
+                ("maximum", models.FloatField()),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("datalogger", "span", "bucket", "label"),
+                        name="unique_rollup_bucket",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(fill, migrations.RunPython.noop),
+    ]
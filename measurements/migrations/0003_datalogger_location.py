@@ -0,0 +1,246 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+CHUNK_SIZE = 2000
+
+
+def normalize(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Datalogger = apps.get_model("measurements", "Datalogger")
+    Location = apps.get_model("measurements", "Location")
+    Measurement = apps.get_model("measurements", "Measurement")
+    MeasurementRollup = apps.get_model("measurements", "MeasurementRollup")
+    measurements = Measurement.objects.using(db)
+    rollups = MeasurementRollup.objects.using(db)
+
+    dataloggers = set(measurements.values_list("datalogger", flat=True).distinct())
+    dataloggers |= set(rollups.values_list("datalogger", flat=True).distinct())
+    for datalogger_uuid in dataloggers:
+        datalogger = Datalogger.objects.using(db).create(uuid=datalogger_uuid)
+        measurements.filter(datalogger=datalogger_uuid).update(
+            datalogger_ref=datalogger
+        )
+        rollups.filter(datalogger=datalogger_uuid).update(datalogger_ref=datalogger)
+
+    # Walk the table by id, grouping each chunk by location fix
+    locations = {}
+    last_id = 0
+    while True:
+        rows = list(
+            measurements.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "location")[:CHUNK_SIZE]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        groups = {}
+        for measurement_id, location in rows:
+            key = (float(location["lat"]), float(location["lng"]))
+            groups.setdefault(key, []).append(measurement_id)
+
+        for (lat, lng), ids in groups.items():
+            location = locations.get((lat, lng))
+            if location is None:
+                location = Location.objects.using(db).create(lat=lat, lng=lng)
+                locations[(lat, lng)] = location
+            measurements.filter(id__in=ids).update(location_ref=location)
+
+
+def denormalize(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Datalogger = apps.get_model("measurements", "Datalogger")
+    Location = apps.get_model("measurements", "Location")
+    Measurement = apps.get_model("measurements", "Measurement")
+    MeasurementRollup = apps.get_model("measurements", "MeasurementRollup")
+    measurements = Measurement.objects.using(db)
+    rollups = MeasurementRollup.objects.using(db)
+
+    for datalogger in Datalogger.objects.using(db).iterator():
+        measurements.filter(datalogger_ref=datalogger).update(
+            datalogger=datalogger.uuid
+        )
+        rollups.filter(datalogger_ref=datalogger).update(datalogger=datalogger.uuid)
+
+    for location in Location.objects.using(db).iterator():
+        measurements.filter(location_ref=location).update(
+            location={"lat": location.lat, "lng": location.lng}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("measurements", "0002_measurementrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Datalogger",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uuid", models.UUIDField(unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Location",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("lat", models.FloatField()),
+                ("lng", models.FloatField()),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("lat", "lng"), name="unique_location"
+                    )
+                ],
+            },
+        ),
+        migrations.RemoveConstraint(
+            model_name="measurementrollup",
+            name="unique_rollup_bucket",
+        ),
+        migrations.RemoveIndex(
+            model_name="measurement",
+            name="measurement_datalog_457607_idx",
+        ),
+        # Old columns become nullable so the migration can be reversed
+        migrations.AlterField(
+            model_name="measurement",
+            name="datalogger",
+            field=models.UUIDField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="measurement",
+            name="location",
+            field=models.JSONField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="measurementrollup",
+            name="datalogger",
+            field=models.UUIDField(null=True),
+        ),
+        migrations.AddField(
+            model_name="measurement",
+            name="datalogger_ref",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="measurements.datalogger",
+            ),
+        ),
+        migrations.AddField(
+            model_name="measurement",
+            name="location_ref",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="measurements.location",
+            ),
+        ),
+        migrations.AddField(
+            model_name="measurementrollup",
+            name="datalogger_ref",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="measurements.datalogger",
+            ),
+        ),
+        migrations.RunPython(normalize, denormalize),
+        migrations.RemoveField(
+            model_name="measurement",
+            name="datalogger",
+        ),
+        migrations.RemoveField(
+            model_name="measurement",
+            name="location",
+        ),
+        migrations.RemoveField(
+            model_name="measurementrollup",
+            name="datalogger",
+        ),
+        migrations.RenameField(
+            model_name="measurement",
+            old_name="datalogger_ref",
+            new_name="datalogger",
+        ),
+        migrations.RenameField(
+            model_name="measurement",
+            old_name="location_ref",
+            new_name="location",
+        ),
+        migrations.RenameField(
+            model_name="measurementrollup",
+            old_name="datalogger_ref",
+            new_name="datalogger",
+        ),
+        migrations.AlterField(
+            model_name="measurement",
+            name="datalogger",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="measurements",
+                to="measurements.datalogger",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="measurement",
+            name="location",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="measurements",
+                to="measurements.location",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="measurementrollup",
+            name="datalogger",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="rollups",
+                to="measurements.datalogger",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="measurement",
+            index=models.Index(
+                fields=["datalogger", "recorded_at"],
+                name="measurement_datalog_2c7d09_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="measurementrollup",
+            constraint=models.UniqueConstraint(
+                fields=("datalogger", "span", "bucket", "label"),
+                name="unique_rollup_bucket",
+            ),
+        ),
+    ]
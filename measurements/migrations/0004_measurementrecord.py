@@ -0,0 +1,58 @@
+# Generated by Django 5.1.6 on 2026-10-17 16:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("measurements", "0003_datalogger_location"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MeasurementRecord",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("recorded_at", models.DateTimeField()),
+                ("temp", models.FloatField(null=True)),
+                ("rain", models.FloatField(null=True)),
+                ("hum", models.FloatField(null=True)),
+                (
+                    "datalogger",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="records",
+                        to="measurements.datalogger",
+                    ),
+                ),
+                (
+                    "location",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="records",
+                        to="measurements.location",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["datalogger", "recorded_at"],
+                        name="measurement_datalog_c2496f_idx",
+                    )
+                ],
+            },
+        ),
+    ]
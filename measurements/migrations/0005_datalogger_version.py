@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-17 17:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("measurements", "0004_measurementrecord"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="datalogger",
+            name="modified_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="datalogger",
+            name="version",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
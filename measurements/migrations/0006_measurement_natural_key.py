@@ -0,0 +1,190 @@
+# Generated by Django 5.1.6 on 2026-10-17 17:55
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, migrations, models
+from django.db.models import Count, F, Max, Min, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+BATCH_SIZE = 500
+LABELS = ["temp", "rain", "hum"]
+SPAN_TRUNCS = {"hour": TruncHour, "day": TruncDay}
+
+
+def deduplicate(apps, schema_editor):
+    # Rows repeating the natural key of an earlier one, stored before ingest
+    # skipped them, are removed so the constraints can be added. The first
+    # stored row is kept and the rollups of the affected dataloggers are
+    # rebuilt from what is left.
+    db = schema_editor.connection.alias
+    narrow = _deduplicate_narrow(apps, db)
+    wide = _deduplicate_wide(apps, db)
+    affected = wide if settings.MEASUREMENTS_STORAGE == "wide" else narrow
+    for datalogger_id in affected:
+        _rebuild_rollups(apps, db, datalogger_id)
+
+    # Cached reads and validators of the dataloggers changed
+    changed = narrow | wide
+    if changed:
+        Datalogger = apps.get_model("measurements", "Datalogger")
+        Datalogger.objects.using(DEFAULT_DB_ALIAS).filter(id__in=changed).update(
+            version=F("version") + 1, modified_at=timezone.now()
+        )
+
+
+def _duplicate_keys(model, db, fields):
+    return (
+        model.objects.using(db)
+        .values_list(*fields)
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+        .order_by()
+    )
+
+
+def _deduplicate_narrow(apps, db):
+    # Returns the ids of the dataloggers rows were deleted from
+    Measurement = apps.get_model("measurements", "Measurement")
+    affected = set()
+    duplicates = []
+    for datalogger_id, recorded_at, label, _ in _duplicate_keys(
+        Measurement, db, ["datalogger_id", "recorded_at", "label"]
+    ):
+        ids = list(
+            Measurement.objects.using(db)
+            .filter(datalogger_id=datalogger_id, recorded_at=recorded_at, label=label)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        duplicates.extend(ids[1:])
+        affected.add(datalogger_id)
+    for start in range(0, len(duplicates), BATCH_SIZE):
+        batch = duplicates[start : start + BATCH_SIZE]
+        Measurement.objects.using(db).filter(id__in=batch).delete()
+    return affected
+
+
+def _deduplicate_wide(apps, db):
+    # Labels missing from the first row of a time are taken from the later
+    # ones, in the order they were stored, before those are deleted
+    MeasurementRecord = apps.get_model("measurements", "MeasurementRecord")
+    affected = set()
+    updated = []
+    duplicates = []
+    for datalogger_id, recorded_at, _ in _duplicate_keys(
+        MeasurementRecord, db, ["datalogger_id", "recorded_at"]
+    ):
+        first, *rest = (
+            MeasurementRecord.objects.using(db)
+            .filter(datalogger_id=datalogger_id, recorded_at=recorded_at)
+            .order_by("id")
+        )
+        for record in rest:
+            for label in LABELS:
+                if getattr(first, label) is None:
+                    setattr(first, label, getattr(record, label))
+            duplicates.append(record.id)
+        updated.append(first)
+        affected.add(datalogger_id)
+    MeasurementRecord.objects.using(db).bulk_update(
+        updated, LABELS, batch_size=BATCH_SIZE
+    )
+    for start in range(0, len(duplicates), BATCH_SIZE):
+        batch = duplicates[start : start + BATCH_SIZE]
+        MeasurementRecord.objects.using(db).filter(id__in=batch).delete()
+    return affected
+
+
+def _rebuild_rollups(apps, db, datalogger_id):
+    # Same groups as the rollup_groups of the storage layouts
+    MeasurementRollup = apps.get_model("measurements", "MeasurementRollup")
+    MeasurementRollup.objects.using(db).filter(datalogger_id=datalogger_id).delete()
+    rollups = []
+    for span, trunc in SPAN_TRUNCS.items():
+        if settings.MEASUREMENTS_STORAGE == "wide":
+            groups = _wide_groups(apps, db, datalogger_id, trunc)
+        else:
+            groups = _narrow_groups(apps, db, datalogger_id, trunc)
+        rollups.extend(
+            MeasurementRollup(datalogger_id=datalogger_id, span=span, **group)
+            for group in groups
+        )
+    MeasurementRollup.objects.using(db).bulk_create(rollups, batch_size=BATCH_SIZE)
+
+
+def _narrow_groups(apps, db, datalogger_id, trunc):
+    Measurement = apps.get_model("measurements", "Measurement")
+    return (
+        Measurement.objects.using(db)
+        .filter(datalogger_id=datalogger_id)
+        .annotate(bucket=trunc("recorded_at"))
+        .values("bucket", "label")
+        .annotate(
+            count=Count("id"),
+            total=Sum("value"),
+            minimum=Min("value"),
+            maximum=Max("value"),
+        )
+        .order_by()
+    )
+
+
+def _wide_groups(apps, db, datalogger_id, trunc):
+    MeasurementRecord = apps.get_model("measurements", "MeasurementRecord")
+    aggregates = {}
+    for label in LABELS:
+        aggregates[f"{label}_count"] = Count(label)
+        aggregates[f"{label}_total"] = Sum(label)
+        aggregates[f"{label}_minimum"] = Min(label)
+        aggregates[f"{label}_maximum"] = Max(label)
+    groups = (
+        MeasurementRecord.objects.using(db)
+        .filter(datalogger_id=datalogger_id)
+        .annotate(bucket=trunc("recorded_at"))
+        .values("bucket")
+        .annotate(**aggregates)
+        .order_by()
+    )
+    for group in groups:
+        for label in LABELS:
+            if group[f"{label}_count"]:
+                yield {
+                    "bucket": group["bucket"],
+                    "label": label,
+                    "count": group[f"{label}_count"],
+                    "total": group[f"{label}_total"],
+                    "minimum": group[f"{label}_minimum"],
+                    "maximum": group[f"{label}_maximum"],
+                }
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("measurements", "0005_datalogger_version"),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="measurement",
+            constraint=models.UniqueConstraint(
+                fields=("datalogger", "recorded_at", "label"),
+                name="unique_measurement",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="measurementrecord",
+            constraint=models.UniqueConstraint(
+                fields=("datalogger", "recorded_at"), name="unique_measurement_record"
+            ),
+        ),
+        migrations.RemoveIndex(
+            model_name="measurement",
+            name="measurement_datalog_2c7d09_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="measurementrecord",
+            name="measurement_datalog_c2496f_idx",
+        ),
+    ]
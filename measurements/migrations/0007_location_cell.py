@@ -0,0 +1,107 @@
+# Generated by Django 5.1.6 on 2026-10-17 18:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+import math
+
+BATCH_SIZE = 500
+
+
+def cell(lat, lng):
+    # regions.cell with the 0.1 degree grid of this migration
+    row = min(math.floor((lat + 90) / 0.1), 1799)
+    column = math.floor((lng + 180) / 0.1) % 3600
+    return row * 3600 + column
+
+
+def fill(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Location = apps.get_model("measurements", "Location")
+    DataloggerLocation = apps.get_model("measurements", "DataloggerLocation")
+    locations = Location.objects.using(db)
+
+    batch = []
+    for location in locations.only("id", "lat", "lng").iterator():
+        location.cell = cell(location.lat, location.lng)
+        batch.append(location)
+        if len(batch) >= BATCH_SIZE:
+            Location.objects.using(db).bulk_update(batch, ["cell"])
+            batch = []
+    Location.objects.using(db).bulk_update(batch, ["cell"])
+
+    pairs = set()
+    for model_name in ["Measurement", "MeasurementRecord"]:
+        model = apps.get_model("measurements", model_name)
+        pairs |= set(
+            model.objects.using(db)
+            .order_by()
+            .values_list("datalogger_id", "location_id")
+            .distinct()
+        )
+    DataloggerLocation.objects.using(db).bulk_create(
+        [
+            DataloggerLocation(datalogger_id=datalogger_id, location_id=location_id)
+            for datalogger_id, location_id in pairs
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("measurements", "0006_measurement_natural_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="location",
+            name="cell",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name="DataloggerLocation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "datalogger",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="datalogger_locations",
+                        to="measurements.datalogger",
+                    ),
+                ),
+                (
+                    "location",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="datalogger_locations",
+                        to="measurements.location",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("location", "datalogger"),
+                        name="unique_datalogger_location",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(fill, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="location",
+            name="cell",
+            field=models.PositiveIntegerField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,121 @@
+# Generated by Django 5.1.6 on 2026-10-17 21:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max
+
+BATCH_SIZE = 500
+LABELS = ["temp", "rain", "hum"]
+
+
+def fill(apps, schema_editor):
+    # Most recent reading of each label of each datalogger, from both
+    # layouts: the maximum time per group, then its value from the unique
+    # index of the rows
+    db = schema_editor.connection.alias
+    Measurement = apps.get_model("measurements", "Measurement")
+    MeasurementRecord = apps.get_model("measurements", "MeasurementRecord")
+    LatestReading = apps.get_model("measurements", "LatestReading")
+
+    latest = {}
+    groups = (
+        Measurement.objects.using(db)
+        .order_by()
+        .values_list("datalogger_id", "label")
+        .annotate(last=Max("recorded_at"))
+    )
+    for datalogger_id, label, recorded_at in groups:
+        value = (
+            Measurement.objects.using(db)
+            .filter(datalogger_id=datalogger_id, recorded_at=recorded_at, label=label)
+            .values_list("value", flat=True)
+            .first()
+        )
+        latest[(datalogger_id, label)] = (recorded_at, value)
+
+    for label in LABELS:
+        groups = (
+            MeasurementRecord.objects.using(db)
+            .filter(**{f"{label}__isnull": False})
+            .order_by()
+            .values_list("datalogger_id")
+            .annotate(last=Max("recorded_at"))
+        )
+        for datalogger_id, recorded_at in groups:
+            found = latest.get((datalogger_id, label))
+            if found is not None and found[0] >= recorded_at:
+                continue
+            value = (
+                MeasurementRecord.objects.using(db)
+                .filter(datalogger_id=datalogger_id, recorded_at=recorded_at)
+                .values_list(label, flat=True)
+                .first()
+            )
+            latest[(datalogger_id, label)] = (recorded_at, value)
+
+    LatestReading.objects.using(db).bulk_create(
+        [
+            LatestReading(
+                datalogger_id=datalogger_id,
+                label=label,
+                recorded_at=recorded_at,
+                value=value,
+            )
+            for (datalogger_id, label), (recorded_at, value) in latest.items()
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("measurements", "0007_location_cell"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LatestReading",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "label",
+                    models.CharField(
+                        choices=[
+                            ("temp", "Temperature"),
+                            ("rain", "Rainfall"),
+                            ("hum", "Humidity"),
+                        ],
+                        max_length=4,
+                    ),
+                ),
+                ("recorded_at", models.DateTimeField()),
+                ("value", models.FloatField()),
+                (
+                    "datalogger",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="latest_readings",
+                        to="measurements.datalogger",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("datalogger", "label"), name="unique_latest_reading"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(fill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-17 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("measurements", "0008_latestreading"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="datalogger",
+            name="compacted_before",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
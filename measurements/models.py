@@ -2,6 +2,66 @@ from django.db import models
 import uuid
 
 
+class Datalogger(models.Model):
+    uuid = models.UUIDField(unique=True)
+    # Bumped whenever readings of the datalogger change, validators of the
+    # conditional GET responses of the read endpoints
+    version = models.PositiveBigIntegerField(default=0)
+    modified_at = models.DateTimeField(null=True)
+    # Raw readings recorded before this time were removed by the compact
+    # command, only the rollups cover them
+    compacted_before = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return str(self.uuid)
+
+
+class Location(models.Model):
+    lat = models.FloatField()
+    lng = models.FloatField()
+    # Cell of the regions.CELL_DEGREES grid holding the location
+    cell = models.PositiveIntegerField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["lat", "lng"], name="unique_location"),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Bulk creations set the cell themselves
+        from .regions import cell
+
+        self.cell = cell(self.lat, self.lng)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.lat}, {self.lng}"
+
+
+class DataloggerLocation(models.Model):
+    # Locations each datalogger reported readings from, region queries find
+    # dataloggers through it rather than through their readings
+    datalogger = models.ForeignKey(
+        Datalogger, on_delete=models.CASCADE, related_name="datalogger_locations"
+    )
+    location = models.ForeignKey(
+        Location,
+        on_delete=models.CASCADE,
+        related_name="datalogger_locations",
+        db_index=False,
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["location", "datalogger"], name="unique_datalogger_location"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.datalogger} at {self.location}"
+
+
 class Measurement(models.Model):
     LABEL_CHOICES = [
         ("temp", "Temperature"),
@@ -12,15 +72,109 @@ class Measurement(models.Model):
     label = models.CharField(max_length=4, choices=LABEL_CHOICES)
     value = models.FloatField()
     recorded_at = models.DateTimeField()
-    datalogger = models.UUIDField()
-    location = models.JSONField()
+    # Both are covered by the composite indexes below or only needed when
+    # deleting a datalogger or location, no single-column index
+    datalogger = models.ForeignKey(
+        Datalogger,
+        on_delete=models.CASCADE,
+        related_name="measurements",
+        db_index=False,
+    )
+    location = models.ForeignKey(
+        Location, on_delete=models.PROTECT, related_name="measurements", db_index=False
+    )
 
     class Meta:
+        # A datalogger sends a single reading per label and time, retried
+        # ingests are skipped. The constraint index also serves the
+        # (datalogger, recorded_at) lookups.
+        constraints = [
+            models.UniqueConstraint(
+                fields=["datalogger", "recorded_at", "label"],
+                name="unique_measurement",
+            ),
+        ]
         indexes = [
-            models.Index(fields=["datalogger", "recorded_at"]),
             models.Index(fields=["label", "recorded_at"]),
             models.Index(fields=["recorded_at"]),
         ]
 
     def __str__(self):
         return f"{self.label}: {self.value} recorded at {self.recorded_at}"
+
+
+class LatestReading(models.Model):
+    # Current state: the most recent reading of each label of a datalogger,
+    # kept by ingest so reading it is a lookup of the unique index
+    datalogger = models.ForeignKey(
+        Datalogger,
+        on_delete=models.CASCADE,
+        related_name="latest_readings",
+        db_index=False,
+    )
+    label = models.CharField(max_length=4, choices=Measurement.LABEL_CHOICES)
+    recorded_at = models.DateTimeField()
+    value = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["datalogger", "label"], name="unique_latest_reading"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Latest {self.label} of {self.datalogger}: {self.value}"
+
+
+class MeasurementRecord(models.Model):
+    # Wide layout: one row per ingested record with a column per label
+    recorded_at = models.DateTimeField()
+    datalogger = models.ForeignKey(
+        Datalogger, on_delete=models.CASCADE, related_name="records", db_index=False
+    )
+    location = models.ForeignKey(
+        Location, on_delete=models.PROTECT, related_name="records", db_index=False
+    )
+    temp = models.FloatField(null=True)
+    rain = models.FloatField(null=True)
+    hum = models.FloatField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["datalogger", "recorded_at"], name="unique_measurement_record"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.datalogger} record at {self.recorded_at}"
+
+
+class MeasurementRollup(models.Model):
+    SPAN_CHOICES = [
+        ("hour", "Hour"),
+        ("day", "Day"),
+    ]
+
+    span = models.CharField(max_length=4, choices=SPAN_CHOICES)
+    bucket = models.DateTimeField()
+    datalogger = models.ForeignKey(
+        Datalogger, on_delete=models.CASCADE, related_name="rollups", db_index=False
+    )
+    label = models.CharField(max_length=4, choices=Measurement.LABEL_CHOICES)
+    count = models.PositiveIntegerField()
+    total = models.FloatField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["datalogger", "span", "bucket", "label"],
+                name="unique_rollup_bucket",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.label} {self.span} rollup of {self.datalogger} at {self.bucket}"
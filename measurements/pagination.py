@@ -0,0 +1,83 @@
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.utils import json
+from itertools import islice
+import base64
+import binascii
+
+
+class PaginationError(Exception):
+    pass
+
+
+def encode_cursor(recorded_at, tiebreaker):
+    payload = json.dumps([recorded_at.isoformat(), tiebreaker]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor, tiebreaker_type):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        recorded_at, tiebreaker = json.loads(payload)
+        recorded_at = parse_datetime(recorded_at)
+    except (binascii.Error, ValueError, TypeError):
+        raise PaginationError("Invalid cursor parameter")
+
+    # Cursors carry an offset, a naive time cannot be compared with the
+    # stored ones
+    if (
+        recorded_at is None
+        or timezone.is_naive(recorded_at)
+        or not isinstance(tiebreaker, tiebreaker_type)
+    ):
+        raise PaginationError("Invalid cursor parameter")
+
+    return recorded_at, tiebreaker
+
+
+def get_page_params(request):
+    # Pagination is opt-in: without limit nor cursor the full window is returned
+    limit = request.query_params.get("limit")
+    cursor = request.query_params.get("cursor")
+    if limit is None and cursor is None:
+        return None
+
+    if limit is None:
+        limit = settings.MEASUREMENTS_PAGE_SIZE
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise PaginationError("Invalid limit parameter")
+        if limit < 1:
+            raise PaginationError("Invalid limit parameter")
+
+    return min(limit, settings.MEASUREMENTS_MAX_PAGE_SIZE), cursor
+
+
+def paginate_measurements(fetch, limit, cursor):
+    # Keyset on (recorded_at, id): the (datalogger, recorded_at) index gives
+    # rows in this order, so every page is a range scan starting at the cursor.
+    # fetch(after, limit) returns at most limit rows strictly after the keyset.
+    after = decode_cursor(cursor, int) if cursor else None
+    rows = fetch(after, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["recorded_at"], rows[-1]["id"])
+
+    return rows, next_cursor
+
+
+def paginate_aggregates(aggregate, limit, cursor):
+    # aggregate(after) yields items ordered by (time_slot, label) that come
+    # strictly after the given keyset, only the first limit + 1 are consumed
+    after = decode_cursor(cursor, str) if cursor else None
+    rows = list(islice(aggregate(after), limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["time_slot"], rows[-1]["label"])
+
+    return rows, next_cursor
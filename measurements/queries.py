@@ -0,0 +1,309 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.http import HttpRequest, QueryDict
+from django.urls import reverse
+from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlencode
+import datetime
+import threading
+import uuid
+
+from . import keys, replicas, retention, views
+from .raw import raw_window
+from .serializers import DataRecordResponseSerializer
+from .summary import aggregate_fleet, parse_span, parse_stats
+
+_lock = threading.Lock()
+_executor = None
+
+# Parameters of the specs answered by a merged query, a spec with any other
+# one, pagination or max_points for instance, goes through its view
+RAW_PARAMS = {"datalogger", "since", "before"}
+SUMMARY_PARAMS = {"datalogger", "since", "before", "span", "stats"}
+
+# Request metadata kept by the requests of the specs run through their view,
+# the rest describes the batch request
+FORWARDED_META = {
+    "HTTP_HOST",
+    "REMOTE_ADDR",
+    "SCRIPT_NAME",
+    "SERVER_NAME",
+    "SERVER_PORT",
+    "wsgi.url_scheme",
+}
+
+# Bounds of unbounded windows when grouping them
+EARLIEST = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+LATEST = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+
+
+def _views():
+    # Endpoints a spec can query, by path
+    return {
+        reverse("fetch_data_raw"): views.fetch_data_raw,
+        reverse("fetch_data_aggregates"): views.fetch_data_aggregates,
+    }
+
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.MEASUREMENTS_QUERY_WORKERS,
+                thread_name_prefix="queries",
+            )
+        return _executor
+
+
+def _ok(body):
+    return {"status": 200, "body": body}
+
+
+def _error(message):
+    return {"status": 400, "body": {"error": message}}
+
+
+def _string(value):
+    # Query string form of a JSON parameter value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def _parse(spec, paths, now):
+    # Path and parameters of a spec, parameters as lists of strings like
+    # request.GET. Specs without before share the time of the batch.
+    if not isinstance(spec, dict):
+        raise ValueError("Expected an object with path and params")
+    path = spec.get("path")
+    if path not in paths:
+        raise ValueError(f"Invalid path, expected one of {', '.join(paths)}")
+    params = spec.get("params", {})
+    if not isinstance(params, dict):
+        raise ValueError("Invalid params, expected an object")
+
+    parsed = {}
+    for name, value in params.items():
+        values = value if isinstance(value, list) else [value]
+        if not all(isinstance(item, (str, int, float, bool)) for item in values):
+            raise ValueError(f"Invalid {name} parameter")
+        parsed[name] = [_string(item) for item in values]
+    if parsed.get("format", ["json"]) != ["json"]:
+        raise ValueError("Only JSON results are available in a batch")
+    parsed.setdefault("before", [now.isoformat()])
+    return path, parsed
+
+
+def _merge_key(view, params):
+    # ("raw", datalogger, since, before, summary) for the readings of a
+    # datalogger, summary when asked to /api/summary which refuses compacted
+    # periods, ("summary", (span, since, before, stats), datalogger) for
+    # aggregates, None when the spec goes through its view. Invalid specs go
+    # through their view as well, which reports the error.
+    allowed = RAW_PARAMS if view is views.fetch_data_raw else SUMMARY_PARAMS
+    if not set(params) <= allowed or any(len(values) > 1 for values in params.values()):
+        return None
+    param = {name: values[0] for name, values in params.items()}
+    try:
+        datalogger = uuid.UUID(param["datalogger"])
+        since = views._parse_datetime(param.get("since"))
+        before = views._parse_datetime(param["before"])
+        span = param.get("span")
+        if span is not None:
+            parse_span(span)
+        stats = param.get("stats")
+        if stats is not None:
+            stats = tuple(parse_stats(stats))
+    except (KeyError, ValueError, ValidationError):
+        return None
+
+    if span is None:
+        if stats is not None:
+            return None
+        # Summaries without span are the readings
+        return ("raw", datalogger, since, before, view is views.fetch_data_aggregates)
+    return ("summary", (span, since, before, stats), datalogger)
+
+
+def _clusters(windows):
+    # (index, since, before) windows of a datalogger grouped when they
+    # overlap, each group is read once over the union of its windows
+    windows = sorted(
+        (since or EARLIEST, before or LATEST, index) for index, since, before in windows
+    )
+    clusters = []
+    for since, before, index in windows:
+        if clusters and since < clusters[-1][1]:
+            clusters[-1][1] = max(clusters[-1][1], before)
+            clusters[-1][2].append((index, since, before))
+        else:
+            clusters.append([since, before, [(index, since, before)]])
+    return clusters
+
+
+def _read_raw(datalogger, since, before, windows, summaries):
+    # Readings of overlapping windows of a datalogger from a single read,
+    # the windows of summaries reaching before a compaction are refused
+    datalogger_id = keys.datalogger_id(datalogger)
+    with replicas.serving([] if datalogger_id is None else [datalogger_id]):
+        horizon = None
+        if any(index in summaries for index, _, _ in windows):
+            horizon = retention.compacted_before([datalogger_id], [since])
+        rows = list(
+            raw_window(
+                datalogger_id,
+                None if since == EARLIEST else since,
+                None if before == LATEST else before,
+            )
+        )
+    results = []
+    for index, lower, upper in windows:
+        if index in summaries and horizon is not None and lower < horizon:
+            results.append((index, _error(str(retention.Compacted(horizon)))))
+            continue
+        selected = [row for row in rows if lower < row["recorded_at"] < upper]
+        results.append(
+            (index, _ok(DataRecordResponseSerializer(selected, many=True).data))
+        )
+    return results
+
+
+def _read_summaries(span, since, before, stats, members):
+    # Aggregates of the (index, datalogger) specs sharing a span and a
+    # window, read for all their dataloggers at once
+    datalogger_ids = {
+        datalogger: keys.datalogger_id(datalogger) for _, datalogger in members
+    }
+    known = [
+        datalogger_id
+        for datalogger_id in dict.fromkeys(datalogger_ids.values())
+        if datalogger_id is not None
+    ]
+    results = {}
+    if known:
+        with replicas.serving(known):
+            try:
+                results = aggregate_fleet(
+                    known, span, since, before, None if stats is None else list(stats)
+                )
+            except retention.Compacted as exc:
+                return [(index, _error(str(exc))) for index, _ in members]
+    serializer_class = views._aggregate_serializer(stats)
+    return [
+        (
+            index,
+            _ok(
+                serializer_class(
+                    results.get(datalogger_ids[datalogger], []), many=True
+                ).data
+            ),
+        )
+        for index, datalogger in members
+    ]
+
+
+def _subrequest(request, path, params):
+    # GET request of a spec, answered in JSON
+    query = urlencode(
+        [(name, value) for name, values in params.items() for value in values]
+    )
+    subrequest = HttpRequest()
+    subrequest.method = "GET"
+    subrequest.path = subrequest.path_info = path
+    subrequest.GET = QueryDict(query)
+    subrequest.META = {
+        name: value for name, value in request.META.items() if name in FORWARDED_META
+    }
+    subrequest.META.update(
+        REQUEST_METHOD="GET",
+        PATH_INFO=path,
+        QUERY_STRING=query,
+        HTTP_ACCEPT="application/json",
+    )
+    return subrequest
+
+
+def _read_view(request, view, path, params, index):
+    # A spec answered by its view, from replicas like a GET request would be
+    subrequest = _subrequest(request, path, params)
+    with replicas.serving(replicas.requested(subrequest)):
+        response = view(subrequest)
+    return [(index, {"status": response.status_code, "body": response.data})]
+
+
+def _call(task):
+    # Pool threads open their own connections, closed like those of a request
+    try:
+        return task()
+    finally:
+        connections.close_all()
+
+
+def _execute(tasks):
+    # Tasks run concurrently on the pool, one after the other inside a
+    # transaction: the other threads could not see its writes
+    if len(tasks) <= 1 or any(
+        connection.in_atomic_block
+        for connection in connections.all(initialized_only=True)
+    ):
+        return [task() for task in tasks]
+    futures = [_pool().submit(_call, task) for task in tasks]
+    return [future.result() for future in futures]
+
+
+def run(request, specs):
+    # Result of each spec in order, as {"status", "body"} of the response of
+    # its endpoint. Readings of a datalogger over overlapping windows are
+    # read once, aggregates sharing a span and a window are grouped in one
+    # fleet query, the other specs run through their view. Each read runs
+    # concurrently with the others.
+    paths = _views()
+    now = timezone.now()
+    results = [None] * len(specs)
+    raw = {}
+    raw_summaries = set()
+    summaries = {}
+    tasks = []
+    for index, spec in enumerate(specs):
+        try:
+            path, params = _parse(spec, paths, now)
+        except ValueError as exc:
+            results[index] = _error(str(exc))
+            continue
+        key = _merge_key(paths[path], params)
+        if key is None:
+            tasks.append(partial(_read_view, request, paths[path], path, params, index))
+        elif key[0] == "raw":
+            raw.setdefault(key[1], []).append((index, key[2], key[3]))
+            if key[4]:
+                raw_summaries.add(index)
+        else:
+            summaries.setdefault(key[1], []).append((index, key[2]))
+
+    for datalogger, windows in raw.items():
+        for since, before, cluster in _clusters(windows):
+            tasks.append(
+                partial(_read_raw, datalogger, since, before, cluster, raw_summaries)
+            )
+    size = settings.MEASUREMENTS_SUMMARY_MAX_DATALOGGERS
+    for (span, since, before, stats), members in summaries.items():
+        for start in range(0, len(members), size):
+            tasks.append(
+                partial(
+                    _read_summaries,
+                    span,
+                    since,
+                    before,
+                    stats,
+                    members[start : start + size],
+                )
+            )
+
+    for done in _execute(tasks):
+        for index, result in done:
+            results[index] = result
+    return results
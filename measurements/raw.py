@@ -0,0 +1,41 @@
+import datetime
+
+from . import caching
+from .storage import get_storage
+
+
+def raw_window(datalogger_id, since=None, before=None):
+    # Yields the measurements of the (since, before) window ordered by
+    # (recorded_at, id), hour blocks fully inside the window are cached
+    if datalogger_id is None:
+        return
+
+    storage = get_storage()
+
+    if since is None:
+        start = storage.first_recorded_at(datalogger_id)
+    else:
+        start = caching.block_floor(since, "data") + caching.BLOCK_WIDTHS["data"]
+        if before is not None and start >= before:
+            yield from storage.rows(datalogger_id, since, before)
+            return
+        yield from storage.rows(datalogger_id, since, start)
+
+    if before is None:
+        end = storage.last_recorded_at(datalogger_id)
+        if end is not None:
+            end += datetime.timedelta(microseconds=1)
+    else:
+        end = before
+
+    if start is None or end is None:
+        return
+
+    yield from caching.cached_range(
+        datalogger_id,
+        "data",
+        start,
+        end,
+        lambda lo, hi: storage.rows(datalogger_id, lo, hi, lower_inclusive=True),
+        "recorded_at",
+    )
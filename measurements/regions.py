@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db.models import Q
+import math
+
+from .models import Datalogger, Location
+
+# Side in degrees of the cells of the location grid. Cells are stored with
+# each location: changing it requires recomputing Location.cell.
+CELL_DEGREES = 0.1
+ROWS = round(180 / CELL_DEGREES)
+COLUMNS = round(360 / CELL_DEGREES)
+
+
+def cell(lat, lng):
+    # Cells are numbered row by row from (-90, -180), west to east
+    row = min(math.floor((lat + 90) / CELL_DEGREES), ROWS - 1)
+    column = math.floor((lng + 180) / CELL_DEGREES) % COLUMNS
+    return row * COLUMNS + column
+
+
+def parse_bbox(value):
+    # min_lng,min_lat,max_lng,max_lat like GeoJSON, a box crossing the
+    # antimeridian has min_lng > max_lng
+    try:
+        min_lng, min_lat, max_lng, max_lat = [float(part) for part in value.split(",")]
+    except ValueError:
+        raise ValueError("Expected min_lng,min_lat,max_lng,max_lat")
+    if not all(math.isfinite(part) for part in [min_lng, min_lat, max_lng, max_lat]):
+        raise ValueError("Bounds must be finite")
+    if not -90 <= min_lat <= max_lat <= 90:
+        raise ValueError("Latitudes must be ordered between -90 and 90")
+    if not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180):
+        raise ValueError("Longitudes must be between -180 and 180")
+    return min_lng, min_lat, max_lng, max_lat
+
+
+def parse_cells(value):
+    try:
+        cells = {int(part) for part in value.split(",") if part}
+    except ValueError:
+        raise ValueError("Expected comma separated cell numbers")
+    if not cells or not all(0 <= cell < ROWS * COLUMNS for cell in cells):
+        raise ValueError(f"Cells must be between 0 and {ROWS * COLUMNS - 1}")
+    if len(cells) > settings.MEASUREMENTS_REGION_MAX_CELLS:
+        raise ValueError(
+            f"Too many cells, maximum is {settings.MEASUREMENTS_REGION_MAX_CELLS}"
+        )
+    return cells
+
+
+def locations(bbox=None, cells=None):
+    # Locations inside the box, served by the (lat, lng) index, or inside
+    # the cells, served by the cell index
+    if cells is not None:
+        return Location.objects.filter(cell__in=cells)
+    min_lng, min_lat, max_lng, max_lat = bbox
+    queryset = Location.objects.filter(lat__gte=min_lat, lat__lte=max_lat)
+    if min_lng <= max_lng:
+        return queryset.filter(lng__gte=min_lng, lng__lte=max_lng)
+    return queryset.filter(Q(lng__gte=min_lng) | Q(lng__lte=max_lng))
+
+
+def datalogger_uuids(bbox=None, cells=None):
+    # Maps the id of each datalogger that reported readings from inside the
+    # region to its uuid, in a single query
+    return dict(
+        Datalogger.objects.filter(
+            datalogger_locations__location__in=locations(bbox, cells)
+        )
+        .distinct()
+        .values_list("id", "uuid")
+    )
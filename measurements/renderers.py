@@ -0,0 +1,58 @@
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils import json
+import csv
+import io
+
+from . import columnar
+
+
+class NDJSONRenderer(BaseRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only used for small bodies such as errors, large results are streamed
+        if data is None:
+            return b""
+        if not isinstance(data, list):
+            data = [data]
+        return "".join(json.dumps(item) + "\n" for item in data).encode()
+
+
+class CSVRenderer(BaseRenderer):
+    media_type = "text/csv"
+    format = "csv"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only used for small bodies such as errors, large results are streamed
+        if data is None:
+            return b""
+        if not isinstance(data, list):
+            data = [data]
+        if not data:
+            return b""
+
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=list(data[0].keys()))
+        writer.writeheader()
+        writer.writerows(data)
+        return buffer.getvalue().encode()
+
+
+class ColumnarRenderer(BaseRenderer):
+    media_type = "application/x-measurements-columnar"
+    format = "columnar"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # data is an iterable of (label, recorded_at, value) rows, errors are
+        # dicts and sent as JSON since they have no columnar representation
+        if data is None:
+            return b""
+        if isinstance(data, dict):
+            response = (renderer_context or {}).get("response")
+            if response is not None:
+                response["Content-Type"] = "application/json"
+            return json.dumps(data).encode()
+        return columnar.encode(data)
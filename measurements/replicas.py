@@ -0,0 +1,216 @@
+from asgiref.local import Local
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.urls import Resolver404, resolve
+from contextlib import contextmanager
+import random
+import uuid
+
+from . import caching, keys
+
+# Replicas chosen for the current request. Context local rather than thread
+# local so that sync views run under ASGI see the choice of their request.
+_local = Local()
+
+# Key marking all dataloggers as written, see written()
+ALL = "*"
+
+
+def replicas(alias):
+    # Read-only copies of a database, none when it has no replica
+    return settings.MEASUREMENTS_REPLICAS.get(alias, [])
+
+
+def aliases():
+    return [
+        replica
+        for copies in settings.MEASUREMENTS_REPLICAS.values()
+        for replica in copies
+    ]
+
+
+@contextmanager
+def reading(chosen=None):
+    # Reads inside the block go to replicas, one picked at random per
+    # database and kept for the whole block so a request reads a single copy
+    # of each. Yields the choices, given back to continue reading the same
+    # copies later.
+    previous = getattr(_local, "chosen", None)
+    _local.chosen = {} if chosen is None else chosen
+    try:
+        yield _local.chosen
+    finally:
+        _local.chosen = previous
+
+
+def for_read(alias):
+    # Alias reads from a database go to, inside reading() one of its replicas
+    chosen = getattr(_local, "chosen", None)
+    if chosen is None:
+        return alias
+    if alias not in chosen:
+        copies = replicas(alias)
+        chosen[alias] = random.choice(copies) if copies else alias
+    return chosen[alias]
+
+
+def _written_key(datalogger_id):
+    return f"measurements:written:{datalogger_id}"
+
+
+def written(datalogger_ids=None):
+    # Reads of the dataloggers, of all of them when None, stay on the primary
+    # databases for MEASUREMENTS_READ_YOUR_WRITES_SECONDS, the time replicas
+    # are expected to catch up in. Marks live in the measurements cache,
+    # shared for writes of a process to be seen by the others (checked by
+    # ReplicaMiddleware).
+    window = settings.MEASUREMENTS_READ_YOUR_WRITES_SECONDS
+    if not settings.MEASUREMENTS_REPLICAS or window <= 0:
+        return
+    if datalogger_ids is None:
+        datalogger_ids = [ALL]
+    caching.get_cache().set_many(
+        {_written_key(datalogger_id): True for datalogger_id in datalogger_ids},
+        window,
+    )
+
+
+def recently_written(datalogger_ids):
+    if settings.MEASUREMENTS_READ_YOUR_WRITES_SECONDS <= 0:
+        return False
+    found = caching.get_cache().get_many(
+        [_written_key(datalogger_id) for datalogger_id in [ALL, *datalogger_ids]]
+    )
+    return bool(found)
+
+
+@contextmanager
+def serving(datalogger_ids):
+    # Reads inside the block go to replicas unless one of the dataloggers
+    # was written within the read-your-writes window. Yields the replicas
+    # chosen, None when reading the primaries.
+    if not settings.MEASUREMENTS_REPLICAS or recently_written(datalogger_ids):
+        yield None
+        return
+    with reading() as chosen:
+        yield chosen
+
+
+def requested(request):
+    # Ids of the existing dataloggers named by a read request. Fleet and
+    # region reads name none: they are served by replicas as soon as the
+    # rest of the fleet was not written as a whole.
+    datalogger_ids = []
+    for param in request.GET.getlist("datalogger"):
+        for value in param.split(","):
+            try:
+                datalogger_id = keys.datalogger_id(uuid.UUID(value))
+            except ValueError:
+                # Reported by the view
+                continue
+            if datalogger_id is not None:
+                datalogger_ids.append(datalogger_id)
+    return datalogger_ids
+
+
+def replicated(view):
+    # Marks a read view ReplicaMiddleware may serve from replicas
+    view.replicated = True
+    return view
+
+
+def _streamed(content, chosen):
+    # Streamed responses are read after the view returned, each chunk from
+    # the replicas of the request
+    iterator = iter(content)
+    while True:
+        with reading(chosen):
+            chunk = next(iterator, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+class ReplicaMiddleware:
+    # GET and HEAD requests to replicated views read from replicas for the
+    # whole request, conditional GET validators and rendering included,
+    # unless one of their dataloggers was written within the read-your-writes
+    # window.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        # Read-your-writes marks of a per-process cache are not seen by the
+        # other processes, which would read replicas right after a write
+        if (
+            settings.MEASUREMENTS_REPLICAS
+            and settings.MEASUREMENTS_READ_YOUR_WRITES_SECONDS > 0
+            and not caching.shared()
+        ):
+            raise ImproperlyConfigured(
+                "MEASUREMENTS_REPLICAS requires a measurements cache shared by "
+                "the processes of the server, such as POCW_CACHE_DIR"
+            )
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _routed(self, request):
+        if not settings.MEASUREMENTS_REPLICAS or request.method not in [
+            "GET",
+            "HEAD",
+        ]:
+            return False
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return False
+        return getattr(match.func, "replicated", False)
+
+    def _streaming(self, response, chosen):
+        if chosen is not None and response.streaming and not response.is_async:
+            response.streaming_content = _streamed(response.streaming_content, chosen)
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self._routed(request):
+            return self.get_response(request)
+        with serving(requested(request)) as chosen:
+            response = self.get_response(request)
+        return self._streaming(response, chosen)
+
+    async def __acall__(self, request):
+        if not self._routed(request):
+            return await self.get_response(request)
+        with serving(requested(request)) as chosen:
+            response = await self.get_response(request)
+        return self._streaming(response, chosen)
+
+
+class ReplicaRouter:
+    # Queries without using() read the replica of the default database
+    # chosen by reading(), sharded rows pick theirs through sharding.
+    # Replicas are copies made by sync(): never written nor migrated.
+    def db_for_read(self, model, **hints):
+        alias = for_read(DEFAULT_DB_ALIAS)
+        return None if alias == DEFAULT_DB_ALIAS else alias
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in aliases():
+            return False
+        return None
+
+
+def sync(alias, replica):
+    # Copies a SQLite database into one of its replicas with the online
+    # backup API, in a single step: the replica goes from one consistent
+    # snapshot of the primary to the next, its readers waiting meanwhile
+    source = connections[alias]
+    target = connections[replica]
+    source.ensure_connection()
+    target.ensure_connection()
+    source.connection.backup(target.connection)
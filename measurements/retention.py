@@ -0,0 +1,112 @@
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+
+from . import rollups, sharding
+from .conditional import touch
+from .models import Datalogger
+from .storage import get_storage
+
+
+class Compacted(Exception):
+    # A read needing raw readings removed by the compact command
+    def __init__(self, horizon):
+        super().__init__(
+            f"Raw readings before {horizon.isoformat()} were compacted, only "
+            "the hour and day spans reach before that time"
+        )
+        self.horizon = horizon
+
+
+def compacted_before(datalogger_ids=None, times=()):
+    # Latest time before which raw readings of the dataloggers were removed,
+    # of all of them when None, None when none was. Compaction only runs
+    # with a retention window and before its horizon: nothing is looked up
+    # without it or when all of times are past it.
+    bound = rollups.retention_horizon()
+    if bound is None or (times and all(time >= bound for time in times)):
+        return None
+    return max(rollups.compacted(datalogger_ids).values(), default=None)
+
+
+def check(datalogger_ids, since):
+    # Raises Compacted when raw readings after since may have been removed
+    found = compacted_before(datalogger_ids, () if since is None else [since])
+    if found is not None and (since is None or since < found):
+        raise Compacted(found)
+
+
+def compact(horizon, chunk_size):
+    # Rolls up the raw readings recorded before horizon, then deletes them.
+    # Each datalogger is marked as compacted before its rows are deleted so
+    # reads stop needing them. Returns the number of rollups created and of
+    # raw rows deleted.
+    storage = get_storage()
+    shards = sharding.fan_out(
+        lambda alias, _: storage.fleet_window(alias, upper=horizon)
+        .order_by()
+        .values_list("datalogger_id", flat=True)
+        .distinct()
+    )
+    datalogger_ids = [datalogger_id for shard in shards for datalogger_id in shard]
+    created = deleted = 0
+    for datalogger_id in datalogger_ids:
+        with transaction.atomic(using=sharding.shard_for(datalogger_id)):
+            created += rollups.fill(datalogger_id, horizon)
+        Datalogger.objects.filter(
+            Q(compacted_before=None) | Q(compacted_before__lt=horizon),
+            id=datalogger_id,
+        ).update(compacted_before=horizon)
+        deleted += expire(storage, datalogger_id, horizon, chunk_size)
+        touch([datalogger_id])
+    return created, deleted
+
+
+def expire(storage, datalogger_id, horizon, chunk_size):
+    # One transaction per chunk of oldest rows, ingest only waits for the
+    # write lock the time of a single chunk
+    alias = sharding.shard_for(datalogger_id)
+    deleted = 0
+    while True:
+        with transaction.atomic(using=alias):
+            chunk = (
+                storage.window(datalogger_id, upper=horizon)
+                .order_by("recorded_at")
+                .values("id")[:chunk_size]
+            )
+            count = storage.model.objects.using(alias).filter(id__in=chunk).delete()[0]
+        if not count:
+            return deleted
+        deleted += count
+
+
+def auto_vacuum(using=DEFAULT_DB_ALIAS):
+    # "incremental", "full" or "none" on SQLite, None on other backends
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA auto_vacuum")
+        return ["none", "full", "incremental"][cursor.fetchone()[0]]
+
+
+def enable_incremental_vacuum(using=DEFAULT_DB_ALIAS):
+    # The mode of an existing SQLite database only changes with a full VACUUM,
+    # which rewrites the file and cannot run inside a transaction
+    with connections[using].cursor() as cursor:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+
+
+def vacuum(pages, using=DEFAULT_DB_ALIAS):
+    # Returns free pages to the filesystem pages at a time, each step only
+    # holding the write lock briefly. Returns the number of pages released.
+    released = 0
+    with connections[using].cursor() as cursor:
+        while True:
+            cursor.execute("PRAGMA freelist_count")
+            free = cursor.fetchone()[0]
+            if not free:
+                return released
+            cursor.execute(f"PRAGMA incremental_vacuum({min(free, pages)})")
+            cursor.fetchall()
+            released += min(free, pages)
@@ -0,0 +1,206 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+import datetime
+
+from . import sharding
+from .models import Datalogger, MeasurementRollup
+from .storage import get_storage
+
+SPAN_WIDTHS = {
+    "hour": datetime.timedelta(hours=1),
+    "day": datetime.timedelta(days=1),
+}
+
+SPAN_TRUNCS = {
+    "hour": TruncHour,
+    "day": TruncDay,
+}
+
+
+def truncate(value, span, tz=None):
+    # Python counterpart of TruncHour/TruncDay in the current timezone
+    value = timezone.localtime(value, tz).replace(minute=0, second=0, microsecond=0)
+    if span == "day":
+        value = value.replace(hour=0)
+    return value
+
+
+def retention_horizon():
+    # Raw readings recorded before this time are removed by the compact
+    # command, they only live on in the rollups. Aligned on a day so both
+    # spans split there.
+    days = settings.MEASUREMENTS_RAW_RETENTION_DAYS
+    if days is None:
+        return None
+    return truncate(timezone.now() - datetime.timedelta(days=days), "day")
+
+
+def compacted(datalogger_ids=None):
+    # {datalogger id: time before which its raw readings were removed} for
+    # the compacted dataloggers among datalogger_ids, all of them when None
+    queryset = Datalogger.objects.exclude(compacted_before=None)
+    if datalogger_ids is not None:
+        queryset = queryset.filter(id__in=datalogger_ids)
+    return dict(queryset.values_list("id", "compacted_before"))
+
+
+def record(measurements):
+    # Fold the new measurements into their buckets before touching the
+    # database, a batch of N records costs one SELECT plus bulk writes.
+    # Readings of a record share their buckets, they are computed once.
+    tz = timezone.get_current_timezone()
+    buckets = {}
+    groups = {}
+    for measurement in measurements:
+        recorded_at = measurement.recorded_at
+        spans = buckets.get(recorded_at)
+        if spans is None:
+            spans = buckets[recorded_at] = [
+                (span, truncate(recorded_at, span, tz)) for span in SPAN_WIDTHS
+            ]
+        for span, bucket in spans:
+            key = (measurement.datalogger_id, span, bucket, measurement.label)
+            value = measurement.value
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [1, value, value, value]
+            else:
+                group[0] += 1
+                group[1] += value
+                group[2] = min(group[2], value)
+                group[3] = max(group[3], value)
+
+    shards = {}
+    for key, group in groups.items():
+        shards.setdefault(sharding.shard_for(key[0]), {})[key] = group
+    for alias in sorted(shards, key=sharding.shards().index):
+        sharding.writing(alias)
+        merge(alias, shards[alias])
+
+
+def merge(alias, groups):
+    # Adds [count, total, minimum, maximum] groups keyed by (datalogger_id,
+    # span, bucket, label) to the rollups stored in a database.
+    # Callers run inside the ingest transaction: on SQLite it already holds
+    # the write lock, other backends lock the rows with select_for_update, so
+    # this read-modify-write cannot interleave with another ingest
+    buckets = [key[2] for key in groups]
+    existing = (
+        MeasurementRollup.objects.using(alias)
+        .select_for_update()
+        .filter(
+            datalogger_id__in={key[0] for key in groups},
+            bucket__gte=min(buckets),
+            bucket__lte=max(buckets),
+        )
+    )
+    existing = {
+        (rollup.datalogger_id, rollup.span, rollup.bucket, rollup.label): rollup
+        for rollup in existing
+    }
+
+    created = []
+    updated = []
+    for key, (count, total, minimum, maximum) in groups.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            datalogger, span, bucket, label = key
+            created.append(
+                MeasurementRollup(
+                    datalogger_id=datalogger,
+                    span=span,
+                    bucket=bucket,
+                    label=label,
+                    count=count,
+                    total=total,
+                    minimum=minimum,
+                    maximum=maximum,
+                )
+            )
+        else:
+            rollup.count += count
+            rollup.total += total
+            rollup.minimum = min(rollup.minimum, minimum)
+            rollup.maximum = max(rollup.maximum, maximum)
+            updated.append(rollup)
+
+    MeasurementRollup.objects.using(alias).bulk_create(
+        created, batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE
+    )
+    MeasurementRollup.objects.using(alias).bulk_update(
+        updated,
+        ["count", "total", "minimum", "maximum"],
+        batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE,
+    )
+
+
+def rebuild(datalogger_id=None, layout=None):
+    # Rollups from before the compaction of a datalogger are kept, its raw
+    # readings are gone there
+    storage = get_storage(layout)
+    horizons = compacted(None if datalogger_id is None else [datalogger_id])
+    if datalogger_id is None:
+        for alias in sharding.shards():
+            stale = MeasurementRollup.objects.using(alias).exclude(
+                datalogger_id__in=storage.datalogger_ids(alias)
+            )
+            for stale_id in stale.values_list("datalogger_id", flat=True).distinct():
+                _current(alias, stale_id, horizons.get(stale_id)).delete()
+        datalogger_ids = storage.datalogger_ids()
+    else:
+        datalogger_ids = [datalogger_id]
+
+    # One transaction per datalogger keeps the write lock short
+    count = 0
+    for datalogger_id in list(datalogger_ids):
+        alias = sharding.shard_for(datalogger_id)
+        lower = horizons.get(datalogger_id)
+        with transaction.atomic(using=alias):
+            _current(alias, datalogger_id, lower).delete()
+            count += _rebuild_datalogger(storage, datalogger_id, lower)
+
+    return count
+
+
+def _current(alias, datalogger_id, lower):
+    # Rollups of a datalogger from lower on, all of them when None
+    rollups = MeasurementRollup.objects.using(alias).filter(datalogger_id=datalogger_id)
+    if lower is not None:
+        rollups = rollups.filter(bucket__gte=lower)
+    return rollups
+
+
+def _rebuild_datalogger(storage, datalogger_id, lower=None):
+    rollups = [
+        MeasurementRollup(datalogger_id=datalogger_id, span=span, **group)
+        for span, trunc in SPAN_TRUNCS.items()
+        for group in storage.rollup_groups(datalogger_id, trunc, lower=lower)
+    ]
+    MeasurementRollup.objects.using(sharding.shard_for(datalogger_id)).bulk_create(
+        rollups, batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE
+    )
+    return len(rollups)
+
+
+def fill(datalogger_id, upper, layout=None):
+    # Creates the rollups missing for raw readings recorded before upper.
+    # Existing ones are kept as they are: they may already count readings
+    # removed by an earlier compaction.
+    storage = get_storage(layout)
+    existing = set(
+        MeasurementRollup.objects.using(sharding.shard_for(datalogger_id))
+        .filter(datalogger_id=datalogger_id, bucket__lt=upper)
+        .values_list("span", "bucket", "label")
+    )
+    rollups = [
+        MeasurementRollup(datalogger_id=datalogger_id, span=span, **group)
+        for span, trunc in SPAN_TRUNCS.items()
+        for group in storage.rollup_groups(datalogger_id, trunc, upper=upper)
+        if (span, group["bucket"], group["label"]) not in existing
+    ]
+    MeasurementRollup.objects.using(sharding.shard_for(datalogger_id)).bulk_create(
+        rollups, batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE
+    )
+    return len(rollups)
@@ -3,6 +3,21 @@ from rest_framework import serializers
 from .models import Measurement
 
 
+# Accepted values per label, with the name used in error messages
+MEASUREMENT_RANGES = {
+    "temp": ("Temperature", -20, 40),
+    "hum": ("Humidity", 20, 100),
+    "rain": ("Rainfall", 0, 2),
+}
+
+
+def range_error(label, value):
+    name, low, high = MEASUREMENT_RANGES[label]
+    if value < low or value > high:
+        return f"{name} must be between {low} and {high}, got {value}"
+    return None
+
+
 class LocationRequestSerializer(serializers.Serializer):
     lat = serializers.FloatField(validators=[MinValueValidator(0.0)])
     lng = serializers.FloatField(validators=[MinValueValidator(0.0)])
@@ -22,21 +37,9 @@ class DataRecordRequestSerializer(serializers.Serializer):
     def validate_measurements(self, measurements):
         # Validate measurement values based on label
         for measurement in measurements:
-            label = measurement["label"]
-            m_value = measurement["value"]
-
-            if label == "temp" and (m_value < -20 or m_value > 40):
-                raise serializers.ValidationError(
-                    f"Temperature must be between -20 and 40, got {m_value}"
-                )
-            elif label == "hum" and (m_value < 20 or m_value > 100):
-                raise serializers.ValidationError(
-                    f"Humidity must be between 20 and 100, got {m_value}"
-                )
-            elif label == "rain" and (m_value < 0 or m_value > 2):
-                raise serializers.ValidationError(
-                    f"Rainfall must be between 0 and 2, got {m_value}"
-                )
+            error = range_error(measurement["label"], measurement["value"])
+            if error is not None:
+                raise serializers.ValidationError(error)
 
         return measurements
 
@@ -51,3 +54,14 @@ class DataRecordAggregateResponseSerializer(serializers.Serializer):
     label = serializers.ChoiceField(choices=["temp", "rain", "hum"])
     time_slot = serializers.DateTimeField()
     value = serializers.FloatField()
+
+
+class DataRecordStatsResponseSerializer(serializers.Serializer):
+    # Only the stats requested are present
+    label = serializers.ChoiceField(choices=["temp", "rain", "hum"])
+    time_slot = serializers.DateTimeField()
+    min = serializers.FloatField(required=False)
+    max = serializers.FloatField(required=False)
+    count = serializers.IntegerField(required=False)
+    avg = serializers.FloatField(required=False)
+    sum = serializers.FloatField(required=False)
@@ -0,0 +1,172 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+import heapq
+import threading
+import zlib
+
+from . import replicas
+
+# Models whose rows live on the shard of their datalogger
+SHARDED_MODELS = {
+    "measurement",
+    "measurementrecord",
+    "measurementrollup",
+    "latestreading",
+}
+
+_lock = threading.Lock()
+_local = threading.local()
+_executor = None
+
+
+def shards():
+    # Aliases of the databases holding raw readings and rollups
+    return settings.MEASUREMENTS_SHARDS or [DEFAULT_DB_ALIAS]
+
+
+def shard_for(datalogger_id):
+    aliases = shards()
+    if len(aliases) == 1:
+        return aliases[0]
+    digest = zlib.crc32(datalogger_id.to_bytes(8, "little"))
+    return aliases[digest % len(aliases)]
+
+
+def reader(datalogger_id):
+    # Alias reads of the rows of a datalogger go to: its shard, or one of
+    # the replicas of the shard inside replicas.reading()
+    return replicas.for_read(shard_for(datalogger_id))
+
+
+def split(datalogger_ids):
+    # Maps the alias of each shard holding some of the dataloggers to their
+    # ids, every shard to None when datalogger_ids is None
+    aliases = shards()
+    if len(aliases) == 1:
+        return {aliases[0]: datalogger_ids}
+    if datalogger_ids is None:
+        return dict.fromkeys(aliases)
+    groups = {}
+    for datalogger_id in datalogger_ids:
+        groups.setdefault(shard_for(datalogger_id), []).append(datalogger_id)
+    return groups
+
+
+def partition(objects):
+    # Objects with a datalogger_id grouped by shard, in shard order
+    groups = {}
+    for obj in objects:
+        groups.setdefault(shard_for(obj.datalogger_id), []).append(obj)
+    return {alias: groups[alias] for alias in shards() if alias in groups}
+
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(thread_name_prefix="shards")
+        return _executor
+
+
+def _call(function, alias, datalogger_ids):
+    # Pool threads open their own connections, closed like those of a request
+    try:
+        return list(function(alias, datalogger_ids))
+    finally:
+        connections.close_all()
+
+
+def fan_out(function, datalogger_ids=None):
+    # Results of function(alias, ids) for every shard holding some of the
+    # dataloggers, see split, in shard order. Several shards are queried in
+    # parallel on a thread pool, except inside a transaction: the other
+    # threads could not see its writes. A single shard gets the result of
+    # function as it is, iterators are only consumed by the pool. Inside
+    # replicas.reading() function is given the replica of each shard.
+    calls = [
+        (replicas.for_read(alias), ids) for alias, ids in split(datalogger_ids).items()
+    ]
+    if len(calls) <= 1 or any(connections[alias].in_atomic_block for alias, _ in calls):
+        return [function(alias, ids) for alias, ids in calls]
+    futures = [_pool().submit(_call, function, alias, ids) for alias, ids in calls]
+    return [future.result() for future in futures]
+
+
+def merge(results, key):
+    # Items of several shards each ordered by key, a datalogger only ever
+    # being on one shard
+    if len(results) == 1:
+        return iter(results[0])
+    return heapq.merge(*results, key=key)
+
+
+@contextmanager
+def atomic():
+    # Transaction on the default database that shards join when first
+    # written, see writing(). Those are committed before the default
+    # database, where on_commit callbacks run. This is not a two-phase
+    # commit: a failed commit can leave the shards before it committed,
+    # ingest being idempotent the client retries the whole batch.
+    previous = getattr(_local, "joined", None)
+    with transaction.atomic(), ExitStack() as stack:
+        _local.joined = (stack, set())
+        try:
+            yield
+        finally:
+            _local.joined = previous
+
+
+def writing(alias):
+    # Opens the transaction of the current atomic() block on a shard. Shards
+    # are only locked once written, in shard order by ingest so concurrent
+    # ones cannot deadlock.
+    joined = getattr(_local, "joined", None)
+    if alias == DEFAULT_DB_ALIAS or joined is None or alias in joined[1]:
+        return
+    stack, aliases = joined
+    stack.enter_context(transaction.atomic(using=alias))
+    aliases.add(alias)
+
+
+def replicate(model, rows):
+    # Copies rows created in the default database to every shard with their
+    # ids, the foreign keys of sharded rows point to them. Copies left by a
+    # rolled back transaction whose ids were reused are overwritten.
+    if not rows:
+        return
+    fields = [field for field in rows[0] if field != "id"]
+    for alias in shards():
+        if alias != DEFAULT_DB_ALIAS:
+            writing(alias)
+            model.objects.using(alias).bulk_create(
+                [model(**row) for row in rows],
+                batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=["id"],
+                update_fields=fields,
+            )
+
+
+class ShardRouter:
+    # Saved and deleted instances of the sharded models go to the shard of
+    # their datalogger, queries choose theirs with using(). Shards only hold
+    # the tables of this app.
+    def db_for_write(self, model, **hints):
+        # Related managers pass the instance they start from
+        datalogger_id = getattr(hints.get("instance"), "datalogger_id", None)
+        if model._meta.model_name in SHARDED_MODELS and datalogger_id is not None:
+            return shard_for(datalogger_id)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Dataloggers and locations are copied to every shard
+        if obj1._meta.app_label == obj2._meta.app_label == "measurements":
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS:
+            return None
+        return app_label == "measurements"
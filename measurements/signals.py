@@ -0,0 +1,16 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from . import sharding
+from .ingest import measurements_saved
+from .models import Measurement
+
+
+@receiver(post_save, sender=Measurement)
+def measurement_saved(sender, instance, created, raw=False, **kwargs):
+    # bulk_create does not send post_save, bulk paths go through
+    # ingest.save_measurements. Edits of existing rows need a
+    # rebuild_rollups run.
+    if created and not raw:
+        with sharding.atomic():
+            measurements_saved([instance])
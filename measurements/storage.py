@@ -0,0 +1,692 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Min, Q, Sum
+from operator import itemgetter
+import itertools
+
+from . import sharding
+from .models import Measurement, MeasurementRecord
+
+LABELS = [label for label, _ in Measurement.LABEL_CHOICES]
+
+# Mean for temp and hum, Sum for rain
+AGGREGATES = {
+    "temp": Avg,
+    "hum": Avg,
+    "rain": Sum,
+}
+
+# Statistics that can be requested per bucket instead of the value above
+STATS = {
+    "min": Min,
+    "max": Max,
+    "count": Count,
+    "avg": Avg,
+    "sum": Sum,
+}
+
+
+# Leading fields of export_rows items, followed by label and value
+EXPORT_FIELDS = ["datalogger__uuid", "recorded_at", "location__lat", "location__lng"]
+
+
+class Storage:
+    # Both layouts expose raw readings as narrow rows: dicts with id, label,
+    # recorded_at and value ordered by (recorded_at, id), and aggregates as
+    # dicts with label, time_slot and value ordered by (time_slot, label).
+    # Aggregates of several dataloggers also hold their datalogger_id.
+    # bucket_aggregates items hold the requested stats instead of value, the
+    # "value" stat being the default aggregate of the label. Readings of one
+    # datalogger are read from its shard, those of several from all of them.
+    model = None
+    # Unique fields of the rows, starting with datalogger_id and recorded_at
+    natural_key = None
+
+    def _bucket_window(
+        self, alias, datalogger_ids, bucket, lower, upper, after, lower_inclusive
+    ):
+        queryset = self.fleet_window(
+            alias, datalogger_ids, lower, upper, lower_inclusive
+        )
+        queryset = queryset.annotate(time_slot=bucket("recorded_at"))
+        if after is not None:
+            # A bucket starts at or before its readings
+            queryset = queryset.filter(recorded_at__gte=after[0])
+        return queryset
+
+    def window(self, datalogger_id, lower=None, upper=None, lower_inclusive=False):
+        queryset = self.model.objects.using(sharding.reader(datalogger_id))
+        queryset = queryset.filter(datalogger_id=datalogger_id)
+        return self._bounded(queryset, lower, upper, lower_inclusive)
+
+    def fleet_window(
+        self, alias, datalogger_ids=None, lower=None, upper=None, lower_inclusive=False
+    ):
+        # Readings of several dataloggers stored in one database, of all of
+        # them when None
+        queryset = self.model.objects.using(alias)
+        if datalogger_ids is not None:
+            queryset = queryset.filter(datalogger_id__in=datalogger_ids)
+        return self._bounded(queryset, lower, upper, lower_inclusive)
+
+    def _bounded(self, queryset, lower, upper, lower_inclusive):
+        if lower is not None:
+            if lower_inclusive:
+                queryset = queryset.filter(recorded_at__gte=lower)
+            else:
+                queryset = queryset.filter(recorded_at__gt=lower)
+        if upper is not None:
+            queryset = queryset.filter(recorded_at__lt=upper)
+        return queryset
+
+    def first_recorded_at(self, datalogger_id):
+        return (
+            self.window(datalogger_id)
+            .order_by("recorded_at")
+            .values_list("recorded_at", flat=True)
+            .first()
+        )
+
+    def last_recorded_at(self, datalogger_id):
+        return (
+            self.window(datalogger_id)
+            .order_by("-recorded_at")
+            .values_list("recorded_at", flat=True)
+            .first()
+        )
+
+    def datalogger_ids(self, alias=None):
+        # Dataloggers with readings in one database, in any shard when None
+        if alias is None:
+            return sorted(
+                {
+                    datalogger_id
+                    for datalogger_ids in sharding.fan_out(
+                        lambda alias, _: self.datalogger_ids(alias)
+                    )
+                    for datalogger_id in datalogger_ids
+                }
+            )
+        return (
+            self.model.objects.using(alias)
+            .order_by()
+            .values_list("datalogger_id", flat=True)
+            .distinct()
+        )
+
+    def delete(self, datalogger_id):
+        return self.window(datalogger_id).delete()[0]
+
+    def save(self, measurements):
+        # Each shard stores the measurements of its dataloggers, joining the
+        # transaction of the caller. Returns the measurements stored.
+        stored = []
+        for alias, group in sharding.partition(measurements).items():
+            sharding.writing(alias)
+            stored.extend(self._save(alias, group))
+        return stored
+
+    def fleet_aggregates(
+        self, datalogger_ids, trunc, lower, upper, lower_inclusive=False
+    ):
+        return sharding.merge(
+            sharding.fan_out(
+                lambda alias, ids: self._fleet_aggregates(
+                    alias, ids, trunc, lower, upper, lower_inclusive
+                ),
+                datalogger_ids,
+            ),
+            key=itemgetter("datalogger_id"),
+        )
+
+    def bucket_aggregates(
+        self,
+        datalogger_ids,
+        bucket,
+        lower,
+        upper,
+        stats,
+        after=None,
+        lower_inclusive=False,
+    ):
+        return sharding.merge(
+            sharding.fan_out(
+                lambda alias, ids: self._bucket_aggregates(
+                    alias, ids, bucket, lower, upper, stats, after, lower_inclusive
+                ),
+                datalogger_ids,
+            ),
+            key=itemgetter("datalogger_id"),
+        )
+
+    def export_rows(self, datalogger_ids, lower, upper, chunk_size):
+        # Shards are exported one after the other, each ordered by
+        # datalogger, without holding their rows in memory
+        return itertools.chain.from_iterable(
+            self._export_rows(alias, ids, lower, upper, chunk_size)
+            for alias, ids in sharding.split(datalogger_ids).items()
+        )
+
+    def stored(self, alias, measurements, *fields):
+        # fields of the rows that may share their natural key with
+        # measurements: those of the same dataloggers within the time range
+        # each of them covers, one query per batch of dataloggers
+        ranges = {}
+        for measurement in measurements:
+            recorded_at = measurement.recorded_at
+            lower, upper = ranges.get(
+                measurement.datalogger_id, (recorded_at, recorded_at)
+            )
+            ranges[measurement.datalogger_id] = (
+                min(lower, recorded_at),
+                max(upper, recorded_at),
+            )
+
+        ranges = list(ranges.items())
+        batch_size = settings.MEASUREMENTS_BULK_BATCH_SIZE
+        for start in range(0, len(ranges), batch_size):
+            condition = Q()
+            for datalogger_id, bounds in ranges[start : start + batch_size]:
+                condition |= Q(datalogger_id=datalogger_id, recorded_at__range=bounds)
+            yield from (
+                self.model.objects.using(alias).filter(condition).values_list(*fields)
+            )
+
+
+class NarrowStorage(Storage):
+    # One Measurement row per label
+    name = "narrow"
+    model = Measurement
+    natural_key = ["datalogger_id", "recorded_at", "label"]
+
+    def _save(self, alias, measurements):
+        # A label repeated at the same time keeps its last value. Readings
+        # already stored are left as they are, a retried ingest stores
+        # nothing. Returns the measurements inserted so derived data only
+        # counts those. The transaction holds the write lock from the lookup
+        # on, a concurrent ingest cannot store the same keys in between.
+        fresh = {
+            (measurement.datalogger_id, measurement.recorded_at, measurement.label): (
+                measurement
+            )
+            for measurement in measurements
+        }
+        with transaction.atomic(using=alias):
+            for key in self.stored(alias, measurements, *self.natural_key):
+                fresh.pop(key, None)
+            measurements = list(fresh.values())
+            Measurement.objects.using(alias).bulk_create(
+                measurements, batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE
+            )
+        return measurements
+
+    def rows(
+        self,
+        datalogger_id,
+        lower=None,
+        upper=None,
+        lower_inclusive=False,
+        after=None,
+        limit=None,
+    ):
+        queryset = self.window(datalogger_id, lower, upper, lower_inclusive)
+        queryset = queryset.order_by("recorded_at", "id")
+        if after is not None:
+            recorded_at, last_id = after
+            queryset = queryset.filter(recorded_at__gte=recorded_at).filter(
+                Q(recorded_at__gt=recorded_at) | Q(id__gt=last_id)
+            )
+
+        queryset = queryset.values("id", "label", "recorded_at", "value")
+        if limit is not None:
+            queryset = queryset[:limit]
+        return list(queryset)
+
+    def stream(self, datalogger_id, lower, upper, chunk_size):
+        return (
+            self.window(datalogger_id, lower, upper)
+            .order_by("recorded_at", "id")
+            .values_list("label", "recorded_at", "value")
+            .iterator(chunk_size=chunk_size)
+        )
+
+    def series(self, datalogger_id, label, lower, upper, chunk_size):
+        # (recorded_at, value) of a single label ordered by recorded_at
+        return (
+            self.window(datalogger_id, lower, upper)
+            .filter(label=label)
+            .order_by("recorded_at", "id")
+            .values_list("recorded_at", "value")
+            .iterator(chunk_size=chunk_size)
+        )
+
+    def label_counts(self, datalogger_id, lower, upper):
+        return dict(
+            self.window(datalogger_id, lower, upper)
+            .values("label")
+            .annotate(count=Count("id"))
+            .order_by()
+            .values_list("label", "count")
+        )
+
+    def _export_rows(self, alias, datalogger_ids, lower, upper, chunk_size):
+        return (
+            self.fleet_window(alias, datalogger_ids, lower, upper)
+            .order_by("datalogger_id", "recorded_at", "id")
+            .values_list(*EXPORT_FIELDS, "label", "value")
+            .iterator(chunk_size=chunk_size)
+        )
+
+    def measurements(self, datalogger_id, chunk_size):
+        return (
+            self.window(datalogger_id)
+            .order_by("recorded_at", "id")
+            .iterator(chunk_size=chunk_size)
+        )
+
+    def aggregates(
+        self, datalogger_id, trunc, lower, upper, lower_inclusive=False, after=None
+    ):
+        queryset = self.window(datalogger_id, lower, upper, lower_inclusive)
+        queryset = queryset.annotate(time_slot=trunc("recorded_at"))
+        if after is not None:
+            time_slot, label = after
+            queryset = queryset.filter(recorded_at__gte=time_slot).filter(
+                Q(time_slot__gt=time_slot) | Q(time_slot=time_slot, label__gt=label)
+            )
+
+        group_queryset = (
+            queryset.values("time_slot", "label")
+            .annotate(
+                **{
+                    label: aggregate("value", filter=Q(label=label))
+                    for label, aggregate in AGGREGATES.items()
+                }
+            )
+            .order_by("time_slot", "label")
+        )
+        for item in group_queryset:
+            yield {
+                "label": item["label"],
+                "time_slot": item["time_slot"],
+                "value": item[item["label"]],
+            }
+
+    def _fleet_aggregates(
+        self, alias, datalogger_ids, trunc, lower, upper, lower_inclusive=False
+    ):
+        # Same aggregates for several dataloggers in one GROUP BY, items also
+        # carry datalogger_id and are ordered by (datalogger_id, time_slot,
+        # label)
+        queryset = self.fleet_window(
+            alias, datalogger_ids, lower, upper, lower_inclusive
+        )
+        group_queryset = (
+            queryset.annotate(time_slot=trunc("recorded_at"))
+            .values("datalogger_id", "time_slot", "label")
+            .annotate(
+                **{
+                    label: aggregate("value", filter=Q(label=label))
+                    for label, aggregate in AGGREGATES.items()
+                }
+            )
+            .order_by("datalogger_id", "time_slot", "label")
+        )
+        for item in group_queryset:
+            yield {
+                "datalogger_id": item["datalogger_id"],
+                "label": item["label"],
+                "time_slot": item["time_slot"],
+                "value": item[item["label"]],
+            }
+
+    def _bucket_aggregates(
+        self,
+        alias,
+        datalogger_ids,
+        bucket,
+        lower,
+        upper,
+        stats,
+        after=None,
+        lower_inclusive=False,
+    ):
+        # One GROUP BY on (datalogger_id, bucket(recorded_at), label)
+        annotations = {}
+        for stat in stats:
+            if stat == "value":
+                for label, aggregate in AGGREGATES.items():
+                    annotations[f"value_{label}"] = aggregate(
+                        "value", filter=Q(label=label)
+                    )
+            else:
+                annotations[stat] = STATS[stat]("value")
+
+        group_queryset = (
+            self._bucket_window(
+                alias, datalogger_ids, bucket, lower, upper, after, lower_inclusive
+            )
+            .values("datalogger_id", "time_slot", "label")
+            .annotate(**annotations)
+            .order_by("datalogger_id", "time_slot", "label")
+        )
+        for item in group_queryset:
+            if after is not None and (item["time_slot"], item["label"]) <= after:
+                continue
+            result = {
+                "datalogger_id": item["datalogger_id"],
+                "label": item["label"],
+                "time_slot": item["time_slot"],
+            }
+            for stat in stats:
+                if stat == "value":
+                    result["value"] = item[f"value_{item['label']}"]
+                else:
+                    result[stat] = item[stat]
+            yield result
+
+    def rollup_groups(self, datalogger_id, trunc, lower=None, upper=None):
+        groups = (
+            self.window(datalogger_id, lower, upper, lower_inclusive=True)
+            .annotate(bucket=trunc("recorded_at"))
+            .values("bucket", "label")
+            .annotate(
+                count=Count("id"),
+                total=Sum("value"),
+                minimum=Min("value"),
+                maximum=Max("value"),
+            )
+            .order_by()
+        )
+        return groups.iterator(chunk_size=settings.MEASUREMENTS_BULK_BATCH_SIZE)
+
+
+class WideStorage(Storage):
+    # One MeasurementRecord row per (datalogger, recorded_at) with a nullable
+    # column per label. Narrow rows are derived from it: the id of a row is
+    # record id * len(LABELS) + label index, which keeps keyset pagination on
+    # (recorded_at, id) working across both layouts.
+    name = "wide"
+    model = MeasurementRecord
+    natural_key = ["datalogger_id", "recorded_at"]
+
+    def _save(self, alias, measurements):
+        # Readings of the same datalogger at the same time share a row, a
+        # label repeated there keeps its last value. Labels missing from an
+        # existing row are added to it, the others are left as they are.
+        # Returns the measurements inserted so derived data only counts
+        # those, the transaction holds the write lock from the lookup on.
+        records = {}
+        stored = {}
+        for measurement in measurements:
+            key = (measurement.datalogger_id, measurement.recorded_at)
+            record = records.get(key)
+            if record is None:
+                record = records[key] = MeasurementRecord(
+                    datalogger_id=measurement.datalogger_id,
+                    location_id=measurement.location_id,
+                    recorded_at=measurement.recorded_at,
+                )
+            setattr(record, measurement.label, measurement.value)
+            stored[key + (measurement.label,)] = measurement
+
+        with transaction.atomic(using=alias):
+            updated = []
+            for record_id, datalogger_id, recorded_at, *values in self.stored(
+                alias, measurements, "id", "datalogger_id", "recorded_at", *LABELS
+            ):
+                record = records.pop((datalogger_id, recorded_at), None)
+                if record is None:
+                    continue
+                changed = False
+                for label, value in zip(LABELS, values):
+                    if value is not None:
+                        stored.pop((datalogger_id, recorded_at, label), None)
+                        setattr(record, label, value)
+                    elif getattr(record, label) is not None:
+                        changed = True
+                if changed:
+                    record.id = record_id
+                    updated.append(record)
+
+            MeasurementRecord.objects.using(alias).bulk_create(
+                records.values(),
+                batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE,
+            )
+            MeasurementRecord.objects.using(alias).bulk_update(
+                updated, LABELS, batch_size=settings.MEASUREMENTS_BULK_BATCH_SIZE
+            )
+        return list(stored.values())
+
+    def _expand(self, records):
+        for record_id, recorded_at, *values in records:
+            for index, (label, value) in enumerate(zip(LABELS, values)):
+                if value is not None:
+                    yield record_id * len(LABELS) + index, label, recorded_at, value
+
+    def rows(
+        self,
+        datalogger_id,
+        lower=None,
+        upper=None,
+        lower_inclusive=False,
+        after=None,
+        limit=None,
+    ):
+        queryset = self.window(datalogger_id, lower, upper, lower_inclusive)
+        queryset = queryset.order_by("recorded_at", "id")
+        if after is not None:
+            recorded_at, last_id = after
+            queryset = queryset.filter(recorded_at__gte=recorded_at).filter(
+                Q(recorded_at__gt=recorded_at) | Q(id__gte=last_id // len(LABELS))
+            )
+
+        records = queryset.values_list("id", "recorded_at", *LABELS)
+        if limit is not None:
+            # Every record holds at least one reading, only the one at the
+            # cursor may be skipped entirely
+            records = records[: limit + 1]
+
+        rows = []
+        for row_id, label, recorded_at, value in self._expand(records):
+            if after is not None and (recorded_at, row_id) <= after:
+                continue
+            rows.append(
+                {
+                    "id": row_id,
+                    "label": label,
+                    "recorded_at": recorded_at,
+                    "value": value,
+                }
+            )
+            if limit is not None and len(rows) >= limit:
+                break
+        return rows
+
+    def stream(self, datalogger_id, lower, upper, chunk_size):
+        records = (
+            self.window(datalogger_id, lower, upper)
+            .order_by("recorded_at", "id")
+            .values_list("id", "recorded_at", *LABELS)
+            .iterator(chunk_size=chunk_size)
+        )
+        for _, label, recorded_at, value in self._expand(records):
+            yield label, recorded_at, value
+
+    def series(self, datalogger_id, label, lower, upper, chunk_size):
+        return (
+            self.window(datalogger_id, lower, upper)
+            .filter(**{f"{label}__isnull": False})
+            .order_by("recorded_at", "id")
+            .values_list("recorded_at", label)
+            .iterator(chunk_size=chunk_size)
+        )
+
+    def label_counts(self, datalogger_id, lower, upper):
+        return self.window(datalogger_id, lower, upper).aggregate(
+            **{label: Count(label) for label in LABELS}
+        )
+
+    def _export_rows(self, alias, datalogger_ids, lower, upper, chunk_size):
+        records = (
+            self.fleet_window(alias, datalogger_ids, lower, upper)
+            .order_by("datalogger_id", "recorded_at", "id")
+            .values_list(*EXPORT_FIELDS, *LABELS)
+            .iterator(chunk_size=chunk_size)
+        )
+        for record in records:
+            fields = record[: len(EXPORT_FIELDS)]
+            for label, value in zip(LABELS, record[len(EXPORT_FIELDS) :]):
+                if value is not None:
+                    yield (*fields, label, value)
+
+    def measurements(self, datalogger_id, chunk_size):
+        records = (
+            self.window(datalogger_id)
+            .order_by("recorded_at", "id")
+            .iterator(chunk_size=chunk_size)
+        )
+        for record in records:
+            for label in LABELS:
+                value = getattr(record, label)
+                if value is not None:
+                    yield Measurement(
+                        label=label,
+                        value=value,
+                        recorded_at=record.recorded_at,
+                        datalogger_id=record.datalogger_id,
+                        location_id=record.location_id,
+                    )
+
+    def aggregates(
+        self, datalogger_id, trunc, lower, upper, lower_inclusive=False, after=None
+    ):
+        # A single pass per time slot computes every label at once
+        queryset = self.window(datalogger_id, lower, upper, lower_inclusive)
+        queryset = queryset.annotate(time_slot=trunc("recorded_at"))
+        if after is not None:
+            queryset = queryset.filter(recorded_at__gte=after[0])
+
+        group_queryset = (
+            queryset.values("time_slot")
+            .annotate(
+                **{
+                    f"{label}_value": aggregate(label)
+                    for label, aggregate in AGGREGATES.items()
+                }
+            )
+            .order_by("time_slot")
+        )
+        for item in group_queryset:
+            for label in sorted(LABELS):
+                value = item[f"{label}_value"]
+                if value is None:
+                    continue
+                if after is not None and (item["time_slot"], label) <= after:
+                    continue
+                yield {"label": label, "time_slot": item["time_slot"], "value": value}
+
+    def _fleet_aggregates(
+        self, alias, datalogger_ids, trunc, lower, upper, lower_inclusive=False
+    ):
+        queryset = self.fleet_window(
+            alias, datalogger_ids, lower, upper, lower_inclusive
+        )
+        group_queryset = (
+            queryset.annotate(time_slot=trunc("recorded_at"))
+            .values("datalogger_id", "time_slot")
+            .annotate(
+                **{
+                    f"{label}_value": aggregate(label)
+                    for label, aggregate in AGGREGATES.items()
+                }
+            )
+            .order_by("datalogger_id", "time_slot")
+        )
+        for item in group_queryset:
+            for label in sorted(LABELS):
+                value = item[f"{label}_value"]
+                if value is not None:
+                    yield {
+                        "datalogger_id": item["datalogger_id"],
+                        "label": label,
+                        "time_slot": item["time_slot"],
+                        "value": value,
+                    }
+
+    def _bucket_aggregates(
+        self,
+        alias,
+        datalogger_ids,
+        bucket,
+        lower,
+        upper,
+        stats,
+        after=None,
+        lower_inclusive=False,
+    ):
+        # One GROUP BY on (datalogger_id, bucket(recorded_at)) computing the
+        # stats of every label column, a label without readings is skipped
+        annotations = {}
+        for label in LABELS:
+            annotations[f"{label}_readings"] = Count(label)
+            for stat in stats:
+                aggregate = AGGREGATES[label] if stat == "value" else STATS[stat]
+                annotations[f"{label}_{stat}"] = aggregate(label)
+
+        group_queryset = (
+            self._bucket_window(
+                alias, datalogger_ids, bucket, lower, upper, after, lower_inclusive
+            )
+            .values("datalogger_id", "time_slot")
+            .annotate(**annotations)
+            .order_by("datalogger_id", "time_slot")
+        )
+        for item in group_queryset:
+            for label in sorted(LABELS):
+                if not item[f"{label}_readings"]:
+                    continue
+                if after is not None and (item["time_slot"], label) <= after:
+                    continue
+                result = {
+                    "datalogger_id": item["datalogger_id"],
+                    "label": label,
+                    "time_slot": item["time_slot"],
+                }
+                for stat in stats:
+                    result[stat] = item[f"{label}_{stat}"]
+                yield result
+
+    def rollup_groups(self, datalogger_id, trunc, lower=None, upper=None):
+        aggregates = {}
+        for label in LABELS:
+            aggregates[f"{label}_count"] = Count(label)
+            aggregates[f"{label}_total"] = Sum(label)
+            aggregates[f"{label}_minimum"] = Min(label)
+            aggregates[f"{label}_maximum"] = Max(label)
+
+        groups = (
+            self.window(datalogger_id, lower, upper, lower_inclusive=True)
+            .annotate(bucket=trunc("recorded_at"))
+            .values("bucket")
+            .annotate(**aggregates)
+            .order_by()
+        )
+        for group in groups.iterator(chunk_size=settings.MEASUREMENTS_BULK_BATCH_SIZE):
+            for label in LABELS:
+                if group[f"{label}_count"]:
+                    yield {
+                        "bucket": group["bucket"],
+                        "label": label,
+                        "count": group[f"{label}_count"],
+                        "total": group[f"{label}_total"],
+                        "minimum": group[f"{label}_minimum"],
+                        "maximum": group[f"{label}_maximum"],
+                    }
+
+
+STORAGES = {storage.name: storage for storage in [NarrowStorage(), WideStorage()]}
+
+
+def get_storage(name=None):
+    return STORAGES[name or settings.MEASUREMENTS_STORAGE]
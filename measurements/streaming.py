@@ -0,0 +1,57 @@
+from rest_framework.utils import json
+import csv
+
+
+def format_datetime(value):
+    # Same output as the DRF DateTimeField used by the JSON responses
+    value = value.isoformat()
+    if value.endswith("+00:00"):
+        value = value[:-6] + "Z"
+    return value
+
+
+def chunked(lines, size):
+    # Joins lines into strings of size lines
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def ndjson_lines(rows):
+    for label, recorded_at, value in rows:
+        yield json.dumps(
+            {
+                "label": label,
+                "recorded_at": format_datetime(recorded_at),
+                "value": value,
+            }
+        ) + "\n"
+
+
+class Echo:
+    # File-like object for csv.writer, writerow returns the formatted line
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(["label", "recorded_at", "value"])
+    for label, recorded_at, value in rows:
+        yield writer.writerow([label, format_datetime(recorded_at), value])
+
+
+STREAM_FORMATS = {
+    "ndjson": ndjson_lines,
+    "csv": csv_lines,
+}
+
+
+def stream_rows(rows, stream_format, chunk_size):
+    # Group lines so each write to the socket carries a reasonable payload
+    return chunked(STREAM_FORMATS[stream_format](rows), chunk_size)
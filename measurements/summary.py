@@ -0,0 +1,300 @@
+from django.db.models import DateTimeField, Func
+from operator import itemgetter
+import re
+
+from . import caching, retention, sharding
+from .models import MeasurementRollup
+from .rollups import SPAN_TRUNCS, SPAN_WIDTHS, truncate
+from .storage import get_storage
+
+
+# Spans other than hour and day: a number of minutes, hours, days or weeks
+SPAN_PATTERN = re.compile(r"^([1-9][0-9]*)([mhdw])$")
+SPAN_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+# Widest span in seconds, wider ones would overflow the bucket arithmetic
+MAX_SPAN_WIDTH = 366 * 86400
+
+STAT_NAMES = ["min", "max", "count", "avg", "sum"]
+
+
+class EpochBucket(Func):
+    # Start of the width seconds long bucket holding the expression, buckets
+    # are aligned on the Unix epoch in UTC
+    output_field = DateTimeField()
+
+    def __init__(self, expression, width):
+        super().__init__(expression)
+        self.width = int(width)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return (
+            f"datetime((CAST(strftime('%%s', {sql}) AS INTEGER) / {self.width}) "
+            f"* {self.width}, 'unixepoch')",
+            params,
+        )
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return (
+            f"to_timestamp(FLOOR(EXTRACT(EPOCH FROM {sql}) / {self.width}) "
+            f"* {self.width})",
+            params,
+        )
+
+
+def parse_span(span):
+    # Bucket expression of a span parameter, ValueError when invalid
+    if span in SPAN_TRUNCS:
+        return SPAN_TRUNCS[span]
+    match = SPAN_PATTERN.match(span)
+    if match is None:
+        raise ValueError(f"Invalid span {span!r}")
+    width = int(match.group(1)) * SPAN_UNITS[match.group(2)]
+    if width > MAX_SPAN_WIDTH:
+        raise ValueError(f"Invalid span {span!r}")
+    return lambda expression: EpochBucket(expression, width)
+
+
+def parse_stats(stats):
+    # Requested stats in order without duplicates, ValueError when invalid
+    names = []
+    for name in stats.split(","):
+        if name not in STAT_NAMES:
+            raise ValueError(f"Invalid stat {name!r}")
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def _rollup_value(label, count, total):
+    if label == "rain":
+        return total
+    return total / count
+
+
+def _fetch_rollups(datalogger_id, span, start, end):
+    rows = (
+        MeasurementRollup.objects.using(sharding.reader(datalogger_id))
+        .filter(
+            datalogger_id=datalogger_id, span=span, bucket__gte=start, bucket__lt=end
+        )
+        .order_by("bucket", "label")
+        .values_list("bucket", "label", "count", "total")
+    )
+    return [
+        {
+            "label": label,
+            "time_slot": bucket,
+            "value": _rollup_value(label, count, total),
+        }
+        for bucket, label, count, total in rows
+    ]
+
+
+def _rollup_segment(datalogger_id, span, start, end, after):
+    rollups = MeasurementRollup.objects.using(sharding.reader(datalogger_id))
+    rollups = rollups.filter(datalogger_id=datalogger_id, span=span)
+    if after is not None:
+        start = after[0] if start is None else max(start, after[0])
+
+    # Unbounded sides stop at the first and last known buckets
+    if start is None:
+        start = rollups.order_by("bucket").values_list("bucket", flat=True).first()
+    if end is None:
+        last = rollups.order_by("-bucket").values_list("bucket", flat=True).first()
+        end = None if last is None else last + SPAN_WIDTHS[span]
+    if start is None or end is None or start >= end:
+        return
+
+    items = caching.cached_range(
+        datalogger_id,
+        span,
+        start,
+        end,
+        lambda lo, hi: _fetch_rollups(datalogger_id, span, lo, hi),
+        "time_slot",
+    )
+    for item in items:
+        if after is None or (item["time_slot"], item["label"]) > after:
+            yield item
+
+
+def _horizon(datalogger_ids, since, before):
+    # Compaction time the split of a window depends on, only when one of its
+    # bounds may be before it
+    times = [time for time in [since, before] if time is not None]
+    return retention.compacted_before(datalogger_ids, times) if times else None
+
+
+def _split_window(span, since, before, horizon):
+    # First and last bucket boundaries fully covered by the window, and
+    # whether the partial buckets at each end are computed from raw readings.
+    # Raw readings before horizon, the time the dataloggers were compacted
+    # before if any, are gone: a window starting there begins at its first
+    # whole bucket and one ending there at its last.
+    full_start = full_end = None
+    since_edge = before_edge = False
+    if since is not None:
+        full_start = truncate(since, span)
+        if horizon is None or since >= horizon:
+            full_start += SPAN_WIDTHS[span]
+            since_edge = True
+        elif full_start < since:
+            full_start += SPAN_WIDTHS[span]
+    if before is not None:
+        full_end = truncate(before, span)
+        before_edge = horizon is None or before >= horizon
+    return full_start, full_end, since_edge, before_edge
+
+
+def aggregate_window(
+    datalogger_id, span, since=None, before=None, after=None, stats=None
+):
+    # Yields aggregates ordered by (time_slot, label), starting strictly after
+    # the optional (time_slot, label) keyset. Buckets entirely inside the
+    # (since, before) window are read from the rollups, only the partial
+    # buckets at both ends are computed from raw measurements. Stats are read
+    # from the same segments, without the cache.
+    if datalogger_id is None:
+        return
+    if stats:
+        for segment in _segments([datalogger_id], span, since, before, stats, after):
+            for item in segment:
+                del item["datalogger_id"]
+                yield item
+        return
+
+    storage = get_storage()
+    trunc = SPAN_TRUNCS[span]
+    full_start, full_end, since_edge, before_edge = _split_window(
+        span, since, before, _horizon([datalogger_id], since, before)
+    )
+
+    if since_edge and before_edge and full_start >= full_end:
+        yield from storage.aggregates(datalogger_id, trunc, since, before, after=after)
+        return
+
+    if since_edge:
+        yield from storage.aggregates(
+            datalogger_id, trunc, since, full_start, after=after
+        )
+
+    yield from _rollup_segment(datalogger_id, span, full_start, full_end, after)
+
+    if before_edge:
+        yield from storage.aggregates(
+            datalogger_id, trunc, full_end, before, lower_inclusive=True, after=after
+        )
+
+
+def _fleet_rollups(datalogger_ids, span, start, end, stats=None, after=None):
+    return sharding.merge(
+        sharding.fan_out(
+            lambda alias, ids: _shard_rollups(
+                alias, ids, span, start, end, stats, after
+            ),
+            datalogger_ids,
+        ),
+        key=itemgetter("datalogger_id"),
+    )
+
+
+def _shard_rollups(alias, datalogger_ids, span, start, end, stats=None, after=None):
+    rows = MeasurementRollup.objects.using(alias).filter(span=span)
+    if datalogger_ids is not None:
+        rows = rows.filter(datalogger_id__in=datalogger_ids)
+    if start is not None:
+        rows = rows.filter(bucket__gte=start)
+    if end is not None:
+        rows = rows.filter(bucket__lt=end)
+    if after is not None:
+        rows = rows.filter(bucket__gte=after[0])
+    rows = rows.order_by("datalogger_id", "bucket", "label").values_list(
+        "datalogger_id", "bucket", "label", "count", "total", "minimum", "maximum"
+    )
+    for datalogger_id, bucket, label, count, total, minimum, maximum in rows:
+        if after is not None and (bucket, label) <= after:
+            continue
+        item = {"datalogger_id": datalogger_id, "label": label, "time_slot": bucket}
+        if stats:
+            values = {
+                "min": minimum,
+                "max": maximum,
+                "count": count,
+                "avg": total / count,
+                "sum": total,
+            }
+            item.update((stat, values[stat]) for stat in stats)
+        else:
+            item["value"] = _rollup_value(label, count, total)
+        yield item
+
+
+def _segments(datalogger_ids, span, since, before, stats=None, after=None):
+    # Raw and rollup segments of an hour or day window, all of the
+    # dataloggers when None, each ordered by (datalogger_id, time_slot,
+    # label) and following each other in time. The split is the one of the
+    # latest compaction among the dataloggers.
+    storage = get_storage()
+    trunc = SPAN_TRUNCS[span]
+    full_start, full_end, since_edge, before_edge = _split_window(
+        span, since, before, _horizon(datalogger_ids, since, before)
+    )
+
+    def raw(lower, upper, lower_inclusive=False):
+        if stats:
+            return storage.bucket_aggregates(
+                datalogger_ids, trunc, lower, upper, stats, after, lower_inclusive
+            )
+        return storage.fleet_aggregates(
+            datalogger_ids, trunc, lower, upper, lower_inclusive
+        )
+
+    if since_edge and before_edge and full_start >= full_end:
+        return [raw(since, before)]
+    segments = []
+    if since_edge:
+        segments.append(raw(since, full_start))
+    segments.append(
+        _fleet_rollups(datalogger_ids, span, full_start, full_end, stats, after)
+    )
+    if before_edge:
+        segments.append(raw(full_end, before, lower_inclusive=True))
+    return segments
+
+
+def aggregate_fleet(datalogger_ids, span, since=None, before=None, stats=None):
+    # Aggregates of several dataloggers, of all of them when datalogger_ids is
+    # None, as a dict of datalogger id to items ordered by (time_slot, label).
+    # Same split as aggregate_window but every segment is read for all the
+    # dataloggers at once: at most three queries whatever their number. The
+    # per-datalogger cache is not used.
+    if span not in SPAN_TRUNCS:
+        return _by_datalogger(
+            [aggregate_buckets(datalogger_ids, span, since, before, stats)]
+        )
+    return _by_datalogger(_segments(datalogger_ids, span, since, before, stats))
+
+
+def _by_datalogger(segments):
+    # Segments follow each other in time, appending keeps the order
+    results = {}
+    for segment in segments:
+        for item in segment:
+            results.setdefault(item.pop("datalogger_id"), []).append(item)
+    return results
+
+
+def aggregate_buckets(
+    datalogger_ids, span, since=None, before=None, stats=None, after=None
+):
+    # Aggregates of any span computed from raw readings in a single query,
+    # with the given stats or the default value of each label. Items hold
+    # their datalogger_id and are ordered by (datalogger_id, time_slot,
+    # label), after is a (time_slot, label) keyset. Raises
+    # retention.Compacted when the window reaches before a compaction.
+    retention.check(datalogger_ids, since)
+    return get_storage().bucket_aggregates(
+        datalogger_ids, parse_span(span), since, before, stats or ["value"], after
+    )
@@ -0,0 +1,245 @@
+from django.conf import settings
+from rest_framework.utils import json
+from collections import deque
+from itertools import islice
+import csv
+import math
+import multiprocessing
+
+import django
+
+from . import sharding
+from .ingest import ingest_records
+from .storage import get_storage
+from .streaming import Echo, chunked, format_datetime
+from .validation import validate_record
+
+# One row per reading, consecutive rows of the same datalogger, time and
+# location form a record. NDJSON files hold one DataRecordRequest per line.
+CSV_FIELDS = ["datalogger", "at", "lat", "lng", "label", "value"]
+
+
+class InvalidRecords(Exception):
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid records")
+        self.errors = errors
+
+
+def _records(rows):
+    # Groups consecutive export rows sharing datalogger, time and location
+    key = None
+    measurements = []
+    for datalogger, recorded_at, lat, lng, label, value in rows:
+        if (datalogger, recorded_at, lat, lng) != key:
+            if key is not None:
+                yield key, measurements
+            key = (datalogger, recorded_at, lat, lng)
+            measurements = []
+        measurements.append({"label": label, "value": value})
+    if key is not None:
+        yield key, measurements
+
+
+def ndjson_lines(rows):
+    for (datalogger, recorded_at, lat, lng), measurements in _records(rows):
+        yield json.dumps(
+            {
+                "at": format_datetime(recorded_at),
+                "datalogger": str(datalogger),
+                "location": {"lat": lat, "lng": lng},
+                "measurements": measurements,
+            }
+        ) + "\n"
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_FIELDS)
+    for datalogger, recorded_at, lat, lng, label, value in rows:
+        yield writer.writerow(
+            [datalogger, format_datetime(recorded_at), lat, lng, label, value]
+        )
+
+
+EXPORT_FORMATS = {
+    "csv": csv_lines,
+    "ndjson": ndjson_lines,
+}
+
+
+def export_measurements(
+    write, export_format, datalogger_ids=None, since=None, before=None, progress=None
+):
+    # Passes the readings to write as text chunks, reading them with a
+    # server side cursor so memory use does not depend on their number.
+    # Returns the number of readings written.
+    chunk_size = settings.MEASUREMENTS_STREAM_CHUNK_SIZE
+    rows = get_storage().export_rows(datalogger_ids, since, before, chunk_size)
+    stats = {"measurements": 0}
+
+    def counted(rows):
+        for row in rows:
+            stats["measurements"] += 1
+            yield row
+
+    for chunk in chunked(EXPORT_FORMATS[export_format](counted(rows)), chunk_size):
+        write(chunk)
+        if progress is not None:
+            progress(stats)
+    return stats["measurements"]
+
+
+def _number(value):
+    # CSV values are strings, anything but a finite number is left to the
+    # serializer to report
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return number if math.isfinite(number) else value
+
+
+def _parse_csv(rows):
+    if any(len(row) != len(CSV_FIELDS) for row in rows):
+        return None, {"non_field_errors": [f"Expected {len(CSV_FIELDS)} columns"]}
+    datalogger, at, lat, lng = rows[0][:4]
+    return {
+        "at": at,
+        "datalogger": datalogger,
+        "location": {"lat": _number(lat), "lng": _number(lng)},
+        "measurements": [
+            {"label": label, "value": _number(value)} for *_, label, value in rows
+        ],
+    }, None
+
+
+def _parse_ndjson(line):
+    try:
+        return json.loads(line), None
+    except ValueError as exc:
+        return None, {"non_field_errors": [f"NDJSON parse error - {exc}"]}
+
+
+PARSERS = {
+    "csv": _parse_csv,
+    "ndjson": _parse_ndjson,
+}
+
+
+def _read_csv(stream):
+    # (line number, rows of one record), the rows are parsed in the workers
+    reader = csv.reader(stream)
+    header = next(reader, None)
+    if header is not None and header != CSV_FIELDS:
+        raise InvalidRecords(
+            [{"line": 1, "errors": {"header": [f"Expected {','.join(CSV_FIELDS)}"]}}]
+        )
+    line = key = None
+    rows = []
+    for row in reader:
+        # Blank lines are ignored like in the NDJSON files
+        if not any(field.strip() for field in row):
+            continue
+        if row[:4] != key or not rows:
+            if rows:
+                yield line, rows
+            line = reader.line_num
+            key = row[:4]
+            rows = []
+        rows.append(row)
+    if rows:
+        yield line, rows
+
+
+def _read_ndjson(stream):
+    # Blank lines are ignored like in NDJSONParser
+    for line_number, line in enumerate(stream, start=1):
+        if line.strip():
+            yield line_number, line
+
+
+READERS = {
+    "csv": _read_csv,
+    "ndjson": _read_ndjson,
+}
+
+
+def _chunks(items, import_format, size):
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield import_format, chunk
+
+
+def _validate_chunk(chunk):
+    # Runs in the pool workers: returns the validated records and the errors
+    # of the others as plain data along with their line number
+    import_format, items = chunk
+    parse = PARSERS[import_format]
+    records = []
+    errors = []
+    for line, payload in items:
+        data, record_errors = parse(payload)
+        if record_errors is None:
+            record, record_errors = validate_record(
+                data, fast=settings.MEASUREMENTS_FAST_VALIDATION
+            )
+        if record_errors is None:
+            records.append(record)
+        else:
+            errors.append(
+                {"line": line, "errors": json.loads(json.dumps(record_errors))}
+            )
+    return records, errors
+
+
+def _validated(chunks, workers):
+    # Validated chunks in file order. With several workers at most two chunks
+    # per worker are in flight, reading stays ahead of the database writes
+    # without loading the whole file.
+    if workers <= 1:
+        for chunk in chunks:
+            yield _validate_chunk(chunk)
+        return
+
+    with multiprocessing.Pool(workers, initializer=django.setup) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_validate_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def import_measurements(
+    stream,
+    import_format,
+    batch_size,
+    workers=1,
+    skip_invalid=False,
+    progress=None,
+    invalid=None,
+):
+    # Validates the records of the text stream with the ingest rules and
+    # stores them batch_size records per transaction. Invalid records raise
+    # InvalidRecords, batches before them stay stored, unless skip_invalid is
+    # set: they are then passed to invalid and the others stored.
+    chunks = _chunks(READERS[import_format](stream), import_format, batch_size)
+    stats = {"records": 0, "measurements": 0, "invalid": 0}
+
+    for records, errors in _validated(chunks, workers):
+        if errors:
+            if not skip_invalid:
+                raise InvalidRecords(errors)
+            stats["invalid"] += len(errors)
+            if invalid is not None:
+                invalid(errors)
+        if records:
+            with sharding.atomic():
+                stats["measurements"] += len(ingest_records(records))
+            stats["records"] += len(records)
+        if progress is not None:
+            progress(stats)
+    return stats
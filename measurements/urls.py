@@ -3,6 +3,14 @@ from . import views
 
 urlpatterns = [
     path("ingest", views.ingest_data, name="ingest_data"),
+    path("ingest/batch", views.ingest_data_batch, name="ingest_data_batch"),
+    path("ingest/async", views.ingest_data_async, name="ingest_data_async"),
+    path("ingest/async/stats", views.ingest_queue_stats, name="ingest_queue_stats"),
     path("data", views.fetch_data_raw, name="fetch_data_raw"),
     path("summary", views.fetch_data_aggregates, name="fetch_data_aggregates"),
+    path("latest", views.fetch_latest, name="fetch_latest"),
+    path("query", views.query_batch, name="query_batch"),
+    path("cache/stats", views.cache_stats, name="cache_stats"),
+    path("metrics", views.export_metrics, name="export_metrics"),
+    path("stream", views.stream_data, name="stream_data"),
 ]
@@ -0,0 +1,98 @@
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import uuid
+
+from .serializers import MEASUREMENT_RANGES, DataRecordRequestSerializer
+
+
+def _float(value):
+    # Numbers as decoded from JSON, anything else is left to FloatField
+    if type(value) is float:
+        return value
+    if type(value) is int:
+        try:
+            return float(value)
+        except OverflowError:
+            return None
+    return None
+
+
+def _datetime(value):
+    # ISO 8601 strings with an offset, DRF handles the naive ones since
+    # making them aware may fail on DST transitions
+    if type(value) is not str:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None or parsed.tzinfo is None:
+            return None
+        return parsed.astimezone(timezone.get_current_timezone())
+    except (ValueError, OverflowError):
+        return None
+
+
+def _fast_validate(data):
+    # Validated data of a DataRecordRequest payload built with plain checks,
+    # None as soon as something does not look like a valid record
+    if type(data) is not dict:
+        return None
+
+    at = _datetime(data.get("at"))
+    if at is None:
+        return None
+
+    datalogger = data.get("datalogger")
+    if type(datalogger) is not str:
+        return None
+    try:
+        datalogger = uuid.UUID(hex=datalogger)
+    except ValueError:
+        return None
+
+    location = data.get("location")
+    if type(location) is not dict:
+        return None
+    lat = _float(location.get("lat"))
+    lng = _float(location.get("lng"))
+    if lat is None or lng is None or lat < 0.0 or lng < 0.0:
+        return None
+
+    measurements = data.get("measurements")
+    if type(measurements) is not list:
+        return None
+    validated = []
+    for measurement in measurements:
+        if type(measurement) is not dict:
+            return None
+        label = measurement.get("label")
+        value = _float(measurement.get("value"))
+        if type(label) is not str or label not in MEASUREMENT_RANGES:
+            return None
+        if value is None:
+            return None
+        _, low, high = MEASUREMENT_RANGES[label]
+        if value < low or value > high:
+            return None
+        validated.append({"label": label, "value": value})
+
+    return {
+        "at": at,
+        "datalogger": datalogger,
+        "location": {"lat": lat, "lng": lng},
+        "measurements": validated,
+    }
+
+
+def validate_record(data, fast=True):
+    # Returns (validated_data, None) or (None, errors), both the same as with
+    # DataRecordRequestSerializer. Valid records take the plain-Python path,
+    # the serializer only runs to describe what is wrong with the others.
+    if fast:
+        validated = _fast_validate(data)
+        if validated is not None:
+            return validated, None
+
+    serializer = DataRecordRequestSerializer(data=data)
+    if serializer.is_valid():
+        return serializer.validated_data, None
+    return None, serializer.errors
@@ -1,42 +1,276 @@
-from django.db.models import Avg, Sum, F, Q
-from django.db.models.functions import TruncDay, TruncHour
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from rest_framework import status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, parser_classes, renderer_classes
+from rest_framework.parsers import JSONParser
+from rest_framework.utils import json
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 import datetime
+import math
 import uuid
 
+from . import (
+    buffering,
+    caching,
+    keys,
+    latest,
+    live,
+    metrics,
+    queries,
+    regions,
+    retention,
+    rollups,
+    sharding,
+)
+from .conditional import conditional
+from .replicas import replicated
+from .downsampling import downsample
+from .ingest import ingest_records
 from .models import Measurement
+from .pagination import (
+    PaginationError,
+    get_page_params,
+    paginate_aggregates,
+    paginate_measurements,
+)
+from .parsers import NDJSONParser
+from .raw import raw_window
+from .renderers import ColumnarRenderer, CSVRenderer, NDJSONRenderer
+from .streaming import STREAM_FORMATS, stream_rows
+from .summary import (
+    aggregate_buckets,
+    aggregate_fleet,
+    aggregate_window,
+    parse_span,
+    parse_stats,
+)
+from .storage import get_storage
+from .validation import validate_record
 from .serializers import (
-    DataRecordRequestSerializer,
     DataRecordResponseSerializer,
     DataRecordAggregateResponseSerializer,
+    DataRecordStatsResponseSerializer,
 )
 
 
+def _parse_datetime(value):
+    # Accept the same formats as filtering a DateTimeField with a string
+    if not value:
+        return None
+    value = Measurement._meta.get_field("recorded_at").to_python(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def _datalogger_id(request, datalogger_uuid):
+    # Already looked up along with the conditional GET validators
+    resolved = getattr(request, "dataloggers", None)
+    if resolved is None:
+        return keys.datalogger_id(datalogger_uuid)
+    return resolved.get(datalogger_uuid)
+
+
+def _datalogger_uuids(request, uuids=None):
+    resolved = getattr(request, "dataloggers", None)
+    if resolved is None:
+        return keys.datalogger_uuids(uuids)
+    return {
+        datalogger_id: datalogger
+        for datalogger, datalogger_id in resolved.items()
+        if uuids is None or datalogger in uuids
+    }
+
+
+def _raw_response(page, datalogger_id, since, before):
+    if page is None:
+        rows = raw_window(datalogger_id, since, before)
+        return Response(DataRecordResponseSerializer(rows, many=True).data)
+
+    def fetch(after, limit):
+        return get_storage().rows(
+            datalogger_id, since, before, after=after, limit=limit
+        )
+
+    rows, next_cursor = paginate_measurements(fetch, *page)
+    return Response(
+        {
+            "next": next_cursor,
+            "results": DataRecordResponseSerializer(rows, many=True).data,
+        }
+    )
+
+
+def _aggregate_serializer(stats):
+    if stats is None:
+        return DataRecordAggregateResponseSerializer
+    return DataRecordStatsResponseSerializer
+
+
+def _fleet_response(
+    request, dataloggers, span, stats, since, before, page, region=None
+):
+    # Aggregates keyed by datalogger uuid, all dataloggers when None or those
+    # that reported from inside the region
+    if span is None:
+        return Response(
+            {"error": "A span parameter is required with several dataloggers"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if page is not None:
+        return Response(
+            {"error": "Pagination is only available for a single datalogger"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    if region is not None:
+        names = regions.datalogger_uuids(**region)
+        results = aggregate_fleet(list(names), span, since, before, stats)
+        requested = sorted(names.values(), key=str)
+    elif dataloggers is None:
+        names = _datalogger_uuids(request)
+        results = aggregate_fleet(None, span, since, before, stats)
+        requested = sorted(names.values(), key=str)
+    else:
+        if len(dataloggers) > settings.MEASUREMENTS_SUMMARY_MAX_DATALOGGERS:
+            return Response(
+                {
+                    "error": "Too many dataloggers, maximum is "
+                    f"{settings.MEASUREMENTS_SUMMARY_MAX_DATALOGGERS}"
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        requested = [uuid.UUID(datalogger) for datalogger in dataloggers]
+        names = _datalogger_uuids(request, requested)
+        results = aggregate_fleet(list(names), span, since, before, stats)
+
+    items = {names[datalogger_id]: rows for datalogger_id, rows in results.items()}
+    serializer_class = _aggregate_serializer(stats)
+    return Response(
+        {
+            str(datalogger): serializer_class(items.get(datalogger, []), many=True).data
+            for datalogger in requested
+        }
+    )
+
+
 @api_view(["POST"])
 def ingest_data(request):
-    serializer = DataRecordRequestSerializer(data=request.data)
+    record, errors = validate_record(
+        request.data, fast=settings.MEASUREMENTS_FAST_VALIDATION
+    )
+
+    if errors is not None:
+        return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-    if not serializer.is_valid():
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    with sharding.atomic():
+        ingest_records([record])
+
+    return Response({}, status=status.HTTP_200_OK)
 
-    data = serializer.validated_data
 
-    for measurement_data in data["measurements"]:
-        Measurement.objects.create(
-            label=measurement_data["label"],
-            value=measurement_data["value"],
-            recorded_at=data["at"],
-            datalogger=data["datalogger"],
-            location=data["location"],
+@api_view(["POST"])
+@parser_classes([JSONParser, NDJSONParser])
+def ingest_data_batch(request):
+    if not isinstance(request.data, list):
+        return Response(
+            {"error": "Expected a list of records"},
+            status=status.HTTP_400_BAD_REQUEST,
         )
 
-    return Response({}, status=status.HTTP_200_OK)
+    if len(request.data) > settings.MEASUREMENTS_BATCH_MAX_RECORDS:
+        return Response(
+            {
+                "error": "Too many records, maximum is "
+                f"{settings.MEASUREMENTS_BATCH_MAX_RECORDS}"
+            },
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    records = []
+    errors = []
+    for index, data in enumerate(request.data):
+        record, record_errors = validate_record(
+            data, fast=settings.MEASUREMENTS_FAST_VALIDATION
+        )
+        if record_errors is None:
+            records.append(record)
+        else:
+            # Report errors along with the index of the faulty record
+            errors.append({"index": index, "errors": record_errors})
+
+    if errors:
+        return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+    # All or nothing: a failure in any chunk rolls the whole batch back
+    with sharding.atomic():
+        measurements = ingest_records(records)
+
+    return Response(
+        {"records": len(records), "measurements": len(measurements)},
+        status=status.HTTP_200_OK,
+    )
+
+
+@csrf_exempt
+@require_POST
+async def ingest_data_async(request):
+    # Plain Django view so it runs on the event loop under ASGI: validation
+    # needs no database and the background writer does the INSERTs
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse(
+            {"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    record, errors = validate_record(data, fast=settings.MEASUREMENTS_FAST_VALIDATION)
+    if errors is not None:
+        return JsonResponse(errors, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        buffering.put(record)
+    except buffering.BufferFull:
+        response = JsonResponse(
+            {"error": "Ingest queue is full, retry later"},
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+        )
+        response["Retry-After"] = "1"
+        return response
+    except buffering.BufferStuck as exc:
+        response = JsonResponse(
+            {"error": "Ingest queue cannot write to the database, retry later"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+        response["Retry-After"] = str(math.ceil(exc.retry_after))
+        return response
+    except buffering.BufferClosed:
+        return JsonResponse(
+            {"error": "Ingest queue is shutting down"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+
+    return JsonResponse({}, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(["GET"])
+def ingest_queue_stats(request):
+    return Response(buffering.stats())
 
 
+@replicated
+@conditional
 @api_view(["GET"])
+@renderer_classes(
+    api_settings.DEFAULT_RENDERER_CLASSES
+    + [NDJSONRenderer, CSVRenderer, ColumnarRenderer]
+)
 def fetch_data_raw(request):
     # Required parameter
     datalogger = request.query_params.get("datalogger")
@@ -47,34 +281,81 @@ def fetch_data_raw(request):
         )
 
     # Optional filters
-    since = request.query_params.get("since")
-    before = request.query_params.get("before", timezone.now().isoformat())
-
     try:
-        datalogger_uuid = uuid.UUID(datalogger)
-
-        queryset = Measurement.objects.filter(datalogger=datalogger_uuid)
+        since = _parse_datetime(request.query_params.get("since"))
+        before = _parse_datetime(
+            request.query_params.get("before", timezone.now().isoformat())
+        )
+    except ValidationError:
+        return Response(
+            {"error": "Invalid since or before parameter"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
 
-        if since:
-            queryset = queryset.filter(recorded_at__gt=since)
+    # Optional downsampling, at most max_points readings per label
+    max_points = request.query_params.get("max_points")
+    if max_points is not None:
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            max_points = 0
+        if not 3 <= max_points <= settings.MEASUREMENTS_MAX_POINTS:
+            return Response(
+                {"error": "Invalid max_points parameter"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        if before:
-            queryset = queryset.filter(recorded_at__lt=before)
+    try:
+        page = get_page_params(request)
+        if page is not None and max_points is not None:
+            return Response(
+                {"error": "max_points cannot be combined with pagination"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        datalogger_id = _datalogger_id(request, uuid.UUID(datalogger))
+
+        def stream():
+            chunk_size = settings.MEASUREMENTS_STREAM_CHUNK_SIZE
+            if max_points is None:
+                return get_storage().stream(datalogger_id, since, before, chunk_size)
+            return downsample(datalogger_id, since, before, max_points, chunk_size)
+
+        stream_format = request.accepted_renderer.format
+        if page is not None and (
+            stream_format == ColumnarRenderer.format or stream_format in STREAM_FORMATS
+        ):
+            # Streamed and columnar responses hold the whole window
+            return Response(
+                {"error": f"Pagination is not supported with format {stream_format}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        data = []
-        for measurement in queryset:
-            data.append(
-                {
-                    "label": measurement.label,
-                    "recorded_at": measurement.recorded_at.isoformat(),
-                    "value": measurement.value,
-                }
+        if stream_format == ColumnarRenderer.format:
+            # Rows go straight from the database cursor into the column
+            # arrays, the renderer writes them out as a single buffer
+            return Response(stream())
+
+        if stream_format in STREAM_FORMATS:
+            # Rows are fetched and written chunk by chunk, nothing is
+            # materialized so memory does not depend on the window size
+            return StreamingHttpResponse(
+                stream_rows(
+                    stream(), stream_format, settings.MEASUREMENTS_STREAM_CHUNK_SIZE
+                ),
+                content_type=request.accepted_renderer.media_type,
             )
 
-        serializer = DataRecordResponseSerializer(data=data, many=True)
-        serializer.is_valid()
-        return Response(serializer.data)
+        if max_points is not None:
+            rows = [
+                {"label": label, "recorded_at": recorded_at, "value": value}
+                for label, recorded_at, value in stream()
+            ]
+            return Response(DataRecordResponseSerializer(rows, many=True).data)
 
+        return _raw_response(page, datalogger_id, since, before)
+
+    except PaginationError as exc:
+        return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
     except ValueError:
         return Response(
             {"error": "Invalid datalogger ID format"},
@@ -82,90 +363,259 @@ def fetch_data_raw(request):
         )
 
 
+@replicated
+@conditional
 @api_view(["GET"])
 def fetch_data_aggregates(request):
-    # Required parameter
-    datalogger = request.query_params.get("datalogger")
-    if not datalogger:
+    # Required parameter, several dataloggers are given as repeated or comma
+    # separated values, fleet=true selects all of them and a bbox or a list
+    # of grid cells those that reported from inside the region
+    dataloggers = [
+        value
+        for param in request.query_params.getlist("datalogger")
+        for value in param.split(",")
+        if value
+    ]
+    fleet = request.query_params.get("fleet") in ["1", "true"]
+    region = None
+    for name, parse in [("bbox", regions.parse_bbox), ("cells", regions.parse_cells)]:
+        value = request.query_params.get(name)
+        if value is None:
+            continue
+        if region is not None or dataloggers or fleet:
+            return Response(
+                {"error": "Only one of datalogger, fleet, bbox and cells can be given"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            region = {name: parse(value)}
+        except ValueError as exc:
+            return Response(
+                {"error": f"Invalid {name} parameter: {exc}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+    if not dataloggers and not fleet and region is None:
         return Response(
             {"error": "Missing required datalogger parameter"},
             status=status.HTTP_400_BAD_REQUEST,
         )
 
     # Optional filters
-    since = request.query_params.get("since")
-    before = request.query_params.get("before", timezone.now().isoformat())
+    try:
+        since = _parse_datetime(request.query_params.get("since"))
+        before = _parse_datetime(
+            request.query_params.get("before", timezone.now().isoformat())
+        )
+    except ValidationError:
+        return Response(
+            {"error": "Invalid since or before parameter"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
     span = request.query_params.get("span")
+    if span is not None:
+        try:
+            parse_span(span)
+        except ValueError:
+            return Response(
+                {"error": "Invalid span parameter"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+    stats = request.query_params.get("stats")
+    if stats is not None:
+        try:
+            stats = parse_stats(stats)
+        except ValueError:
+            return Response(
+                {"error": "Invalid stats parameter"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if span is None:
+            return Response(
+                {"error": "The stats parameter requires a span"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
     try:
-        datalogger_uuid = uuid.UUID(datalogger)
-
-        queryset = Measurement.objects.filter(datalogger=datalogger_uuid)
-
-        if since:
-            queryset = queryset.filter(recorded_at__gt=since)
+        page = get_page_params(request)
+        if fleet or region is not None or len(dataloggers) > 1:
+            return _fleet_response(
+                request,
+                None if fleet else dataloggers,
+                span,
+                stats,
+                since,
+                before,
+                page,
+                region,
+            )
 
-        if before:
-            queryset = queryset.filter(recorded_at__lt=before)
+        datalogger_id = _datalogger_id(request, uuid.UUID(dataloggers[0]))
 
         if span is None:
-            data = []
-            for measurement in queryset:
-                data.append(
-                    {
-                        "label": measurement.label,
-                        "recorded_at": measurement.recorded_at.isoformat(),
-                        "value": measurement.value,
-                    }
+            # The readings, which compaction removes
+            retention.check([datalogger_id], since)
+            return _raw_response(page, datalogger_id, since, before)
+
+        # Hour and day buckets are served from the rollups, other spans are
+        # grouped in SQL from the raw readings
+        def aggregate(after=None):
+            if span in rollups.SPAN_WIDTHS:
+                return aggregate_window(
+                    datalogger_id, span, since, before, after, stats
                 )
+            return aggregate_buckets([datalogger_id], span, since, before, stats, after)
 
-            serializer = DataRecordResponseSerializer(data=data, many=True)
-            serializer.is_valid()
+        serializer_class = _aggregate_serializer(stats)
+        if page is None:
+            serializer = serializer_class(aggregate(), many=True)
             return Response(serializer.data)
 
-        result = []
+        result, next_cursor = paginate_aggregates(aggregate, *page)
+        serializer = serializer_class(result, many=True)
+        return Response({"next": next_cursor, "results": serializer.data})
 
-        # Group by time slot according to span
-        if span == "day":
-            date_trunc = "day"
-        elif span == "hour":
-            date_trunc = "hour"
-        else:
-            return Response(
-                {"error": "Invalid span parameter"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+    except (PaginationError, retention.Compacted) as exc:
+        return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+    except ValueError:
+        return Response(
+            {"error": "Invalid datalogger ID format"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+
+@replicated
+@api_view(["GET"])
+def fetch_latest(request):
+    # Latest reading of each label of one or several dataloggers, given as
+    # repeated or comma separated values, keyed by datalogger uuid. Served
+    # from memory once looked up, no query to the readings.
+    dataloggers = [
+        value
+        for param in request.query_params.getlist("datalogger")
+        for value in param.split(",")
+        if value
+    ]
+    if not dataloggers:
+        return Response(
+            {"error": "Missing required datalogger parameter"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if len(dataloggers) > settings.MEASUREMENTS_SUMMARY_MAX_DATALOGGERS:
+        return Response(
+            {
+                "error": "Too many dataloggers, maximum is "
+                f"{settings.MEASUREMENTS_SUMMARY_MAX_DATALOGGERS}"
+            },
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    try:
+        requested = list(dict.fromkeys(uuid.UUID(value) for value in dataloggers))
+    except ValueError:
+        return Response(
+            {"error": "Invalid datalogger ID format"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
 
-        if span == "day":
-            queryset = queryset.annotate(time_slot=TruncDay("recorded_at"))
-        else:  # hour
-            queryset = queryset.annotate(time_slot=TruncHour("recorded_at"))
+    datalogger_ids = {
+        datalogger: keys.datalogger_id(datalogger) for datalogger in requested
+    }
+    found = latest.readings(
+        [datalogger_id for datalogger_id in datalogger_ids.values() if datalogger_id]
+    )
+    return Response(
+        {
+            str(datalogger): DataRecordResponseSerializer(
+                found.get(datalogger_id, []), many=True
+            ).data
+            for datalogger, datalogger_id in datalogger_ids.items()
+        }
+    )
 
-        # Group by time_slot and apply the appropriate aggregation
-        # Mean for temp and hum, Sum for rain
-        group_queryset = queryset.values("time_slot", "label")
-        temp = Avg("value", filter=Q(label="temp"))
-        hum = Avg("value", filter=Q(label="hum"))
-        rain = Sum("value", filter=Q(label="rain"))
-        group_queryset = (
-            group_queryset.annotate(temp=temp).annotate(hum=hum).annotate(rain=rain)
+
+@api_view(["POST"])
+def query_batch(request):
+    # Several /api/data and /api/summary queries in a single request, given
+    # as a list of {"path", "params"} specs and answered with the status and
+    # body of each
+    if not isinstance(request.data, list) or not request.data:
+        return Response(
+            {"error": "Expected a non-empty list of query specs"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if len(request.data) > settings.MEASUREMENTS_QUERY_MAX_SPECS:
+        return Response(
+            {
+                "error": "Too many query specs, maximum is "
+                f"{settings.MEASUREMENTS_QUERY_MAX_SPECS}"
+            },
+            status=status.HTTP_400_BAD_REQUEST,
         )
+    return Response({"results": queries.run(request, request.data)})
+
+
+@api_view(["GET"])
+def cache_stats(request):
+    return Response(caching.stats())
 
-        for item in group_queryset:
-            result.append(
-                {
-                    "label": item["label"],
-                    "time_slot": item["time_slot"].isoformat(),
-                    "value": item[item["label"]],
-                }
-            )
 
-        serializer = DataRecordAggregateResponseSerializer(data=result, many=True)
-        serializer.is_valid()
-        return Response(serializer.data)
+@require_GET
+def export_metrics(request):
+    # Plain Django view, Prometheus scrapers expect text rather than JSON
+    return HttpResponse(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
+
+@require_GET
+async def stream_data(request):
+    # Server-sent events of the readings of a datalogger as ingest commits
+    # them. Plain Django view so idle streams only hold a coroutine under
+    # ASGI; Last-Event-ID, or since on the first connection, replays the
+    # stored readings recorded after it.
+    datalogger = request.GET.get("datalogger")
+    if not datalogger:
+        return JsonResponse(
+            {"error": "Missing required datalogger parameter"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    try:
+        datalogger = uuid.UUID(datalogger)
     except ValueError:
-        return Response(
+        return JsonResponse(
             {"error": "Invalid datalogger ID format"},
             status=status.HTTP_400_BAD_REQUEST,
         )
+    try:
+        since = _parse_datetime(
+            request.headers.get("Last-Event-ID") or request.GET.get("since")
+        )
+    except ValidationError:
+        return JsonResponse(
+            {"error": "Invalid since parameter or Last-Event-ID"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    datalogger_id = await sync_to_async(keys.datalogger_id)(datalogger)
+    if datalogger_id is None:
+        return JsonResponse(
+            {"error": "Unknown datalogger"}, status=status.HTTP_404_NOT_FOUND
+        )
+    # The subscription is taken here so a full server answers 503 rather than
+    # a broken stream
+    try:
+        subscription = live.subscribe(datalogger_id)
+    except live.TooManySubscribers:
+        response = JsonResponse(
+            {"error": "Too many subscribers, retry later"},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+        response["Retry-After"] = "5"
+        return response
+
+    response = StreamingHttpResponse(
+        live.Stream(subscription, since), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    # Proxies must not buffer the events
+    response["X-Accel-Buffering"] = "no"
+    return response
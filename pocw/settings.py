@@ -25,6 +25,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "measurements.metrics.MetricsMiddleware",
+    "measurements.replicas.ReplicaMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -55,12 +57,56 @@ TEMPLATES = [
 WSGI_APPLICATION = "pocw.wsgi.application"
 
 # Database
+# Transactions take the write lock when they start: ingest looks up the
+# readings already stored before inserting the others, a concurrent one
+# cannot store them in between, nor fail to upgrade its lock.
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {"transaction_mode": "IMMEDIATE"},
     }
 }
+# Shard databases, only opened when listed in MEASUREMENTS_SHARDS, in the
+# same transaction mode
+for shard in range(8):
+    DATABASES[f"shard{shard}"] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / f"shard{shard}.sqlite3",
+        "OPTIONS": {"transaction_mode": "IMMEDIATE"},
+    }
+# Read-only copies of the default and shard databases, refreshed by
+# sync_replicas, only read when listed in MEASUREMENTS_REPLICAS
+for alias in list(DATABASES):
+    for replica in range(2):
+        DATABASES[f"{alias}_replica{replica}"] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / f"{alias}_replica{replica}.sqlite3",
+        }
+DATABASE_ROUTERS = [
+    "measurements.replicas.ReplicaRouter",
+    "measurements.sharding.ShardRouter",
+]
+
+# Cache
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Blocks of the read cache, in memory of each process unless
+    # POCW_CACHE_DIR gives a directory shared by the processes of a server
+    "measurements": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "measurements",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+}
+if os.environ.get("POCW_CACHE_DIR"):
+    CACHES["measurements"].update(
+        BACKEND="django.core.cache.backends.filebased.FileBasedCache",
+        LOCATION=os.environ["POCW_CACHE_DIR"],
+    )
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -99,3 +145,104 @@ REST_FRAMEWORK = {
         "rest_framework.renderers.JSONRenderer",
     ],
 }
+
+# Measurements settings
+# Number of rows sent per INSERT statement by bulk ingestion paths
+MEASUREMENTS_BULK_BATCH_SIZE = 500
+# Maximum number of records accepted by a single batch ingest request
+MEASUREMENTS_BATCH_MAX_RECORDS = 10000
+# Number of records stored per transaction by the import_measurements command
+MEASUREMENTS_IMPORT_BATCH_SIZE = 5000
+# Number of rows fetched from the database per round trip when streaming
+MEASUREMENTS_STREAM_CHUNK_SIZE = 2000
+# Maximum number of readings per label accepted by /api/data?max_points=
+MEASUREMENTS_MAX_POINTS = 10000
+# Default and maximum number of items per page on paginated read endpoints
+MEASUREMENTS_PAGE_SIZE = 100
+MEASUREMENTS_MAX_PAGE_SIZE = 1000
+# Maximum number of dataloggers listed in a single /api/summary request
+MEASUREMENTS_SUMMARY_MAX_DATALOGGERS = 500
+# Maximum number of grid cells of a /api/summary region
+MEASUREMENTS_REGION_MAX_CELLS = 1000
+# Age in days after which raw readings are deleted by the compact command,
+# None keeps them forever. Older periods of /api/summary?span=hour|day are
+# served in whole buckets from the rollups. Keep it set once compacted, reads
+# only look for compacted periods with it.
+MEASUREMENTS_RAW_RETENTION_DAYS = None
+# Number of raw rows deleted per transaction by the compact command
+MEASUREMENTS_COMPACT_CHUNK_SIZE = 5000
+# Cache holding closed time blocks of /api/data and /api/summary results
+MEASUREMENTS_CACHE_ENABLED = True
+MEASUREMENTS_CACHE_ALIAS = "measurements"
+# Lifetime in seconds of blocks that can still receive readings
+MEASUREMENTS_CACHE_OPEN_TIMEOUT = 10
+# Lifetime in seconds of past blocks. A late upload drops its blocks from the
+# cache of the process storing it, the other processes of a per-process cache
+# serve theirs until they expire.
+MEASUREMENTS_CACHE_CLOSED_TIMEOUT = 600
+# Per-endpoint latency, SQL and rendering counters exposed at /api/metrics
+MEASUREMENTS_METRICS_ENABLED = True
+# Log requests slower than this many seconds with their SQL, None disables it
+MEASUREMENTS_SLOW_REQUEST_SECONDS = None
+# Number of datalogger and location ids kept in memory by ingest
+MEASUREMENTS_KEY_CACHE_SIZE = 100000
+# Number of dataloggers whose latest readings /api/latest keeps in memory,
+# and seconds before an entry is read again: other processes storing
+# readings do not drop the entries of this one
+MEASUREMENTS_LATEST_CACHE_SIZE = 10000
+MEASUREMENTS_LATEST_CACHE_TIMEOUT = 5
+# Specs accepted by a /api/query batch, and threads running the queries of
+# the batches of a process concurrently
+MEASUREMENTS_QUERY_MAX_SPECS = 100
+MEASUREMENTS_QUERY_WORKERS = 4
+# Layout of raw readings: "narrow" stores one Measurement row per label,
+# "wide" one MeasurementRecord row per record (see convert_storage)
+MEASUREMENTS_STORAGE = "narrow"
+# Databases raw readings and rollups are spread over by a hash of their
+# datalogger, each with its own write lock. POCW_SHARDS=N uses the first N
+# shard databases, none keeps them in the default one. Dataloggers and
+# locations stay in the default database and are copied to every shard.
+# Changing the list requires a rebalance_shards run.
+MEASUREMENTS_SHARDS = [
+    f"shard{shard}" for shard in range(int(os.environ.get("POCW_SHARDS", 0)))
+]
+# Replicas of each database holding readings, GET requests to /api/data and
+# /api/summary read one of them. POCW_REPLICAS=N uses the first N replicas
+# of the default database and of each shard, none reads the primaries.
+# Read-your-writes needs a cache shared by the processes, see POCW_CACHE_DIR.
+MEASUREMENTS_REPLICAS = {
+    alias: [
+        f"{alias}_replica{replica}"
+        for replica in range(int(os.environ["POCW_REPLICAS"]))
+    ]
+    for alias in ["default", *MEASUREMENTS_SHARDS]
+    if int(os.environ.get("POCW_REPLICAS", 0))
+}
+# Seconds reads of a datalogger stay on the primary databases after it was
+# written, to be longer than the delay of the replicas. 0 always reads them.
+MEASUREMENTS_READ_YOUR_WRITES_SECONDS = 5
+# Validate ingested records with plain-Python checks, the DRF serializer only
+# runs for invalid records to report their errors
+MEASUREMENTS_FAST_VALIDATION = True
+# Buffered ingest (/api/ingest/async): records waiting for the background
+# writer, records per INSERT transaction and maximum wait in seconds before
+# a partial batch is written
+MEASUREMENTS_INGEST_QUEUE_SIZE = 10000
+MEASUREMENTS_INGEST_QUEUE_BATCH_SIZE = 500
+MEASUREMENTS_INGEST_QUEUE_FLUSH_INTERVAL = 0.5
+# Start the writer thread on the first buffered record, when disabled the
+# queue is only written by buffering.flush() and buffering.shutdown()
+MEASUREMENTS_INGEST_QUEUE_WRITER = True
+# Seconds shutdown keeps retrying a batch the database refuses before the
+# records left are dropped and counted as failed
+MEASUREMENTS_INGEST_QUEUE_SHUTDOWN_TIMEOUT = 60
+# Answer the read endpoints with ETag and Last-Modified validators and 304
+# Not Modified to conditional requests
+MEASUREMENTS_CONDITIONAL_GET = True
+# Events buffered per /api/stream subscriber, a subscriber falling further
+# behind is disconnected and resumes from its Last-Event-ID
+MEASUREMENTS_LIVE_BUFFER_SIZE = 256
+# Open /api/stream subscriptions per process
+MEASUREMENTS_LIVE_MAX_SUBSCRIBERS = 10000
+# Seconds between keepalive comments on idle /api/stream connections
+MEASUREMENTS_LIVE_KEEPALIVE = 15
@@ -0,0 +1,81 @@
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+import io
+from unittest import mock
+
+from measurements.bench import (
+    BenchError,
+    bench_ingest,
+    bench_storage,
+    bench_suite,
+    bench_validation,
+    synthetic_records,
+)
+from measurements.models import Measurement
+
+
+class BenchTests(TestCase):
+    def test_synthetic_records_are_deterministic(self):
+        first = list(synthetic_records(3, 10, seed=4))
+        second = list(synthetic_records(3, 10, seed=4))
+
+        self.assertEqual(first, second)
+        self.assertEqual(len({record["datalogger"] for record in first}), 3)
+
+    def test_bench_ingest(self):
+        result = bench_ingest(count=20, batch_size=8, dataloggers=2)
+
+        self.assertEqual(result["records"], 20)
+        self.assertGreater(result["batch"]["records_per_second"], 0)
+        self.assertEqual(Measurement.objects.count(), 2 * 20 * 3)
+
+    def test_bench_storage(self):
+        result = bench_storage(count=30, dataloggers=3, repeat=1)
+
+        self.assertEqual(result["narrow"]["rows"], 30 * 3)
+        self.assertEqual(result["wide"]["rows"], 30)
+        self.assertGreater(result["wide"]["table_bytes"], 0)
+        self.assertIn("summary_day", result["wide"]["latency_ms"])
+        self.assertEqual(Measurement.objects.count(), 0)
+
+    def test_bench_suite(self):
+        result = bench_suite(
+            dataloggers=2, days=[2, 1], interval=3600, ingest_records=5, repeat=3
+        )
+
+        self.assertEqual([size["days"] for size in result["sizes"]], [1, 2])
+        self.assertEqual([size["records"] for size in result["sizes"]], [48, 96])
+        self.assertEqual(result["sizes"][0]["ingest"]["records"], 5)
+        self.assertEqual(Measurement.objects.count(), 96 * 3)
+        latency = result["sizes"][1]["latency_ms"]["summary_day"]
+        self.assertLessEqual(latency["p50"], latency["p99"])
+
+    def test_bench_validation(self):
+        result = bench_validation(count=20, dataloggers=2)
+
+        self.assertEqual(result["records"], 20)
+        self.assertGreater(result["fast"]["us_per_record"], 0)
+        self.assertGreater(result["serializer"]["us_per_record"], 0)
+
+    def test_command_scenarios(self):
+        out = io.StringIO()
+        call_command("bench", "validation", records=20, dataloggers=2, stdout=out)
+        self.assertIn("speedup", out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command("bench", "nope")
+
+    def test_failed_request(self):
+        # Reported with the status and body of the response
+        records = [{"datalogger": "logger"}]
+        with mock.patch("measurements.bench.synthetic_records", return_value=records):
+            with self.assertRaisesRegex(BenchError, "answered 400: .*datalogger"):
+                bench_ingest(count=1, batch_size=1, dataloggers=1)
+
+        errors = {"measurements": ["This field is required."]}
+        with mock.patch(
+            "measurements.bench.validate_record", return_value=(None, errors)
+        ):
+            with self.assertRaisesRegex(CommandError, "Invalid synthetic record"):
+                call_command("bench", "validation", records=1, stdout=io.StringIO())
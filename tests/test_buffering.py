@@ -0,0 +1,230 @@
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import json
+from unittest import mock
+
+from measurements import buffering, keys
+from measurements.ingest import ingest_records
+from measurements.bench import synthetic_records
+from measurements.models import Measurement
+
+
+@override_settings(MEASUREMENTS_INGEST_QUEUE_WRITER=False)
+class BufferingTests(TestCase):
+    def setUp(self):
+        buffering.reset()
+        self.addCleanup(buffering.reset)
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.records = list(synthetic_records(2, 10, seed=9))
+
+    def post(self, record):
+        return self.client.post(reverse("ingest_data_async"), record, format="json")
+
+    def test_records_are_written_in_batches(self):
+        for record in self.records:
+            response = self.post(record)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        # Nothing is written before the queue is drained
+        self.assertEqual(Measurement.objects.count(), 0)
+        self.assertEqual(buffering.stats()["depth"], 10)
+
+        with self.settings(MEASUREMENTS_INGEST_QUEUE_BATCH_SIZE=4):
+            self.assertEqual(buffering.flush(), 10)
+
+        self.assertEqual(
+            Measurement.objects.count(),
+            sum(len(record["measurements"]) for record in self.records),
+        )
+        stats = self.client.get(reverse("ingest_queue_stats")).data
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["accepted"], 10)
+        self.assertEqual(stats["written"], 10)
+        self.assertEqual(stats["batches"], 3)
+        self.assertEqual(stats["last_batch_size"], 2)
+        self.assertGreaterEqual(stats["max_flush_latency"], 0)
+
+    def test_full_queue_applies_backpressure(self):
+        with self.settings(MEASUREMENTS_INGEST_QUEUE_SIZE=2):
+            buffering.reset()
+            self.assertEqual(
+                self.post(self.records[0]).status_code, status.HTTP_202_ACCEPTED
+            )
+            self.assertEqual(
+                self.post(self.records[1]).status_code, status.HTTP_202_ACCEPTED
+            )
+            response = self.post(self.records[2])
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response["Retry-After"], "1")
+
+            buffering.flush()
+            self.assertEqual(
+                self.post(self.records[2]).status_code, status.HTTP_202_ACCEPTED
+            )
+            self.assertEqual(buffering.stats()["rejected"], 1)
+
+    def test_invalid_records_are_rejected(self):
+        record = dict(self.records[0], measurements=[{"label": "temp", "value": 99}])
+        response = self.post(record)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("measurements", json.loads(response.content))
+
+        response = self.client.post(
+            reverse("ingest_data_async"), "{not json", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(buffering.stats()["depth"], 0)
+
+    def test_failed_batch_is_kept(self):
+        # A batch the database refuses stays at the head of the queue, records
+        # are refused meanwhile rather than lost
+        for record in self.records[:4]:
+            self.post(record)
+        locked = OperationalError("database is locked")
+        with self.settings(MEASUREMENTS_INGEST_QUEUE_BATCH_SIZE=2), mock.patch.object(
+            buffering, "ingest_records", side_effect=locked
+        ), mock.patch("time.sleep") as sleep:
+            self.assertEqual(buffering.flush(), 0)
+            self.assertEqual(sleep.call_count, buffering.WRITE_ATTEMPTS - 1)
+        stats = buffering.stats()
+        self.assertEqual((stats["depth"], stats["stuck"], stats["failed"]), (4, 2, 0))
+        self.assertEqual(Measurement.objects.count(), 0)
+
+        response = self.post(self.records[4])
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response["Retry-After"], "1")
+
+        with self.settings(MEASUREMENTS_INGEST_QUEUE_BATCH_SIZE=2):
+            self.assertEqual(buffering.flush(), 4)
+        self.assertEqual(
+            Measurement.objects.count(),
+            sum(len(record["measurements"]) for record in self.records[:4]),
+        )
+        self.assertEqual(buffering.stats()["stuck"], 0)
+        self.assertEqual(
+            self.post(self.records[4]).status_code, status.HTTP_202_ACCEPTED
+        )
+
+    def test_shutdown_drains_queue(self):
+        for record in self.records:
+            self.post(record)
+
+        buffering.shutdown()
+        self.assertEqual(buffering.stats()["written"], 10)
+        self.assertEqual(
+            self.post(self.records[0]).status_code,
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+
+    def test_shutdown_gives_up(self):
+        # A batch the database keeps refusing does not hold shutdown forever
+        for record in self.records[:4]:
+            self.post(record)
+        locked = OperationalError("database is locked")
+        with self.settings(
+            MEASUREMENTS_INGEST_QUEUE_BATCH_SIZE=2,
+            MEASUREMENTS_INGEST_QUEUE_SHUTDOWN_TIMEOUT=0,
+        ), mock.patch.object(
+            buffering, "ingest_records", side_effect=locked
+        ), mock.patch(
+            "time.sleep"
+        ), self.assertLogs(
+            "measurements.buffering", "ERROR"
+        ) as logs:
+            buffering.shutdown()
+
+        stats = buffering.stats()
+        self.assertEqual((stats["depth"], stats["stuck"], stats["failed"]), (0, 0, 4))
+        self.assertIn("Giving up on 4 buffered records", logs.output[-1])
+        self.assertEqual(Measurement.objects.count(), 0)
+
+
+class BufferingWriterTests(TransactionTestCase):
+    def setUp(self):
+        buffering.reset()
+        self.addCleanup(buffering.reset)
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+
+    def test_writer_thread_drains_queue_on_shutdown(self):
+        records = list(synthetic_records(3, 4, seed=2))
+        for record in records:
+            response = self.client.post(
+                reverse("ingest_data_async"), record, format="json"
+            )
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        buffering.shutdown()
+        self.assertEqual(buffering.stats()["written"], len(records))
+        self.assertEqual(
+            Measurement.objects.count(),
+            sum(len(record["measurements"]) for record in records),
+        )
+
+    def test_writer_retries_failed_batch(self):
+        # The writer backs off and retries until the batch is written,
+        # shutdown included
+        records = list(synthetic_records(3, 4, seed=2))
+        failures = [OperationalError("database is locked")] * (
+            2 * buffering.WRITE_ATTEMPTS
+        )
+
+        def write(batch):
+            if failures:
+                raise failures.pop()
+            return ingest_records(batch)
+
+        with mock.patch.object(
+            buffering, "ingest_records", side_effect=write
+        ), mock.patch.object(
+            buffering, "_back_off", wraps=buffering._back_off
+        ) as back_off, mock.patch(
+            "time.sleep"
+        ) as sleep:
+            for record in records:
+                response = self.client.post(
+                    reverse("ingest_data_async"), record, format="json"
+                )
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            buffering.shutdown()
+
+        self.assertEqual(buffering.stats()["written"], len(records))
+        self.assertEqual(
+            Measurement.objects.count(),
+            sum(len(record["measurements"]) for record in records),
+        )
+        # One delay after each failed round, doubling
+        self.assertEqual(back_off.call_count, 2)
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertEqual(
+            delays[buffering.WRITE_ATTEMPTS - 1 :: buffering.WRITE_ATTEMPTS],
+            [buffering.RETRY_DELAY, 2 * buffering.RETRY_DELAY],
+        )
+
+    # The writer takes a single batch once every record was accepted
+    @override_settings(
+        MEASUREMENTS_INGEST_QUEUE_SHUTDOWN_TIMEOUT=0,
+        MEASUREMENTS_INGEST_QUEUE_BATCH_SIZE=4,
+        MEASUREMENTS_INGEST_QUEUE_FLUSH_INTERVAL=2,
+    )
+    def test_writer_gives_up_on_shutdown(self):
+        records = list(synthetic_records(3, 4, seed=2))
+        locked = OperationalError("database is locked")
+        with mock.patch.object(
+            buffering, "ingest_records", side_effect=locked
+        ), mock.patch("time.sleep"), self.assertLogs("measurements.buffering", "ERROR"):
+            for record in records:
+                response = self.client.post(
+                    reverse("ingest_data_async"), record, format="json"
+                )
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            buffering.shutdown()
+
+        stats = buffering.stats()
+        self.assertEqual((stats["depth"], stats["written"]), (0, 0))
+        self.assertEqual(stats["failed"], len(records))
@@ -0,0 +1,204 @@
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import tempfile
+import time
+import uuid
+from unittest import mock
+
+from measurements import caching, keys
+from measurements.bench import synthetic_records
+
+
+class CachingMixin:
+    def setUp(self):
+        caching.get_cache().clear()
+        caching.reset_stats()
+        # ingest() runs on_commit callbacks, which remember ids of rows that
+        # the test rollback removes
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+        # One record every 20 minutes over 3 days
+        self.records = list(
+            synthetic_records(1, 216, start=self.start, interval=1200, seed=5)
+        )
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.datalogger = uuid.UUID(self.records[0]["datalogger"])
+        self.params = {
+            "datalogger": str(self.datalogger),
+            "since": (self.start - datetime.timedelta(days=1)).isoformat(),
+            "before": (self.start + datetime.timedelta(days=4)).isoformat(),
+        }
+
+    def ingest(self, at, value):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("ingest_data"),
+                {
+                    "at": at.isoformat(),
+                    "datalogger": str(self.datalogger),
+                    "location": {"lat": 1, "lng": 1},
+                    "measurements": [{"label": "temp", "value": value}],
+                },
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class CachingTests(CachingMixin, TestCase):
+    def test_summary_cache(self):
+        url = reverse("fetch_data_aggregates")
+        params = dict(self.params, span="hour")
+
+        first = self.client.get(url, params)
+        self.assertEqual(caching.stats()["hour"], {"hits": 0, "misses": 4})
+        second = self.client.get(url, params)
+        self.assertEqual(caching.stats()["hour"], {"hits": 4, "misses": 4})
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(len(first.data), 72 * 3)
+
+        # A late reading only drops the block it belongs to
+        at = self.start + datetime.timedelta(days=1, hours=5, minutes=1)
+        self.ingest(at, -15)
+        caching.reset_stats()
+        third = self.client.get(url, params)
+        self.assertEqual(caching.stats()["hour"], {"hits": 3, "misses": 1})
+        updated = [
+            item
+            for item in third.data
+            if item["time_slot"] == "2024-05-02T05:00:00Z" and item["label"] == "temp"
+        ]
+        expected = [
+            item
+            for item in first.data
+            if item["time_slot"] == "2024-05-02T05:00:00Z" and item["label"] == "temp"
+        ]
+        self.assertNotEqual(updated, expected)
+
+        # Daily summaries use their own blocks
+        response = self.client.get(url, dict(params, span="day"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 3 * 3)
+
+    def test_raw_data_cache(self):
+        url = reverse("fetch_data_raw")
+
+        first = self.client.get(url, self.params)
+        self.assertEqual(len(first.data), 216 * 3)
+        self.assertEqual(caching.stats()["data"], {"hits": 0, "misses": 24 * 5 - 1})
+        second = self.client.get(url, self.params)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(caching.stats()["data"]["hits"], 24 * 5 - 1)
+
+        self.ingest(self.start + datetime.timedelta(hours=2, minutes=30), 12)
+        caching.reset_stats()
+        third = self.client.get(url, self.params)
+        self.assertEqual(len(third.data), 216 * 3 + 1)
+        self.assertEqual(caching.stats()["data"]["misses"], 1)
+
+        # Unbounded windows start and stop at the stored readings
+        response = self.client.get(
+            url, {"datalogger": str(self.datalogger), "before": ""}
+        )
+        self.assertEqual(response.data, third.data)
+
+    def test_open_blocks_expire(self):
+        url = reverse("fetch_data_raw")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        params = {
+            "datalogger": str(self.datalogger),
+            "since": (now - datetime.timedelta(hours=3)).isoformat(),
+            "before": (now + datetime.timedelta(hours=3)).isoformat(),
+        }
+
+        with self.settings(MEASUREMENTS_CACHE_OPEN_TIMEOUT=0):
+            self.client.get(url, params)
+            self.client.get(url, params)
+        # The two past blocks are reused, the current and future ones are not
+        self.assertEqual(caching.stats()["data"], {"hits": 2, "misses": 8})
+
+    def test_cache_disabled(self):
+        with self.settings(MEASUREMENTS_CACHE_ENABLED=False):
+            first = self.client.get(reverse("fetch_data_raw"), self.params)
+            second = self.client.get(
+                reverse("fetch_data_aggregates"), dict(self.params, span="day")
+            )
+        self.assertEqual(len(first.data), 216 * 3)
+        self.assertEqual(len(second.data), 3 * 3)
+        self.assertEqual(
+            caching.stats(),
+            {kind: {"hits": 0, "misses": 0} for kind in ["data", "hour", "day"]},
+        )
+
+    def test_cache_stats(self):
+        self.client.get(reverse("fetch_data_raw"), self.params)
+        response = self.client.get(reverse("cache_stats"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["data"]["misses"], 24 * 5 - 1)
+
+
+def worker_caches(backend, location=None):
+    # Measurements caches of two processes of a server
+    return {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        **{
+            worker: {
+                "BACKEND": backend,
+                "LOCATION": location or worker,
+                "TIMEOUT": None,
+            }
+            for worker in ["worker0", "worker1"]
+        },
+    }
+
+
+class WorkerCachingTests(CachingMixin, TestCase):
+    # A late upload stored by one process, read by another one
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        super().setUp()
+
+    def summaries(self, worker):
+        with self.settings(MEASUREMENTS_CACHE_ALIAS=worker):
+            response = self.client.get(
+                reverse("fetch_data_aggregates"), dict(self.params, span="hour")
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def late_upload(self):
+        with self.settings(MEASUREMENTS_CACHE_ALIAS="worker0"):
+            self.ingest(self.start + datetime.timedelta(hours=5, minutes=1), -15)
+
+    def test_per_process_caches(self):
+        with override_settings(
+            CACHES=worker_caches("django.core.cache.backends.locmem.LocMemCache")
+        ):
+            cached = self.summaries("worker1")
+            self.late_upload()
+            self.assertNotEqual(self.summaries("worker0"), cached)
+            # Served from the blocks of the other process until they expire
+            self.assertEqual(self.summaries("worker1"), cached)
+            expired = time.time() + settings.MEASUREMENTS_CACHE_CLOSED_TIMEOUT + 1
+            with mock.patch("time.time", return_value=expired):
+                self.assertEqual(self.summaries("worker1"), self.summaries("worker0"))
+
+    def test_shared_cache(self):
+        with override_settings(
+            CACHES=worker_caches(
+                "django.core.cache.backends.filebased.FileBasedCache", self.directory
+            )
+        ):
+            cached = self.summaries("worker1")
+            self.late_upload()
+            self.assertNotEqual(self.summaries("worker1"), cached)
@@ -0,0 +1,174 @@
+from django.core.management import call_command
+from django.db.models import F
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+from django.utils.http import http_date
+
+import datetime
+import io
+from unittest import mock
+
+from measurements import keys
+from measurements.bench import synthetic_records
+from measurements.models import Datalogger
+
+
+class ConditionalTests(TestCase):
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+        self.records = list(
+            synthetic_records(2, 48, start=self.start, interval=1800, seed=8)
+        )
+        self.ingest(self.records)
+        self.dataloggers = sorted({record["datalogger"] for record in self.records})
+
+    def ingest(self, records):
+        response = self.client.post(
+            reverse("ingest_data_batch"), records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def requests(self):
+        return [
+            ("fetch_data_raw", {"datalogger": self.dataloggers[0]}),
+            ("fetch_data_aggregates", {"datalogger": self.dataloggers[0]}),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": self.dataloggers[0], "span": "hour"},
+            ),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": ",".join(self.dataloggers), "span": "day"},
+            ),
+            ("fetch_data_aggregates", {"fleet": "true", "span": "day"}),
+        ]
+
+    def test_not_modified(self):
+        # Readings stored seconds ago, see test_same_second_changes
+        Datalogger.objects.update(
+            modified_at=F("modified_at") - datetime.timedelta(seconds=2)
+        )
+        for name, params in self.requests():
+            with self.subTest(name=name, params=params):
+                url = reverse(name)
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertIn("Accept", response["Vary"])
+                etag = response["ETag"]
+                last_modified = response["Last-Modified"]
+
+                # Only the datalogger lookup runs
+                with self.assertNumQueries(1):
+                    response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(response["ETag"], etag)
+                self.assertFalse(response.content)
+
+                response = self.client.get(
+                    url, params, HTTP_IF_MODIFIED_SINCE=last_modified
+                )
+                self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+                response = self.client.get(url, params, HTTP_IF_NONE_MATCH='"other"')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_same_second_changes(self):
+        # Readings stored in the same second as the previous ones are not
+        # hidden by If-Modified-Since
+        url = reverse("fetch_data_raw")
+        params = {"datalogger": self.dataloggers[0]}
+        records = [
+            dict(record, at=(self.start - datetime.timedelta(days=days)).isoformat())
+            for days, record in [(1, self.records[0]), (2, self.records[0])]
+        ]
+        second = datetime.datetime(2025, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        since = http_date(second.timestamp())
+        now = mock.Mock()
+        with mock.patch("django.utils.timezone.now", now):
+            now.return_value = second + datetime.timedelta(milliseconds=200)
+            self.ingest(records[:1])
+            now.return_value = second + datetime.timedelta(milliseconds=400)
+            response = self.client.get(url, params)
+            self.assertNotIn("Last-Modified", response)
+            count = len(response.data)
+
+            now.return_value = second + datetime.timedelta(milliseconds=700)
+            self.ingest(records[1:])
+            now.return_value = second + datetime.timedelta(milliseconds=900)
+            response = self.client.get(url, params, HTTP_IF_MODIFIED_SINCE=since)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                len(response.data), count + len(records[1]["measurements"])
+            )
+
+            # Once the second is over it can be given
+            now.return_value = second + datetime.timedelta(seconds=2)
+            response = self.client.get(url, params)
+            self.assertEqual(response["Last-Modified"], since)
+            response = self.client.get(url, params, HTTP_IF_MODIFIED_SINCE=since)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_validators_change(self):
+        url = reverse("fetch_data_raw")
+        first, second = [{"datalogger": datalogger} for datalogger in self.dataloggers]
+        responses = [self.client.get(url, params) for params in [first, second]]
+        etags = [response["ETag"] for response in responses]
+        fleet_url = reverse("fetch_data_aggregates")
+        fleet = {"fleet": "true", "span": "day"}
+        fleet_etag = self.client.get(fleet_url, fleet)["ETag"]
+
+        # Another representation of the same readings
+        response = self.client.get(url, first, HTTP_ACCEPT="text/csv")
+        self.assertNotEqual(response["ETag"], etags[0])
+
+        # New readings only change the validators of their datalogger
+        record = next(
+            record
+            for record in self.records
+            if record["datalogger"] == self.dataloggers[0]
+        )
+        record = dict(record, at=(self.start - datetime.timedelta(days=1)).isoformat())
+        self.ingest([record])
+        response = self.client.get(url, first, HTTP_IF_NONE_MATCH=etags[0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            len(response.data), len(responses[0].data) + len(record["measurements"])
+        )
+        response = self.client.get(url, second, HTTP_IF_NONE_MATCH=etags[1])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # but those of the whole fleet
+        response = self.client.get(fleet_url, fleet, HTTP_IF_NONE_MATCH=fleet_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        fleet_etag = response["ETag"]
+
+        # as does a new datalogger
+        Datalogger.objects.create(uuid="00000000-0000-0000-0000-000000000001")
+        response = self.client.get(fleet_url, fleet, HTTP_IF_NONE_MATCH=fleet_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Moving the readings to another layout changes all of them
+        with self.settings(MEASUREMENTS_STORAGE="wide"):
+            call_command("convert_storage", "wide", stdout=io.StringIO())
+            response = self.client.get(url, second, HTTP_IF_NONE_MATCH=etags[1])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_errors_and_disabled(self):
+        url = reverse("fetch_data_raw")
+        response = self.client.get(url, {"datalogger": "logger"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn("ETag", response)
+
+        response = self.client.get(url, {"datalogger": self.dataloggers[0]})
+        with self.settings(MEASUREMENTS_CONDITIONAL_GET=False):
+            response = self.client.get(
+                url,
+                {"datalogger": self.dataloggers[0]},
+                HTTP_IF_NONE_MATCH=response["ETag"],
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("ETag", response)
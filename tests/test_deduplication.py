@@ -0,0 +1,232 @@
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import io
+from unittest import mock
+
+from measurements import ingest, keys
+from measurements.storage import Storage
+from measurements.bench import synthetic_records
+from measurements.models import (
+    Datalogger,
+    Measurement,
+    MeasurementRecord,
+    MeasurementRollup,
+)
+
+
+def rollups():
+    return sorted(
+        MeasurementRollup.objects.values_list(
+            "datalogger", "span", "bucket", "label", "count", "total"
+        )
+    )
+
+
+class IdempotentIngestTests(TestCase):
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 7, 1, tzinfo=datetime.timezone.utc)
+        self.records = list(
+            synthetic_records(2, 40, start=self.start, interval=900, seed=9)
+        )
+
+    def ingest(self, records):
+        response = self.client.post(
+            reverse("ingest_data_batch"), records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data["measurements"]
+
+    def readings(self):
+        return sorted(
+            (item["label"], item["recorded_at"], item["value"])
+            for datalogger in {record["datalogger"] for record in self.records}
+            for item in self.client.get(
+                reverse("fetch_data_raw"), {"datalogger": datalogger}
+            ).data
+        )
+
+    def test_retries(self):
+        for layout in ["narrow", "wide"]:
+            with self.subTest(layout=layout), self.settings(
+                MEASUREMENTS_STORAGE=layout
+            ):
+                Measurement.objects.all().delete()
+                MeasurementRecord.objects.all().delete()
+                MeasurementRollup.objects.all().delete()
+
+                self.assertEqual(self.ingest(self.records), 40 * 3)
+                expected = (self.readings(), rollups())
+
+                # Retried batches, partly or entirely stored already
+                self.assertEqual(self.ingest(self.records[:25]), 0)
+                self.assertEqual(self.ingest(self.records), 0)
+                response = self.client.post(
+                    reverse("ingest_data"), self.records[3], format="json"
+                )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual((self.readings(), rollups()), expected)
+
+    def test_new_labels(self):
+        for layout in ["narrow", "wide"]:
+            with self.subTest(layout=layout), self.settings(
+                MEASUREMENTS_STORAGE=layout
+            ):
+                Measurement.objects.all().delete()
+                MeasurementRecord.objects.all().delete()
+                MeasurementRollup.objects.all().delete()
+                first, second = [
+                    dict(self.records[0], measurements=measurements)
+                    for measurements in [
+                        self.records[0]["measurements"][:2],
+                        self.records[0]["measurements"][1:],
+                    ]
+                ]
+                # A label repeated in a batch keeps its last value
+                repeated = dict(first, measurements=[{"label": "temp", "value": 39.5}])
+                self.assertEqual(self.ingest([first, repeated]), 2)
+
+                # Only the reading missing at that time is stored
+                self.assertEqual(self.ingest([second]), 1)
+                values = {label: value for label, _, value in self.readings()}
+                self.assertEqual(
+                    values,
+                    dict(
+                        {
+                            item["label"]: item["value"]
+                            for item in self.records[0]["measurements"]
+                        },
+                        temp=39.5,
+                    ),
+                )
+                self.assertEqual(
+                    sorted(
+                        MeasurementRollup.objects.filter(span="hour").values_list(
+                            "label", "count"
+                        )
+                    ),
+                    [("hum", 1), ("rain", 1), ("temp", 1)],
+                )
+
+    def test_write_lock(self):
+        # Taken before looking up the stored readings
+        self.assertEqual(
+            connection.settings_dict["OPTIONS"]["transaction_mode"], "IMMEDIATE"
+        )
+
+    def test_stale_lookup(self):
+        # A reading the lookup missed fails the ingest rather than being
+        # counted again by the rollups
+        self.ingest(self.records)
+        expected = rollups()
+        measurements = list(Measurement.objects.all()[:3])
+        for measurement in measurements:
+            measurement.pk = None
+        with mock.patch.object(Storage, "stored", return_value=iter([])):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                ingest.save_measurements(measurements)
+        self.assertEqual(rollups(), expected)
+
+
+class UpgradeTests(TransactionTestCase):
+    # Duplicates can only be stored before the natural key migration, the
+    # database is taken back there for the test
+    before = [("measurements", "0005_datalogger_version")]
+
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.records = list(synthetic_records(2, 30, interval=1200, seed=10))
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.addCleanup(self.migrate)
+
+    def migrate(self, targets=None):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets or executor.loader.graph.leaf_nodes("measurements"))
+        return executor.loader.project_state(targets).apps if targets else None
+
+    def test_narrow(self):
+        expected = (
+            sorted(Measurement.objects.values_list("id", "label", "value")),
+            rollups(),
+        )
+        versions = dict(Datalogger.objects.values_list("id", "version"))
+        apps = self.migrate(self.before)
+        model = apps.get_model("measurements", "Measurement")
+        originals = list(model.objects.order_by("id")[:40])
+        copies = [
+            model(
+                label=measurement.label,
+                value=measurement.value + 1,
+                recorded_at=measurement.recorded_at,
+                datalogger_id=measurement.datalogger_id,
+                location_id=measurement.location_id,
+            )
+            for measurement in originals + originals[:5]
+        ]
+        model.objects.bulk_create(copies)
+        # Rollups counting the copies
+        apps.get_model("measurements", "MeasurementRollup").objects.update(
+            count=F("count") + 1
+        )
+
+        self.migrate()
+        self.assertEqual(
+            (
+                sorted(Measurement.objects.values_list("id", "label", "value")),
+                rollups(),
+            ),
+            expected,
+        )
+        for datalogger_id, version in versions.items():
+            self.assertGreater(
+                Datalogger.objects.get(id=datalogger_id).version, version
+            )
+
+    def test_wide(self):
+        with self.settings(MEASUREMENTS_STORAGE="wide"):
+            call_command("convert_storage", "wide", stdout=io.StringIO())
+            expected = rollups()
+            first = MeasurementRecord.objects.order_by("id").first()
+            temp = first.temp
+
+            apps = self.migrate(self.before)
+            model = apps.get_model("measurements", "MeasurementRecord")
+            model.objects.filter(id=first.id).update(temp=None)
+            model.objects.bulk_create(
+                [
+                    model(
+                        datalogger_id=first.datalogger_id,
+                        location_id=first.location_id,
+                        recorded_at=first.recorded_at,
+                        temp=value,
+                        rain=-1.0,
+                    )
+                    for value in [temp, temp + 1]
+                ]
+            )
+
+            self.migrate()
+            first.refresh_from_db()
+            # Missing labels come from the first later row, the others stay
+            self.assertEqual(first.temp, temp)
+            self.assertNotEqual(first.rain, -1.0)
+            self.assertEqual(
+                MeasurementRecord.objects.filter(
+                    datalogger_id=first.datalogger_id, recorded_at=first.recorded_at
+                ).count(),
+                1,
+            )
+            self.assertEqual(rollups(), expected)
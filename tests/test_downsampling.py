@@ -0,0 +1,124 @@
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import io
+import random
+
+from measurements import keys
+from measurements.bench import synthetic_records
+from measurements.downsampling import lttb
+
+
+def reference_lttb(points, threshold):
+    # Textbook implementation working on the whole list
+    if len(points) <= threshold:
+        return points
+    size, buckets = len(points) - 2, threshold - 2
+    selected = [points[0]]
+    a = points[0]
+    for i in range(buckets):
+        start = i * size // buckets + 1
+        end = (i + 1) * size // buckets + 1
+        following = points[end : (i + 2) * size // buckets + 1]
+        if i == buckets - 1:
+            following = [points[-1]]
+        avg_x = sum(point[0] for point in following) / len(following)
+        avg_y = sum(point[1] for point in following) / len(following)
+        a = max(
+            points[start:end],
+            key=lambda b: abs(
+                (a[0] - avg_x) * (b[1] - a[1]) - (a[0] - b[0]) * (avg_y - a[1])
+            ),
+        )
+        selected.append(a)
+    selected.append(points[-1])
+    return selected
+
+
+class LTTBTests(SimpleTestCase):
+    def test_matches_reference(self):
+        rng = random.Random(7)
+        for count, threshold in [(10, 20), (100, 10), (1000, 97), (257, 3), (50, 49)]:
+            with self.subTest(count=count, threshold=threshold):
+                points = [(x * 60.0, rng.uniform(-10, 10), x) for x in range(count)]
+                expected = [point[2] for point in reference_lttb(points, threshold)]
+                actual = list(lttb(iter(points), count, threshold))
+                self.assertEqual(actual, expected)
+                self.assertLessEqual(len(actual), threshold)
+
+    def test_keeps_spikes(self):
+        points = [(float(x), 0.0, x) for x in range(1000)]
+        points[421] = (421.0, 100.0, 421)
+        self.assertIn(421, list(lttb(iter(points), 1000, 20)))
+
+    def test_fewer_points_than_counted(self):
+        points = [(float(x), float(x % 7), x) for x in range(40)]
+        self.assertEqual(list(lttb(iter(points), 100, 10))[0], 0)
+
+
+class DownsamplingAPITests(TestCase):
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 2, 1, tzinfo=datetime.timezone.utc)
+        self.records = list(synthetic_records(1, 500, start=self.start, seed=11))
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.params = {
+            "datalogger": self.records[0]["datalogger"],
+            "since": (self.start - datetime.timedelta(hours=1)).isoformat(),
+            "before": (self.start + datetime.timedelta(days=5)).isoformat(),
+        }
+        self.url = reverse("fetch_data_raw")
+
+    def test_max_points(self):
+        full = self.client.get(self.url, self.params).data
+        response = self.client.get(self.url, dict(self.params, max_points=40))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        for label in ["temp", "rain", "hum"]:
+            series = [item for item in full if item["label"] == label]
+            points = [item for item in response.data if item["label"] == label]
+            self.assertEqual(len(points), 40)
+            self.assertEqual(points[0], series[0])
+            self.assertEqual(points[-1], series[-1])
+            self.assertTrue(all(point in series for point in points))
+        self.assertEqual(
+            [item["recorded_at"] for item in response.data],
+            sorted(item["recorded_at"] for item in response.data),
+        )
+
+        # Streamed formats are downsampled too
+        lines = b"".join(
+            self.client.get(
+                self.url, dict(self.params, max_points=40, format="csv")
+            ).streaming_content
+        )
+        self.assertEqual(len(lines.decode().splitlines()), 1 + 3 * 40)
+
+        # Short series are returned as is
+        short = self.client.get(self.url, dict(self.params, max_points=1000))
+        self.assertEqual(short.data, full)
+
+        # Same points with the wide layout
+        with self.settings(MEASUREMENTS_STORAGE="wide"):
+            call_command("convert_storage", "wide", stdout=io.StringIO())
+            wide = self.client.get(self.url, dict(self.params, max_points=40))
+            self.assertEqual(wide.data, response.data)
+
+    def test_max_points_errors(self):
+        for params in [
+            {"max_points": 2},
+            {"max_points": "many"},
+            {"max_points": 10**6},
+            {"max_points": 10, "limit": 5},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(self.url, dict(self.params, **params))
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,84 @@
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import uuid
+
+from measurements import keys
+from measurements.models import Datalogger, Location, Measurement
+
+
+class KeysTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.addCleanup(keys.clear)
+        keys.clear()
+
+    def record(self, datalogger, lat=47.56321, lng=1.524568):
+        return {
+            "at": timezone.now().isoformat(),
+            "datalogger": str(datalogger),
+            "location": {"lat": lat, "lng": lng},
+            "measurements": [
+                {"label": "temp", "value": 10.5},
+                {"label": "rain", "value": 0.2},
+                {"label": "hum", "value": 60},
+            ],
+        }
+
+    def test_ingest_normalizes_dataloggers_and_locations(self):
+        first, second = uuid.uuid4(), uuid.uuid4()
+        records = [
+            self.record(first),
+            self.record(first),
+            self.record(second),
+            self.record(second, lat=48.1),
+        ]
+        response = self.client.post(
+            reverse("ingest_data_batch"), records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(
+            reverse("ingest_data"), self.record(first), format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(Measurement.objects.count(), 15)
+        self.assertEqual(Datalogger.objects.count(), 2)
+        self.assertEqual(Location.objects.count(), 2)
+        self.assertEqual(Measurement.objects.filter(datalogger__uuid=first).count(), 9)
+
+    def test_ids_are_cached_once_committed(self):
+        datalogger = uuid.uuid4()
+        with self.captureOnCommitCallbacks(execute=True):
+            ids = keys.datalogger_ids([datalogger])
+            locations = keys.location_ids([(1.5, 2.5)])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(keys.datalogger_ids([datalogger]), ids)
+            self.assertEqual(keys.datalogger_id(datalogger), ids[datalogger])
+            self.assertEqual(keys.location_ids([(1.5, 2.5)]), locations)
+
+        # Without a commit nothing is remembered
+        other = uuid.uuid4()
+        with self.captureOnCommitCallbacks(execute=False):
+            keys.datalogger_ids([other])
+        with self.assertNumQueries(1):
+            self.assertIsNotNone(keys.datalogger_id(other))
+
+        self.assertIsNone(keys.datalogger_id(uuid.uuid4()))
+
+    def test_cache_size_is_bounded(self):
+        dataloggers = [uuid.uuid4() for _ in range(3)]
+        with self.settings(MEASUREMENTS_KEY_CACHE_SIZE=2):
+            for datalogger in dataloggers:
+                with self.captureOnCommitCallbacks(execute=True):
+                    keys.datalogger_ids([datalogger])
+
+        # The oldest entry has been evicted
+        with self.assertNumQueries(0):
+            keys.datalogger_ids(dataloggers[1:])
+        with self.assertNumQueries(1):
+            keys.datalogger_id(dataloggers[0])
@@ -0,0 +1,197 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import importlib
+import types
+import uuid
+from unittest import mock
+
+from measurements import keys, latest
+from measurements.bench import synthetic_records
+from measurements.models import LatestReading
+
+fill = importlib.import_module("measurements.migrations.0008_latestreading").fill
+
+
+class LatestTests(TestCase):
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.addCleanup(latest.invalidate)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 7, 1, tzinfo=datetime.timezone.utc)
+        self.records = list(
+            synthetic_records(3, 60, start=self.start, interval=600, seed=21)
+        )
+        self.dataloggers = [record["datalogger"] for record in self.records[:3]]
+
+    def ingest(self, records):
+        # Entries of the cache are dropped once the ingest committed
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("ingest_data_batch"), records, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def get(self, *dataloggers):
+        response = self.client.get(
+            reverse("fetch_latest"), {"datalogger": ",".join(dataloggers)}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def expected(self, datalogger):
+        # Last reading of each label of /api/data
+        response = self.client.get(
+            reverse("fetch_data_raw"), {"datalogger": datalogger}
+        )
+        last = {}
+        for row in response.json():
+            if (
+                row["recorded_at"]
+                > last.get(row["label"], {"recorded_at": ""})["recorded_at"]
+            ):
+                last[row["label"]] = row
+        return [last[label] for label in sorted(last)]
+
+    def test_latest(self):
+        self.ingest(self.records)
+        unknown = str(uuid.uuid4())
+        body = self.get(*self.dataloggers, unknown)
+        self.assertEqual(list(body), [*self.dataloggers, unknown])
+        for datalogger in self.dataloggers:
+            self.assertEqual(body[datalogger], self.expected(datalogger))
+            self.assertEqual(len(body[datalogger]), 3)
+        self.assertEqual(body[unknown], [])
+
+        response = self.client.get(
+            reverse("fetch_latest"),
+            {"datalogger": [self.dataloggers[1], self.dataloggers[1]]},
+        )
+        self.assertEqual(list(response.json()), [self.dataloggers[1]])
+
+    def test_out_of_order(self):
+        datalogger = self.dataloggers[0]
+        records = [
+            record for record in self.records if record["datalogger"] == datalogger
+        ]
+        self.ingest(records[10:])
+        before = self.get(datalogger)
+        self.assertEqual(before[datalogger], self.expected(datalogger))
+
+        # Older readings uploaded late do not replace the latest ones
+        self.ingest(records[:10])
+        self.assertEqual(self.get(datalogger), before)
+
+        # A newer record with a single label only replaces that label
+        at = datetime.datetime.fromisoformat(records[-1]["at"])
+        newer = dict(
+            records[-1],
+            at=(at + datetime.timedelta(minutes=5)).isoformat(),
+            measurements=[{"label": "temp", "value": 12.5}],
+        )
+        self.ingest([newer])
+        readings = {row["label"]: row for row in self.get(datalogger)[datalogger]}
+        self.assertEqual(readings["temp"]["value"], 12.5)
+        self.assertEqual(
+            readings["hum"],
+            next(row for row in before[datalogger] if row["label"] == "hum"),
+        )
+
+        # Readings of a single batch keep their most recent time
+        self.ingest([dict(newer, at=self.start.isoformat()), newer])
+        self.assertEqual(
+            LatestReading.objects.get(datalogger__uuid=datalogger, label="temp").value,
+            12.5,
+        )
+
+    def test_cache(self):
+        self.ingest(self.records)
+        datalogger = self.dataloggers[0]
+        first = self.get(datalogger)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(datalogger), first)
+
+        # Stored readings drop the entry
+        at = datetime.datetime.fromisoformat(self.records[-1]["at"])
+        self.ingest(
+            [
+                dict(
+                    self.records[0],
+                    at=(at + datetime.timedelta(hours=1)).isoformat(),
+                    measurements=[{"label": "rain", "value": 1.2}],
+                )
+            ]
+        )
+        with self.assertNumQueries(1):
+            readings = {row["label"]: row for row in self.get(datalogger)[datalogger]}
+        self.assertEqual(readings["rain"]["value"], 1.2)
+
+        # Entries expire, the least recently used ones go first
+        with mock.patch(
+            "measurements.latest.time.monotonic", return_value=1e12
+        ), self.assertNumQueries(1):
+            self.get(datalogger)
+        with self.settings(MEASUREMENTS_LATEST_CACHE_SIZE=2):
+            self.get(*self.dataloggers)
+            with self.assertNumQueries(0):
+                self.get(*self.dataloggers[1:])
+            with self.assertNumQueries(1):
+                self.get(self.dataloggers[0])
+
+    def test_errors(self):
+        for params in [
+            {},
+            {"datalogger": "not-a-uuid"},
+            {
+                "datalogger": ",".join(
+                    str(uuid.uuid4())
+                    for _ in range(settings.MEASUREMENTS_SUMMARY_MAX_DATALOGGERS + 1)
+                )
+            },
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(reverse("fetch_latest"), params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_migration_fill(self):
+        # Readings stored before the table existed, in both layouts
+        narrow = [
+            record
+            for record in self.records
+            if record["datalogger"] != self.dataloggers[2]
+        ]
+        self.ingest(narrow)
+        with self.settings(MEASUREMENTS_STORAGE="wide"):
+            self.ingest([record for record in self.records if record not in narrow])
+            self.ingest(
+                [
+                    dict(
+                        self.records[0],
+                        at=(self.start + datetime.timedelta(days=1)).isoformat(),
+                        measurements=[{"label": "hum", "value": 55.5}],
+                    )
+                ]
+            )
+        expected = sorted(
+            LatestReading.objects.values_list(
+                "datalogger_id", "label", "recorded_at", "value"
+            )
+        )
+        self.assertEqual(len(expected), 9)
+
+        LatestReading.objects.all().delete()
+        fill(apps, types.SimpleNamespace(connection=connection))
+        self.assertEqual(
+            sorted(
+                LatestReading.objects.values_list(
+                    "datalogger_id", "label", "recorded_at", "value"
+                )
+            ),
+            expected,
+        )
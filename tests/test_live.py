@@ -0,0 +1,163 @@
+from asgiref.sync import sync_to_async
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import asyncio
+import datetime
+import json
+import uuid
+
+from measurements import keys, live
+from measurements.bench import synthetic_records
+from measurements.streaming import format_datetime
+
+
+def parse_events(chunks):
+    # (id, data) of the events of SSE chunks, comments are skipped
+    events = []
+    for event in b"".join(chunks).decode().split("\n\n"):
+        fields = dict(
+            line.split(": ", 1)
+            for line in event.splitlines()
+            if not line.startswith(":")
+        )
+        if fields:
+            events.append((fields["id"], fields["data"]))
+    return events
+
+
+@override_settings(MEASUREMENTS_LIVE_KEEPALIVE=0.05)
+class LiveTests(TestCase):
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 8, 1, tzinfo=datetime.timezone.utc)
+        records = list(synthetic_records(1, 20, start=self.start, seed=11))
+        self.stored, self.records = records[:10], records[10:]
+        self.ingest(self.stored)
+        self.datalogger = records[0]["datalogger"]
+        self.datalogger_id = keys.datalogger_id(uuid.UUID(self.datalogger))
+
+    def ingest(self, records):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("ingest_data_batch"), records, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    async def read(self, chunks, count):
+        # Chunks until count events have been received, keepalive comments
+        # come every 50ms
+        received = []
+        for _ in range(100):
+            if len(parse_events(received)) >= count:
+                return parse_events(received)
+            received.append(await asyncio.wait_for(anext(chunks), 5))
+        self.fail(f"Less than {count} events received")
+
+    async def test_live_events(self):
+        response = await self.async_client.get(
+            reverse("stream_data"), {"datalogger": self.datalogger}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b": subscribed\n\n")
+        # Idle streams only get comments
+        self.assertEqual(await anext(chunks), b": keepalive\n\n")
+
+        await sync_to_async(self.ingest)(self.records[:3])
+        events = await self.read(chunks, 3)
+        self.assertEqual(
+            [event_id for event_id, _ in events],
+            [record["at"].replace("+00:00", "Z") for record in self.records[:3]],
+        )
+        self.assertEqual(
+            json.loads(events[0][1])[0],
+            {
+                "label": "temp",
+                "recorded_at": events[0][0],
+                "value": self.records[0]["measurements"][0]["value"],
+            },
+        )
+
+        # Older readings committed later are left to /api/data
+        await sync_to_async(self.ingest)([self.stored[-1] | {"at": "2023-01-01"}])
+        await sync_to_async(self.ingest)(self.records[3:4])
+        events = await self.read(chunks, 1)
+        self.assertEqual(events[0][0], self.records[3]["at"].replace("+00:00", "Z"))
+        self.assertEqual(live.stats()["subscribers"], 1)
+
+    async def test_replay(self):
+        last_seen = self.stored[4]["at"]
+        response = await self.async_client.get(
+            reverse("stream_data"),
+            {"datalogger": self.datalogger},
+            headers={"Last-Event-ID": last_seen},
+        )
+        chunks = aiter(response.streaming_content)
+        events = await self.read(chunks, 5)
+        self.assertEqual(
+            [event_id for event_id, _ in events],
+            [record["at"].replace("+00:00", "Z") for record in self.stored[5:]],
+        )
+
+        await sync_to_async(self.ingest)(self.records[:1])
+        events = await self.read(chunks, 1)
+        self.assertEqual(events[0][0], self.records[0]["at"].replace("+00:00", "Z"))
+
+    async def test_unsubscribe_and_overflow(self):
+        stream = live.events(live.subscribe(self.datalogger_id))
+        await anext(stream)
+        self.assertEqual(live.stats()["subscribers"], 1)
+        await stream.aclose()
+        self.assertEqual(live.stats()["subscribers"], 0)
+
+        # A subscriber falling behind gets its buffer, then the stream ends
+        with self.settings(MEASUREMENTS_LIVE_BUFFER_SIZE=2):
+            stream = live.events(live.subscribe(self.datalogger_id))
+            await anext(stream)
+            await sync_to_async(self.ingest)(self.records[:4])
+            chunks = [chunk.encode() async for chunk in stream]
+        self.assertEqual(
+            [event_id for event_id, _ in parse_events(chunks)],
+            [
+                format_datetime(datetime.datetime.fromisoformat(record["at"]))
+                for record in self.records[:2]
+            ],
+        )
+        self.assertEqual(live.stats()["subscribers"], 0)
+
+    def test_errors(self):
+        url = reverse("stream_data")
+        for params, headers, expected in [
+            ({}, {}, status.HTTP_400_BAD_REQUEST),
+            ({"datalogger": "logger"}, {}, status.HTTP_400_BAD_REQUEST),
+            (
+                {"datalogger": self.datalogger},
+                {"HTTP_LAST_EVENT_ID": "yesterday"},
+                status.HTTP_400_BAD_REQUEST,
+            ),
+            ({"datalogger": str(uuid.uuid4())}, {}, status.HTTP_404_NOT_FOUND),
+        ]:
+            with self.subTest(params=params, headers=headers):
+                response = self.client.get(url, params, **headers)
+                self.assertEqual(response.status_code, expected)
+
+        with self.settings(MEASUREMENTS_LIVE_MAX_SUBSCRIBERS=0):
+            response = self.client.get(url, {"datalogger": self.datalogger})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    async def test_subscription_taken_by_view(self):
+        # Before anything is streamed, and released when the response closes
+        url = reverse("stream_data")
+        with self.settings(MEASUREMENTS_LIVE_MAX_SUBSCRIBERS=1):
+            first = await self.async_client.get(url, {"datalogger": self.datalogger})
+            self.assertEqual(first.status_code, status.HTTP_200_OK)
+            self.assertEqual(live.stats()["subscribers"], 1)
+            second = await self.async_client.get(url, {"datalogger": self.datalogger})
+            self.assertEqual(second.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            first.close()
+        self.assertEqual(live.stats()["subscribers"], 0)
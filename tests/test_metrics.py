@@ -0,0 +1,88 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import re
+
+from measurements import keys, metrics
+from measurements.bench import synthetic_records
+
+
+def sample(text, name, endpoint):
+    match = re.search(
+        rf'^{name}{{endpoint="{endpoint}"(?:,le="\+Inf")?}} (\S+)$', text, re.MULTILINE
+    )
+    return None if match is None else float(match.group(1))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.records = list(synthetic_records(1, 20, seed=6))
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.params = {"datalogger": self.records[0]["datalogger"]}
+
+    def scrape(self):
+        response = self.client.get(reverse("export_metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        return response.content.decode()
+
+    def test_endpoint_metrics(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get(reverse("fetch_data_raw"), self.params).data
+        # Read before the next requests clear the query log
+        query_count = len(queries)
+        self.client.get(
+            reverse("fetch_data_aggregates"), dict(self.params, span="hour")
+        )
+        self.client.get("/api/unknown")
+
+        text = self.scrape()
+        self.assertIn("# TYPE measurements_request_duration_seconds histogram", text)
+        for name, expected in [
+            ("measurements_request_duration_seconds_count", 1),
+            ("measurements_request_duration_seconds_bucket", 1),
+            ("measurements_sql_queries_total", query_count),
+            ("measurements_rows_total", len(data)),
+        ]:
+            with self.subTest(name=name):
+                self.assertEqual(sample(text, name, "fetch_data_raw"), expected)
+        self.assertEqual(
+            sample(
+                text, "measurements_request_duration_seconds_count", "ingest_data_batch"
+            ),
+            1,
+        )
+        self.assertGreater(
+            sample(text, "measurements_serialization_seconds_total", "fetch_data_raw"),
+            0,
+        )
+        self.assertIsNotNone(
+            sample(text, "measurements_sql_seconds_total", "fetch_data_aggregates")
+        )
+        self.assertNotIn("unknown", text)
+        self.assertIn('measurements_cache_hits_total{kind="data"}', text)
+        self.assertIn("measurements_ingest_queue_depth 0", text)
+
+    def test_slow_request_log(self):
+        with self.settings(MEASUREMENTS_SLOW_REQUEST_SECONDS=0):
+            with self.assertLogs("measurements.metrics", "WARNING") as logs:
+                self.client.get(reverse("fetch_data_raw"), self.params)
+        self.assertIn("Slow request GET /api/data?datalogger=", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+    def test_disabled(self):
+        metrics.reset()
+        with self.settings(MEASUREMENTS_METRICS_ENABLED=False):
+            self.client.get(reverse("fetch_data_raw"), self.params)
+        self.assertEqual(metrics.stats(), {})
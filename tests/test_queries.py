@@ -0,0 +1,202 @@
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import uuid
+from unittest import mock
+
+from measurements import keys, queries
+from measurements.bench import synthetic_records
+from measurements.pagination import encode_cursor
+
+
+class QueryMixin:
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 8, 1, tzinfo=datetime.timezone.utc)
+        self.records = list(
+            synthetic_records(4, 384, start=self.start, interval=900, seed=17)
+        )
+        self.dataloggers = [record["datalogger"] for record in self.records[:4]]
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def at(self, minutes):
+        return (self.start + datetime.timedelta(minutes=minutes)).isoformat()
+
+    def specs(self):
+        d0, d1, d2, d3 = self.dataloggers
+        since = self.at(50)
+        return [
+            # Readings of d0 over overlapping windows, read once
+            ("fetch_data_raw", {"datalogger": d0}),
+            (
+                "fetch_data_raw",
+                {"datalogger": d0, "since": since, "before": self.at(300)},
+            ),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": d0, "since": self.at(600), "before": self.at(720)},
+            ),
+            # Disjoint windows of d1, read separately
+            (
+                "fetch_data_raw",
+                {"datalogger": d1, "since": self.at(60), "before": self.at(120)},
+            ),
+            (
+                "fetch_data_raw",
+                {"datalogger": d1, "since": self.at(180), "before": self.at(240)},
+            ),
+            # Aggregates grouped by span and window
+            (
+                "fetch_data_aggregates",
+                {"datalogger": d0, "span": "hour", "since": since},
+            ),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": d1, "span": "hour", "since": since},
+            ),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": d2, "span": "hour", "since": since},
+            ),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": str(uuid.uuid4()), "span": "hour", "since": since},
+            ),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": d2, "span": "6h", "stats": "min,max"},
+            ),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": d3, "span": "6h", "stats": "min,max"},
+            ),
+            ("fetch_data_aggregates", {"datalogger": d3, "span": "day"}),
+            # Through their view
+            ("fetch_data_raw", {"datalogger": d0, "limit": 10}),
+            ("fetch_data_raw", {"datalogger": d1, "max_points": 20}),
+            ("fetch_data_aggregates", {"fleet": True, "span": "hour"}),
+            ("fetch_data_aggregates", {"datalogger": [d0, d1], "span": "day"}),
+            ("fetch_data_aggregates", {"bbox": "0,40,10,52", "span": "day"}),
+            ("fetch_data_raw", {"datalogger": "nope"}),
+            ("fetch_data_aggregates", {"datalogger": d0, "span": "fortnight"}),
+        ]
+
+    def expected(self, specs):
+        results = []
+        for name, params in specs:
+            params = {
+                key: "true" if value is True else value for key, value in params.items()
+            }
+            response = self.client.get(reverse(name), params)
+            results.append({"status": response.status_code, "body": response.json()})
+        return results
+
+    def query(self, specs):
+        response = self.client.post(
+            reverse("query_batch"),
+            [{"path": reverse(name), "params": params} for name, params in specs],
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()["results"]
+
+
+class QueryTests(QueryMixin, TestCase):
+    def test_same_results(self):
+        specs = self.specs()
+        with mock.patch.object(
+            queries, "raw_window", wraps=queries.raw_window
+        ) as raw, mock.patch.object(
+            queries, "aggregate_fleet", wraps=queries.aggregate_fleet
+        ) as fleet:
+            results = self.query(specs)
+        self.assertEqual(results, self.expected(specs))
+        self.assertEqual(results[-2]["status"], status.HTTP_400_BAD_REQUEST)
+        # One read of d0 and two of d1, one aggregate query per span
+        self.assertEqual(raw.call_count, 3)
+        self.assertEqual(fleet.call_count, 3)
+
+    def test_same_results_without_cache(self):
+        specs = self.specs()
+        with self.settings(MEASUREMENTS_CACHE_ENABLED=False):
+            self.assertEqual(self.query(specs), self.expected(specs))
+
+    def test_invalid_specs(self):
+        # Reported in the result of the spec, the others are answered
+        response = self.client.post(
+            reverse("query_batch"),
+            [
+                "nope",
+                {"path": "/api/stream", "params": {}},
+                {"path": reverse("fetch_data_raw"), "params": ["datalogger"]},
+                {
+                    "path": reverse("fetch_data_raw"),
+                    "params": {"datalogger": self.dataloggers[0], "format": "csv"},
+                },
+                {"path": reverse("fetch_data_raw"), "params": {"since": {}}},
+                {"path": reverse("fetch_data_raw"), "params": {}},
+                {
+                    "path": reverse("fetch_data_raw"),
+                    "params": {
+                        "datalogger": self.dataloggers[0],
+                        "cursor": encode_cursor(datetime.datetime(2024, 8, 1), 1),
+                    },
+                },
+                {
+                    "path": reverse("fetch_data_raw"),
+                    "params": {"datalogger": self.dataloggers[0]},
+                },
+            ],
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.json()["results"]
+        self.assertEqual([result["status"] for result in results], [400] * 7 + [200])
+        self.assertIn("Invalid path", results[1]["body"]["error"])
+        self.assertEqual(
+            results[5]["body"], {"error": "Missing required datalogger parameter"}
+        )
+        self.assertEqual(results[6]["body"], {"error": "Invalid cursor parameter"})
+
+    def test_invalid_batch(self):
+        for data in [{}, [], "nope"]:
+            response = self.client.post(reverse("query_batch"), data, format="json")
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.settings(MEASUREMENTS_QUERY_MAX_SPECS=2):
+            response = self.client.post(
+                reverse("query_batch"),
+                [{"path": reverse("fetch_data_raw"), "params": {}}] * 3,
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {"error": "Too many query specs, maximum is 2"})
+
+    def test_clusters(self):
+        at = [self.start + datetime.timedelta(hours=hour) for hour in range(6)]
+        clusters = queries._clusters(
+            [(0, at[0], at[2]), (1, at[4], at[5]), (2, at[1], at[3]), (3, None, at[1])]
+        )
+        self.assertEqual(
+            [
+                (since, before, [index for index, _, _ in windows])
+                for since, before, windows in clusters
+            ],
+            [(queries.EARLIEST, at[3], [3, 0, 2]), (at[4], at[5], [1])],
+        )
+
+
+@override_settings(MEASUREMENTS_CACHE_ENABLED=False)
+class ConcurrentQueryTests(QueryMixin, TransactionTestCase):
+    # Outside of a transaction specs are read from the thread pool
+    def test_concurrent_reads(self):
+        specs = self.specs()
+        with mock.patch.object(queries, "_call", wraps=queries._call) as call:
+            self.assertEqual(self.query(specs), self.expected(specs))
+        self.assertGreater(call.call_count, 1)
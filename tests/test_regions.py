@@ -0,0 +1,127 @@
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+
+from measurements import keys, regions
+from measurements.bench import synthetic_records
+from measurements.models import DataloggerLocation, Location
+
+
+class RegionTests(TestCase):
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 9, 1, tzinfo=datetime.timezone.utc)
+        records = list(
+            synthetic_records(4, 80, start=self.start, interval=900, seed=12)
+        )
+        self.dataloggers = [record["datalogger"] for record in records[:4]]
+        self.locations = dict(
+            zip(
+                self.dataloggers,
+                [
+                    {"lat": 45.02, "lng": 2.01},
+                    {"lat": 45.07, "lng": 2.08},
+                    {"lat": 10.0, "lng": 179.5},
+                    {"lat": 10.0, "lng": 0.5},
+                ],
+            )
+        )
+        for record in records:
+            record["location"] = self.locations[record["datalogger"]]
+        # The first datalogger also reported from elsewhere
+        records.append(
+            dict(
+                records[0], at=self.start.isoformat(), location={"lat": 30, "lng": 100}
+            )
+        )
+        response = self.client.post(
+            reverse("ingest_data_batch"), records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+
+    def summary(self, params):
+        response = self.client.get(
+            reverse("fetch_data_aggregates"), dict(params, span="hour")
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_cells(self):
+        self.assertEqual(regions.cell(-90, -180), 0)
+        self.assertEqual(regions.cell(90, 180), (regions.ROWS - 1) * regions.COLUMNS)
+        self.assertEqual(regions.cell(-89.95, -179.95), 0)
+        self.assertEqual(regions.cell(-89.95, 179.95), regions.COLUMNS - 1)
+        self.assertEqual(
+            sorted(Location.objects.values_list("cell", flat=True)),
+            sorted(
+                regions.cell(location["lat"], location["lng"])
+                for location in list(self.locations.values())
+                + [{"lat": 30, "lng": 100}]
+            ),
+        )
+        self.assertEqual(DataloggerLocation.objects.count(), 5)
+
+    def test_region_summaries(self):
+        fleet = self.summary({"fleet": "true"})
+        first, second, east, west = self.dataloggers
+        for params, expected in [
+            ({"bbox": "1,44,3,46"}, [first, second]),
+            ({"bbox": "2.05,45.05,2.1,45.1"}, [second]),
+            ({"bbox": "99,29,101,31"}, [first]),
+            # Boxes crossing the antimeridian
+            ({"bbox": "179,9,1,11"}, [east, west]),
+            ({"bbox": "179,9,180,11"}, [east]),
+            ({"bbox": "10,10,20,20"}, []),
+            (
+                {
+                    "cells": ",".join(
+                        str(regions.cell(**self.locations[datalogger]))
+                        for datalogger in [first, west]
+                    )
+                },
+                [first, second, west],
+            ),
+        ]:
+            with self.subTest(params=params):
+                self.assertEqual(
+                    self.summary(params),
+                    {datalogger: fleet[datalogger] for datalogger in sorted(expected)},
+                )
+
+    def test_queries(self):
+        url = reverse("fetch_data_aggregates")
+        params = {"bbox": "1,44,3,46", "span": "hour"}
+        # Validators, region, then rollups and the open hour like the fleet
+        with self.assertNumQueries(4):
+            response = self.client.get(url, params)
+        with self.assertNumQueries(1):
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_errors(self):
+        url = reverse("fetch_data_aggregates")
+        for params in [
+            {"bbox": "1,2,3"},
+            {"bbox": "1,2,3,x"},
+            {"bbox": "1,50,3,40"},
+            {"bbox": "1,2,190,4"},
+            {"bbox": "nan,2,3,4"},
+            {"cells": ""},
+            {"cells": "1,a"},
+            {"cells": str(regions.ROWS * regions.COLUMNS)},
+            {"bbox": "1,44,3,46", "cells": "1"},
+            {"bbox": "1,44,3,46", "fleet": "true"},
+            {"cells": "1", "datalogger": self.dataloggers[0]},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(url, dict(params, span="hour"))
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with self.settings(MEASUREMENTS_REGION_MAX_CELLS=1):
+            response = self.client.get(url, {"cells": "1,2", "span": "hour"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("Too many cells", response.data["error"])
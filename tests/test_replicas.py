@@ -0,0 +1,314 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import tempfile
+from contextlib import ExitStack
+
+from measurements import caching, keys, latest, replicas
+from measurements.bench import synthetic_records
+from measurements.conditional import touch
+from measurements.models import Datalogger
+
+REPLICAS = ["default_replica0", "default_replica1"]
+SHARDS = ["shard0", "shard1"]
+
+
+def measurements_cache(backend, location):
+    return {
+        **settings.CACHES,
+        "measurements": {"BACKEND": backend, "LOCATION": location, "TIMEOUT": None},
+    }
+
+
+class ReplicaMixin:
+    def setUp(self):
+        # Marks of recent writes are shared through files, as between the
+        # processes of a server
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(
+            self.settings(
+                CACHES=measurements_cache(
+                    "django.core.cache.backends.filebased.FileBasedCache",
+                    directory.name,
+                )
+            )
+        )
+        self.addCleanup(keys.clear)
+        self.addCleanup(latest.invalidate)
+        self.addCleanup(caching.get_cache().clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+        self.records = list(
+            synthetic_records(4, 96, start=self.start, interval=900, seed=5)
+        )
+        self.dataloggers = [record["datalogger"] for record in self.records[:4]]
+
+    def sync(self):
+        for alias, copies in settings.MEASUREMENTS_REPLICAS.items():
+            for replica in copies:
+                replicas.sync(alias, replica)
+
+    def ingest(self, records):
+        response = self.client.post(
+            reverse("ingest_data_batch"), records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def elapse(self):
+        # Forgets recent writes, as when the read-your-writes window elapsed
+        caching.get_cache().clear()
+
+    def get(self, name, params):
+        # Response body and number of queries on the primary and replicas
+        contexts = {
+            alias: CaptureQueriesContext(connections[alias])
+            for alias in ["default", *REPLICAS]
+        }
+        with ExitStack() as stack:
+            for context in contexts.values():
+                stack.enter_context(context)
+            response = self.client.get(reverse(name), params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            if response.streaming:
+                body = b"".join(response.streaming_content).decode()
+            else:
+                body = response.json()
+        replica_queries = sum(len(contexts[alias]) for alias in REPLICAS)
+        return body, len(contexts["default"]), replica_queries
+
+    def primary(self, name, params):
+        with self.settings(MEASUREMENTS_REPLICAS={}):
+            return self.get(name, params)[0]
+
+
+@override_settings(
+    MEASUREMENTS_REPLICAS={"default": REPLICAS},
+    MEASUREMENTS_READ_YOUR_WRITES_SECONDS=60,
+    MEASUREMENTS_CACHE_ENABLED=False,
+)
+class ReplicaTests(ReplicaMixin, TransactionTestCase):
+    databases = {"default", *REPLICAS}
+
+    def test_reads_from_replicas(self):
+        self.ingest(self.records)
+        self.sync()
+        self.elapse()
+        for name, params in [
+            ("fetch_data_raw", {"datalogger": self.dataloggers[0]}),
+            ("fetch_data_raw", {"datalogger": self.dataloggers[1], "format": "csv"}),
+            ("fetch_data_raw", {"datalogger": self.dataloggers[1], "format": "ndjson"}),
+            ("fetch_data_aggregates", {"datalogger": self.dataloggers[2]}),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": self.dataloggers[3], "span": "hour"},
+            ),
+            ("fetch_data_aggregates", {"fleet": "true", "span": "day"}),
+            ("fetch_data_aggregates", {"bbox": "0,40,10,52", "span": "hour"}),
+            ("fetch_latest", {"datalogger": self.dataloggers}),
+        ]:
+            with self.subTest(name=name, params=params):
+                body, primary, replica = self.get(name, params)
+                self.assertEqual(body, self.primary(name, params))
+                self.assertEqual(primary, 0)
+                self.assertGreater(replica, 0)
+
+    def test_read_your_writes(self):
+        first, later = self.records[:48], self.records[48:]
+        self.ingest(first)
+        self.sync()
+        self.elapse()
+        written = self.dataloggers[0]
+        self.ingest([record for record in later if record["datalogger"] == written])
+
+        # The datalogger just written is read from the primary
+        params = {"datalogger": written, "span": "hour"}
+        body, primary, replica = self.get("fetch_data_aggregates", params)
+        self.assertEqual(body, self.primary("fetch_data_aggregates", params))
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+        # The others and the fleet from a replica not synced yet
+        params = {"datalogger": self.dataloggers[1], "span": "hour"}
+        _, primary, _ = self.get("fetch_data_aggregates", params)
+        self.assertEqual(primary, 0)
+        params = {"fleet": "true", "span": "hour"}
+        stale, primary, _ = self.get("fetch_data_aggregates", params)
+        self.assertEqual(primary, 0)
+        self.assertNotEqual(stale, self.primary("fetch_data_aggregates", params))
+
+        self.sync()
+        self.assertEqual(
+            self.get("fetch_data_aggregates", params)[0],
+            self.primary("fetch_data_aggregates", params),
+        )
+
+        # Changes to every datalogger keep all reads on the primary
+        touch()
+        _, primary, replica = self.get("fetch_data_aggregates", params)
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+    def test_query_batch(self):
+        # Each spec of a batch is routed like its GET request
+        written, other = self.dataloggers[:2]
+        specs = [
+            {"path": reverse("fetch_data_raw"), "params": {"datalogger": written}},
+            {"path": reverse("fetch_data_raw"), "params": {"datalogger": other}},
+            {
+                "path": reverse("fetch_data_aggregates"),
+                "params": {"datalogger": other, "span": "hour"},
+            },
+            {
+                "path": reverse("fetch_data_aggregates"),
+                "params": {"fleet": True, "span": "day"},
+            },
+        ]
+
+        def query():
+            response = self.client.post(reverse("query_batch"), specs, format="json")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [result["body"] for result in response.json()["results"]]
+
+        self.ingest(self.records[:48])
+        self.sync()
+        self.elapse()
+        stale = query()
+        self.ingest(
+            [record for record in self.records[48:] if record["datalogger"] == written]
+        )
+
+        # The datalogger just written is read from the primary, the others
+        # and the fleet from a replica not synced yet
+        results = query()
+        with self.settings(MEASUREMENTS_REPLICAS={}):
+            fresh = query()
+        self.assertEqual(results[0], fresh[0])
+        self.assertNotEqual(results[0], stale[0])
+        self.assertEqual(results[1:], stale[1:])
+        self.assertNotEqual(results[3], fresh[3])
+
+        self.elapse()
+        self.assertEqual(query(), stale)
+
+    def test_replica_blocks_not_cached(self):
+        # A replica not synced after the read-your-writes window misses the
+        # late upload, its blocks must not outlive the next sync
+        self.ingest(self.records[:48])
+        self.sync()
+        self.elapse()
+        datalogger = self.dataloggers[0]
+        self.ingest(
+            [
+                record
+                for record in self.records[48:]
+                if record["datalogger"] == datalogger
+            ]
+        )
+        params = {
+            "datalogger": datalogger,
+            "before": (self.start + datetime.timedelta(days=1)).isoformat(),
+        }
+        with self.settings(
+            MEASUREMENTS_CACHE_ENABLED=True, MEASUREMENTS_READ_YOUR_WRITES_SECONDS=0
+        ):
+            stale, primary, _ = self.get("fetch_data_raw", params)
+            self.assertEqual(primary, 0)
+            self.assertNotEqual(stale, self.primary("fetch_data_raw", params))
+            self.sync()
+            self.assertEqual(
+                self.get("fetch_data_raw", params)[0],
+                self.primary("fetch_data_raw", params),
+            )
+
+    def test_shared_cache_required(self):
+        locmem = measurements_cache(
+            "django.core.cache.backends.locmem.LocMemCache", "replicas"
+        )
+        with self.settings(CACHES=locmem):
+            with self.assertRaises(ImproperlyConfigured):
+                replicas.ReplicaMiddleware(lambda request: None)
+            # Without read-your-writes nothing needs to be shared
+            with self.settings(MEASUREMENTS_READ_YOUR_WRITES_SECONDS=0):
+                replicas.ReplicaMiddleware(lambda request: None)
+            with self.settings(MEASUREMENTS_REPLICAS={}):
+                replicas.ReplicaMiddleware(lambda request: None)
+
+    def test_conditional_get(self):
+        # Validators come from the replica serving the request
+        self.ingest(self.records[:48])
+        self.sync()
+        self.elapse()
+        params = {"datalogger": self.dataloggers[0]}
+        response = self.client.get(reverse("fetch_data_raw"), params)
+        etag = response.headers["ETag"]
+        self.ingest(self.records[48:])
+        self.elapse()
+
+        response = self.client.get(
+            reverse("fetch_data_raw"), params, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.sync()
+        response = self.client.get(
+            reverse("fetch_data_raw"), params, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_router(self):
+        self.assertEqual(router.db_for_read(Datalogger), "default")
+        with replicas.reading():
+            self.assertIn(router.db_for_read(Datalogger), REPLICAS)
+            self.assertEqual(router.db_for_write(Datalogger), "default")
+            # One replica per database for the whole block
+            self.assertEqual(
+                {router.db_for_read(Datalogger) for _ in range(20)},
+                {router.db_for_read(Datalogger)},
+            )
+        self.assertFalse(router.allow_migrate(REPLICAS[0], "measurements"))
+        self.assertTrue(router.allow_migrate("default", "measurements"))
+
+        with self.settings(MEASUREMENTS_REPLICAS={}), replicas.reading():
+            self.assertEqual(router.db_for_read(Datalogger), "default")
+
+
+@override_settings(
+    MEASUREMENTS_SHARDS=SHARDS,
+    MEASUREMENTS_REPLICAS={
+        "default": REPLICAS[:1],
+        **{alias: [f"{alias}_replica0"] for alias in SHARDS},
+    },
+    MEASUREMENTS_CACHE_ENABLED=False,
+)
+class ShardReplicaTests(ReplicaMixin, TransactionTestCase):
+    databases = {
+        "default",
+        REPLICAS[0],
+        *SHARDS,
+        *[f"{alias}_replica0" for alias in SHARDS],
+    }
+
+    def test_fleet_reads(self):
+        # Shards are read from their replicas by the thread pool as well
+        self.ingest(self.records[:48])
+        params = {"fleet": "true", "span": "hour"}
+        expected = self.primary("fetch_data_aggregates", params)
+        self.sync()
+        self.ingest(self.records[48:])
+        self.elapse()
+
+        body, primary, _ = self.get("fetch_data_aggregates", params)
+        self.assertEqual(body, expected)
+        self.assertEqual(primary, 0)
+        self.sync()
+        self.assertEqual(
+            self.get("fetch_data_aggregates", params)[0],
+            self.primary("fetch_data_aggregates", params),
+        )
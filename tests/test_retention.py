@@ -0,0 +1,230 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import io
+
+from measurements.bench import synthetic_records
+from measurements.models import Measurement, MeasurementRecord, MeasurementRollup
+from measurements.rollups import retention_horizon, truncate
+
+
+@override_settings(MEASUREMENTS_RAW_RETENTION_DAYS=7)
+class CompactTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        # One record every 25 minutes from 10 days ago, the first 3 days are
+        # past the retention window
+        self.start = truncate(timezone.now() - datetime.timedelta(days=10), "day")
+        self.records = list(
+            synthetic_records(2, 600, start=self.start, interval=1500, seed=5)
+        )
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.horizon = retention_horizon()
+        self.assertEqual(self.horizon, self.start + datetime.timedelta(days=3))
+
+    def summaries(self, windows, **params):
+        # Responses for the first datalogger and the fleet, over each window
+        url = reverse("fetch_data_aggregates")
+        datalogger = self.records[0]["datalogger"]
+        results = []
+        for span, since, before in windows:
+            query = dict(params, span=span, since=since.isoformat())
+            if before is not None:
+                query["before"] = before.isoformat()
+            results.append(self.client.get(url, dict(query, datalogger=datalogger)))
+            results.append(self.client.get(url, dict(query, fleet="true")))
+        for response in results:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [response.data for response in results]
+
+    def whole(self, **params):
+        # Windows starting and ending on bucket boundaries or past the
+        # horizon. A bucket starting at since is read whole from the rollups
+        # once compacted, the windows start before the first reading.
+        day, hour = datetime.timedelta(days=1), datetime.timedelta(hours=1)
+        return self.summaries(
+            [
+                ("day", self.start - day, None),
+                ("hour", self.start - hour, self.horizon),
+                (
+                    "hour",
+                    self.start + datetime.timedelta(days=1),
+                    self.horizon + datetime.timedelta(hours=7, minutes=30),
+                ),
+                ("day", self.start - day, self.horizon),
+                ("hour", self.horizon + datetime.timedelta(minutes=30), None),
+            ],
+            **params,
+        )
+
+    def partial(self):
+        # Windows starting or ending inside a bucket before the horizon, and
+        # the start of that bucket
+        since = self.start + datetime.timedelta(hours=5)
+        before = self.horizon - datetime.timedelta(hours=2)
+        windows = [
+            ("day", since, None, truncate(since, "day")),
+            ("hour", self.start + datetime.timedelta(minutes=10), None, self.start),
+            (
+                "day",
+                self.start - datetime.timedelta(days=1),
+                before,
+                truncate(before, "day"),
+            ),
+        ]
+        summaries = self.summaries([window[:3] for window in windows])
+        return summaries, [window[3] for window in windows for _ in range(2)]
+
+    def assertCompacted(self, model):
+        self.assertFalse(model.objects.filter(recorded_at__lt=self.horizon).exists())
+        self.assertTrue(model.objects.filter(recorded_at__gte=self.horizon).exists())
+
+    def assertTrimmed(self, summaries, expected, buckets):
+        # Same results without the bucket only partly covered
+        def trimmed(items, bucket):
+            if isinstance(items, dict):
+                return {key: trimmed(value, bucket) for key, value in items.items()}
+            return [
+                item
+                for item in items
+                if datetime.datetime.fromisoformat(item["time_slot"]) != bucket
+            ]
+
+        for result, summary, bucket in zip(summaries, expected, buckets):
+            self.assertNotEqual(result, summary)
+            self.assertEqual(result, trimmed(summary, bucket))
+
+    def test_compact(self):
+        expected = self.whole()
+        self.assertTrue(all(expected))
+        stats = self.whole(stats="min,max,count,avg,sum")
+        partial, buckets = self.partial()
+        # Rollups lost before the compaction are recreated from raw readings
+        MeasurementRollup.objects.filter(
+            span="hour", bucket__lt=self.start + datetime.timedelta(hours=3)
+        ).delete()
+
+        out = io.StringIO()
+        call_command("compact", chunk_size=100, stdout=out)
+        self.assertIn("missing rollups created", out.getvalue())
+        self.assertCompacted(Measurement)
+        self.assertEqual(self.whole(), expected)
+        self.assertEqual(self.whole(stats="min,max,count,avg,sum"), stats)
+        # Partial buckets are only trimmed once their readings are gone
+        self.assertTrimmed(self.partial()[0], partial, buckets)
+
+        # Rebuilding keeps the rollups of compacted periods
+        call_command("rebuild_rollups", stdout=io.StringIO())
+        self.assertEqual(self.whole(), expected)
+
+        # Nothing left to delete
+        out = io.StringIO()
+        call_command("compact", stdout=out)
+        self.assertIn("0 raw rows", out.getvalue())
+
+    def test_compact_wide(self):
+        expected = self.whole()
+        with self.settings(MEASUREMENTS_STORAGE="wide"):
+            call_command("convert_storage", "wide", stdout=io.StringIO())
+            call_command("compact", chunk_size=100, stdout=io.StringIO())
+            self.assertCompacted(MeasurementRecord)
+            self.assertEqual(self.whole(), expected)
+
+    def test_stats_from_rollups(self):
+        # Whole buckets come from the rollup columns, partial ones from the
+        # raw readings, like the values
+        datalogger = self.records[0]["datalogger"]
+        url = reverse("fetch_data_aggregates")
+        since = self.horizon + datetime.timedelta(minutes=30)
+        params = {
+            "datalogger": datalogger,
+            "span": "hour",
+            "since": since.isoformat(),
+            "stats": "min,max,count,avg,sum",
+        }
+        with self.settings(MEASUREMENTS_CACHE_ENABLED=False):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rollups = {
+            (rollup.bucket, rollup.label): rollup
+            for rollup in MeasurementRollup.objects.filter(
+                datalogger__uuid=datalogger, span="hour"
+            )
+        }
+        partial = truncate(since, "hour")
+        for item in response.data:
+            bucket = datetime.datetime.fromisoformat(item["time_slot"])
+            if bucket == partial:
+                self.assertLess(item["count"], rollups[(bucket, item["label"])].count)
+                continue
+            rollup = rollups[(bucket, item["label"])]
+            self.assertEqual(
+                [item["min"], item["max"], item["count"], item["sum"], item["avg"]],
+                [
+                    rollup.minimum,
+                    rollup.maximum,
+                    rollup.count,
+                    rollup.total,
+                    rollup.total / rollup.count,
+                ],
+            )
+        self.assertEqual(
+            datetime.datetime.fromisoformat(response.data[0]["time_slot"]), partial
+        )
+
+    def test_raw_reads_refused(self):
+        # Queries only answered from raw readings cannot reach before the
+        # compaction, neither before it ran
+        datalogger = self.records[0]["datalogger"]
+        url = reverse("fetch_data_aggregates")
+        early = (self.start + datetime.timedelta(days=1)).isoformat()
+        queries = [
+            {"datalogger": datalogger},
+            {"datalogger": datalogger, "since": early},
+            {"datalogger": datalogger, "span": "6h", "since": early},
+            {"datalogger": datalogger, "span": "15m", "stats": "max"},
+            {"fleet": "true", "span": "6h", "since": early},
+        ]
+        for params in queries:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        call_command("compact", stdout=io.StringIO())
+        for params in queries:
+            with self.subTest(params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn(self.horizon.isoformat(), response.data["error"])
+        response = self.client.post(
+            reverse("query_batch"),
+            [{"path": url, "params": params} for params in queries],
+            format="json",
+        )
+        self.assertEqual(
+            [result["status"] for result in response.json()["results"]],
+            [400] * len(queries),
+        )
+
+        # Past the horizon they are answered
+        for params in queries:
+            response = self.client.get(
+                url, dict(params, since=self.horizon.isoformat())
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.data)
+
+    def test_compact_without_retention(self):
+        with self.settings(MEASUREMENTS_RAW_RETENTION_DAYS=None):
+            with self.assertRaises(CommandError):
+                call_command("compact", stdout=io.StringIO())
+        with self.assertRaises(CommandError):
+            call_command("compact", chunk_size=0, stdout=io.StringIO())
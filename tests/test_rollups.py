@@ -0,0 +1,407 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import Avg, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import io
+import uuid
+
+from measurements.bench import synthetic_records
+from measurements.models import Datalogger, Measurement, MeasurementRollup
+from measurements.summary import aggregate_window
+
+
+def raw_aggregates(datalogger, span, since, before):
+    trunc = TruncDay if span == "day" else TruncHour
+    groups = (
+        Measurement.objects.filter(
+            datalogger__uuid=datalogger, recorded_at__gt=since, recorded_at__lt=before
+        )
+        .annotate(time_slot=trunc("recorded_at"))
+        .values("time_slot", "label")
+        .annotate(
+            temp=Avg("value", filter=Q(label="temp")),
+            hum=Avg("value", filter=Q(label="hum")),
+            rain=Sum("value", filter=Q(label="rain")),
+        )
+        .order_by("time_slot", "label")
+    )
+    return [(item["time_slot"], item["label"], item[item["label"]]) for item in groups]
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 3, 1, tzinfo=datetime.timezone.utc)
+        # 2 dataloggers, one record every 25 minutes over ~3.5 days
+        self.records = list(
+            synthetic_records(2, 400, start=self.start, interval=1500, seed=3)
+        )
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.datalogger = uuid.UUID(self.records[0]["datalogger"])
+        self.datalogger_id = Datalogger.objects.get(uuid=self.datalogger).id
+
+    def assertSameAggregates(self, span, since, before):
+        expected = raw_aggregates(self.datalogger, span, since, before)
+        actual = [
+            (item["time_slot"], item["label"], item["value"])
+            for item in aggregate_window(self.datalogger_id, span, since, before)
+        ]
+        self.assertEqual([item[:2] for item in actual], [item[:2] for item in expected])
+        for (_, _, value), (_, _, expected_value) in zip(actual, expected):
+            self.assertAlmostEqual(value, expected_value)
+
+    def assertAlmostSameItems(self, actual, expected):
+        # Rollup totals may differ from a sum of the raw readings in the
+        # last digits
+        self.assertEqual(
+            [item.keys() for item in actual], [item.keys() for item in expected]
+        )
+        for item, expected_item in zip(actual, expected):
+            for key, value in item.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, expected_item[key])
+                else:
+                    self.assertEqual(value, expected_item[key])
+
+    def test_rollups_match_raw_aggregates(self):
+        self.assertEqual(
+            MeasurementRollup.objects.filter(
+                datalogger__uuid=self.datalogger, span="day"
+            ).count(),
+            4 * 3,
+        )
+
+        windows = [
+            (
+                self.start - datetime.timedelta(days=1),
+                self.start + datetime.timedelta(days=5),
+            ),
+            (
+                self.start + datetime.timedelta(hours=5, minutes=10),
+                self.start + datetime.timedelta(days=2, hours=7, minutes=3),
+            ),
+            (
+                self.start + datetime.timedelta(hours=5, minutes=10),
+                self.start + datetime.timedelta(hours=5, minutes=55),
+            ),
+            (self.start, self.start + datetime.timedelta(days=1)),
+        ]
+        for since, before in windows:
+            for span in ["hour", "day"]:
+                with self.subTest(span=span, since=since, before=before):
+                    self.assertSameAggregates(span, since, before)
+
+    def test_summary_reads_rollups(self):
+        url = reverse("fetch_data_aggregates")
+        params = {
+            "datalogger": str(self.datalogger),
+            "span": "day",
+            "since": (self.start + datetime.timedelta(hours=3)).isoformat(),
+            "before": (self.start + datetime.timedelta(days=3, hours=3)).isoformat(),
+        }
+
+        # Datalogger id lookup, then the edge days come from the raw table and
+        # the two full days from rollups
+        with self.assertNumQueries(4):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 4 * 3)
+
+        response = self.client.get(url, dict(params, since="yesterday"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_fleet_summary(self):
+        url = reverse("fetch_data_aggregates")
+        dataloggers = sorted({record["datalogger"] for record in self.records})
+        unknown = str(uuid.uuid4())
+        window = {
+            "span": "hour",
+            "since": (self.start + datetime.timedelta(hours=3, minutes=5)).isoformat(),
+            "before": (self.start + datetime.timedelta(days=2, hours=1)).isoformat(),
+        }
+        expected = {
+            datalogger: self.client.get(url, dict(window, datalogger=datalogger)).data
+            for datalogger in dataloggers
+        }
+        self.assertTrue(all(expected.values()))
+
+        for layout in ["narrow", "wide"]:
+            with self.subTest(layout=layout), self.settings(
+                MEASUREMENTS_STORAGE=layout
+            ):
+                if layout == "wide":
+                    call_command("convert_storage", "wide", stdout=io.StringIO())
+
+                # Datalogger lookup, both edges and the rollups in between,
+                # whatever the number of dataloggers
+                with self.assertNumQueries(4):
+                    response = self.client.get(
+                        url, dict(window, datalogger=",".join(dataloggers + [unknown]))
+                    )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data, dict(expected, **{unknown: []}))
+
+                response = self.client.get(url, dict(window, fleet="true"))
+                self.assertEqual(response.data, expected)
+
+        for params in [
+            {"datalogger": dataloggers},
+            {"fleet": "true", "span": "hour", "limit": 10},
+            {"datalogger": [dataloggers[0], "logger"], "span": "day"},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with self.settings(MEASUREMENTS_SUMMARY_MAX_DATALOGGERS=1):
+            response = self.client.get(url, dict(window, datalogger=dataloggers))
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_summary_arbitrary_spans_and_stats(self):
+        url = reverse("fetch_data_aggregates")
+        window = {
+            "datalogger": str(self.datalogger),
+            "since": (self.start + datetime.timedelta(hours=3, minutes=5)).isoformat(),
+            "before": (self.start + datetime.timedelta(days=2, hours=1)).isoformat(),
+        }
+        since = datetime.datetime.fromisoformat(window["since"])
+        before = datetime.datetime.fromisoformat(window["before"])
+
+        # Expected stats computed in Python from the ingested records
+        expected = {}
+        for record in self.records:
+            at = datetime.datetime.fromisoformat(record["at"])
+            if record["datalogger"] != window["datalogger"]:
+                continue
+            if not since < at < before:
+                continue
+            slot = datetime.datetime.fromtimestamp(
+                int(at.timestamp()) // 900 * 900, datetime.timezone.utc
+            )
+            for measurement in record["measurements"]:
+                key = (slot, measurement["label"])
+                expected.setdefault(key, []).append(measurement["value"])
+        self.assertTrue(expected)
+
+        for layout in ["narrow", "wide"]:
+            with self.subTest(layout=layout), self.settings(
+                MEASUREMENTS_STORAGE=layout
+            ):
+                if layout == "wide":
+                    call_command("convert_storage", "wide", stdout=io.StringIO())
+
+                # Datalogger id lookup and a single GROUP BY
+                with self.assertNumQueries(2):
+                    response = self.client.get(
+                        url, dict(window, span="15m", stats="min,max,count,sum")
+                    )
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(
+                    [
+                        (
+                            datetime.datetime.fromisoformat(item["time_slot"]),
+                            item["label"],
+                        )
+                        for item in response.data
+                    ],
+                    sorted(expected),
+                )
+                for item in response.data:
+                    values = expected[
+                        (
+                            datetime.datetime.fromisoformat(item["time_slot"]),
+                            item["label"],
+                        )
+                    ]
+                    self.assertEqual(
+                        set(item), {"label", "time_slot", *"min max count sum".split()}
+                    )
+                    self.assertEqual(item["count"], len(values))
+                    self.assertEqual(item["min"], min(values))
+                    self.assertEqual(item["max"], max(values))
+                    self.assertAlmostEqual(item["sum"], sum(values))
+
+                # Epoch buckets of an hour or a day match the rollups in UTC
+                for span, width in [("hour", "60m"), ("day", "1d")]:
+                    self.assertAlmostSameItems(
+                        self.client.get(url, dict(window, span=width)).data,
+                        self.client.get(url, dict(window, span=span)).data,
+                    )
+
+                stats = self.client.get(url, dict(window, span="day", stats="avg")).data
+                values = self.client.get(url, dict(window, span="day")).data
+                for item, value in zip(stats, values):
+                    if item["label"] != "rain":
+                        self.assertAlmostEqual(item["avg"], value["value"])
+
+                pages = []
+                params = dict(window, span="6h", stats="count", limit=5)
+                while True:
+                    response = self.client.get(url, params).data
+                    pages.extend(response["results"])
+                    if response["next"] is None:
+                        break
+                    params["cursor"] = response["next"]
+                self.assertEqual(
+                    pages,
+                    self.client.get(url, dict(window, span="6h", stats="count")).data,
+                )
+
+                response = self.client.get(
+                    url, dict(window, span="2h", stats="count", fleet="true")
+                )
+                self.assertEqual(
+                    response.data[window["datalogger"]],
+                    self.client.get(url, dict(window, span="2h", stats="count")).data,
+                )
+
+        for params in [
+            {"span": "15x"},
+            {"span": "0m"},
+            {"span": "367d"},
+            {"span": "99999999999999999999w"},
+            {"span": "week"},
+            {"span": "hour", "stats": "median"},
+            {"stats": "count"},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get(url, dict(window, **params))
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_single_ingest_updates_rollups(self):
+        datalogger = uuid.uuid4()
+        for minutes, value in [(10, 10), (30, 12), (50, 20)]:
+            at = self.start + datetime.timedelta(minutes=minutes)
+            response = self.client.post(
+                reverse("ingest_data"),
+                {
+                    "at": at.isoformat(),
+                    "datalogger": str(datalogger),
+                    "location": {"lat": 1, "lng": 1},
+                    "measurements": [{"label": "temp", "value": value}],
+                },
+                format="json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        rollup = MeasurementRollup.objects.get(datalogger__uuid=datalogger, span="hour")
+        self.assertEqual(rollup.bucket, self.start)
+        self.assertEqual(
+            (rollup.count, rollup.total, rollup.minimum, rollup.maximum),
+            (3, 42, 10, 20),
+        )
+
+    def test_batched_ingest(self):
+        # Totals are added up batch after batch, close to but not always
+        # equal to the sum a rebuild reads from the raw readings
+        records = list(synthetic_records(1, 150, start=self.start, seed=5))
+        for start in range(0, len(records), 4):
+            response = self.client.post(
+                reverse("ingest_data_batch"),
+                records[start : start + 4],
+                format="json",
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rollups = MeasurementRollup.objects.filter(
+            datalogger__uuid=records[0]["datalogger"]
+        )
+        fields = ["span", "bucket", "label", "count", "minimum", "maximum", "total"]
+        merged = sorted(rollups.values_list(*fields))
+        call_command("rebuild_rollups", stdout=io.StringIO())
+        rebuilt = sorted(rollups.values_list(*fields))
+
+        self.assertEqual(
+            [rollup[:-1] for rollup in merged], [rollup[:-1] for rollup in rebuilt]
+        )
+        for rollup, expected in zip(merged, rebuilt):
+            self.assertAlmostEqual(rollup[-1], expected[-1])
+
+    def test_rebuild_rollups(self):
+        expected = sorted(
+            MeasurementRollup.objects.values_list(
+                "datalogger", "span", "bucket", "label", "count", "minimum", "maximum"
+            )
+        )
+        MeasurementRollup.objects.all().delete()
+        MeasurementRollup.objects.create(
+            datalogger=Datalogger.objects.create(uuid=uuid.uuid4()),
+            span="day",
+            bucket=self.start,
+            label="temp",
+            count=1,
+            total=1,
+            minimum=1,
+            maximum=1,
+        )
+
+        out = io.StringIO()
+        call_command("rebuild_rollups", stdout=out)
+        self.assertIn(f"{len(expected)} rollups rebuilt", out.getvalue())
+        self.assertEqual(
+            sorted(
+                MeasurementRollup.objects.values_list(
+                    "datalogger",
+                    "span",
+                    "bucket",
+                    "label",
+                    "count",
+                    "minimum",
+                    "maximum",
+                )
+            ),
+            expected,
+        )
+
+        MeasurementRollup.objects.filter(datalogger__uuid=self.datalogger).delete()
+        call_command(
+            "rebuild_rollups", datalogger=str(self.datalogger), stdout=io.StringIO()
+        )
+        self.assertEqual(MeasurementRollup.objects.count(), len(expected))
+
+        with self.assertRaises(CommandError):
+            call_command("rebuild_rollups", datalogger="logger")
+        with self.assertRaises(CommandError):
+            call_command("rebuild_rollups", datalogger=str(uuid.uuid4()))
+
+
+class UpgradeTests(TransactionTestCase):
+    def test_existing_measurements(self):
+        # Measurements stored before the rollups table get their rollups
+        # from the migration creating it
+        client = APIClient()
+        records = list(synthetic_records(2, 30, interval=1200, seed=11))
+        response = client.post(reverse("ingest_data_batch"), records, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Dataloggers are created again by the migrations
+        fields = [
+            "datalogger__uuid",
+            "span",
+            "bucket",
+            "label",
+            "count",
+            "minimum",
+            "maximum",
+        ]
+        expected = sorted(MeasurementRollup.objects.values_list(*fields))
+
+        executor = MigrationExecutor(connection)
+        latest = executor.loader.graph.leaf_nodes("measurements")
+        self.addCleanup(MigrationExecutor(connection).migrate, latest)
+        executor.migrate([("measurements", "0001_initial")])
+        executor = MigrationExecutor(connection)
+        executor.migrate(latest)
+
+        self.assertEqual(
+            sorted(MeasurementRollup.objects.values_list(*fields)), expected
+        )
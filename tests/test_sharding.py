@@ -0,0 +1,254 @@
+from django.core.management import call_command
+from django.db import connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import io
+import uuid
+from unittest import mock
+
+from measurements import keys, latest, sharding
+from measurements.bench import synthetic_records
+from measurements.ingest import ingest_records
+from measurements.models import (
+    Datalogger,
+    LatestReading,
+    Location,
+    Measurement,
+    MeasurementRecord,
+    MeasurementRollup,
+)
+
+SHARDS = ["shard0", "shard1", "shard2"]
+
+
+def rounded(value):
+    # Rollups merged by a rebalance add partial sums in another order
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, list):
+        return [rounded(item) for item in value]
+    if isinstance(value, dict):
+        return {key: rounded(item) for key, item in value.items()}
+    return value
+
+
+def sharded_rows(alias):
+    # (datalogger id, model name) of the rows stored in a database
+    return {
+        (datalogger_id, model._meta.model_name)
+        for model in [Measurement, MeasurementRecord, MeasurementRollup, LatestReading]
+        for datalogger_id in model.objects.using(alias)
+        .values_list("datalogger_id", flat=True)
+        .distinct()
+    }
+
+
+class ShardingMixin:
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.addCleanup(latest.invalidate)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 10, 1, tzinfo=datetime.timezone.utc)
+        self.records = list(
+            synthetic_records(8, 240, start=self.start, interval=900, seed=13)
+        )
+        self.dataloggers = sorted({record["datalogger"] for record in self.records})
+
+    def ingest(self, records):
+        response = self.client.post(
+            reverse("ingest_data_batch"), records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def responses(self):
+        since = (self.start + datetime.timedelta(minutes=50)).isoformat()
+        requests = [
+            ("fetch_data_raw", {"datalogger": self.dataloggers[0]}),
+            ("fetch_data_raw", {"datalogger": self.dataloggers[-1], "since": since}),
+            ("fetch_data_aggregates", {"datalogger": self.dataloggers[1]}),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": self.dataloggers[2], "span": "hour", "since": since},
+            ),
+            ("fetch_data_aggregates", {"fleet": "true", "span": "hour"}),
+            (
+                "fetch_data_aggregates",
+                {"fleet": "true", "span": "day", "since": since},
+            ),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": self.dataloggers[:5], "span": "6h", "stats": "min,max"},
+            ),
+            ("fetch_data_aggregates", {"bbox": "0,40,10,52", "span": "day"}),
+            ("fetch_latest", {"datalogger": self.dataloggers}),
+        ]
+        results = []
+        for name, params in requests:
+            response = self.client.get(reverse(name), params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            results.append(response.json())
+
+        out = io.StringIO()
+        call_command(
+            "export_measurements", format="csv", stdout=out, stderr=io.StringIO()
+        )
+        results.append(sorted(out.getvalue().splitlines()))
+        return results
+
+    def assertPlaced(self):
+        # Rows only live on the shard of their datalogger
+        for alias in ["default", *SHARDS]:
+            for datalogger_id, _ in sharded_rows(alias):
+                self.assertEqual(sharding.shard_for(datalogger_id), alias)
+
+
+@override_settings(MEASUREMENTS_SHARDS=SHARDS)
+class ShardingTests(ShardingMixin, TestCase):
+    databases = {"default", *SHARDS}
+
+    def test_shard_for(self):
+        placed = {sharding.shard_for(datalogger_id) for datalogger_id in range(30)}
+        self.assertEqual(placed, set(SHARDS))
+        self.assertEqual(
+            sharding.split([1, 2, 3, 4]),
+            {
+                alias: [i for i in [1, 2, 3, 4] if sharding.shard_for(i) == alias]
+                for alias in SHARDS
+                if any(sharding.shard_for(i) == alias for i in [1, 2, 3, 4])
+            },
+        )
+        with self.settings(MEASUREMENTS_SHARDS=[]):
+            self.assertEqual(sharding.shard_for(12), "default")
+            self.assertEqual(sharding.split(None), {"default": None})
+
+    def test_same_responses(self):
+        for layout in ["narrow", "wide"]:
+            with self.subTest(layout=layout), self.settings(
+                MEASUREMENTS_STORAGE=layout, MEASUREMENTS_CACHE_ENABLED=False
+            ):
+                with self.settings(MEASUREMENTS_SHARDS=[]):
+                    self.ingest(self.records)
+                    expected = self.responses()
+                    Datalogger.objects.all().delete()
+                    Location.objects.all().delete()
+                    keys.clear()
+
+                self.ingest(self.records)
+                self.assertEqual(self.responses(), expected)
+                self.assertPlaced()
+                self.assertFalse(sharded_rows("default"))
+                # Dataloggers and locations are in every database
+                for alias in SHARDS:
+                    self.assertEqual(Datalogger.objects.using(alias).count(), 8)
+                    self.assertEqual(Location.objects.using(alias).count(), 8)
+                for alias in ["default", *SHARDS]:
+                    Datalogger.objects.using(alias).all().delete()
+                    Location.objects.using(alias).all().delete()
+                keys.clear()
+
+    def test_single_shard_reads(self):
+        self.ingest(self.records)
+        datalogger_id = keys.datalogger_id(uuid.UUID(self.dataloggers[0]))
+        alias = sharding.shard_for(datalogger_id)
+        others = [other for other in SHARDS if other != alias]
+        contexts = [CaptureQueriesContext(connections[other]) for other in others]
+        for context in contexts:
+            context.__enter__()
+        for name, params in [
+            ("fetch_data_raw", {"datalogger": self.dataloggers[0]}),
+            ("fetch_data_aggregates", {"datalogger": self.dataloggers[0]}),
+            (
+                "fetch_data_aggregates",
+                {"datalogger": self.dataloggers[0], "span": "hour"},
+            ),
+        ]:
+            response = self.client.get(reverse(name), params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.data)
+        for context in contexts:
+            context.__exit__(None, None, None)
+            self.assertEqual(len(context), 0)
+
+    def test_rollback(self):
+        # A failure after the shards were written leaves nothing behind
+        records = [
+            dict(record, measurements=record["measurements"][:1])
+            for record in self.records[:16]
+        ]
+        payload = [
+            dict(
+                record,
+                at=datetime.datetime.fromisoformat(record["at"]),
+                datalogger=uuid.UUID(record["datalogger"]),
+            )
+            for record in records
+        ]
+        with mock.patch(
+            "measurements.ingest.caching.invalidate", side_effect=RuntimeError
+        ):
+            with self.assertRaises(RuntimeError):
+                with sharding.atomic():
+                    ingest_records(payload)
+        for alias in ["default", *SHARDS]:
+            self.assertFalse(sharded_rows(alias))
+            self.assertFalse(Datalogger.objects.using(alias).exists())
+
+        keys.clear()
+        self.ingest(records)
+        self.assertPlaced()
+
+    def test_rebalance(self):
+        with self.settings(MEASUREMENTS_SHARDS=[], MEASUREMENTS_CACHE_ENABLED=False):
+            self.ingest(self.records)
+            expected = rounded(self.responses())
+            Datalogger.objects.all().delete()
+            Location.objects.all().delete()
+            keys.clear()
+
+            self.ingest(self.records[:120])
+        # Restarted with two shards, the same dataloggers keep sending readings
+        keys.clear()
+        with self.settings(MEASUREMENTS_SHARDS=SHARDS[:2]):
+            self.ingest(self.records[120:])
+
+        # Readings of the default database and of two shards spread over three
+        out = io.StringIO()
+        call_command("rebalance_shards", chunk_size=50, stdout=out)
+        self.assertIn("of 8 dataloggers moved across 3 shards", out.getvalue())
+        self.assertPlaced()
+        with self.settings(MEASUREMENTS_CACHE_ENABLED=False):
+            self.assertEqual(rounded(self.responses()), expected)
+
+        # Back to a single database, the shards left are given as sources
+        with self.settings(MEASUREMENTS_SHARDS=[], MEASUREMENTS_CACHE_ENABLED=False):
+            call_command(
+                "rebalance_shards", source=SHARDS, chunk_size=7, stdout=io.StringIO()
+            )
+            for alias in SHARDS:
+                self.assertFalse(sharded_rows(alias))
+            self.assertEqual(rounded(self.responses()), expected)
+
+            out = io.StringIO()
+            call_command("rebalance_shards", stdout=out)
+            self.assertIn("0 rows of 0 dataloggers", out.getvalue())
+
+
+@override_settings(MEASUREMENTS_SHARDS=SHARDS, MEASUREMENTS_CACHE_ENABLED=False)
+class FanOutTests(ShardingMixin, TransactionTestCase):
+    # Outside of a transaction shards are read from the thread pool
+    databases = {"default", *SHARDS}
+
+    def test_parallel_reads(self):
+        self.ingest(self.records)
+        # Inside a transaction the shards are read one after the other
+        with transaction.atomic(using=SHARDS[0]):
+            expected = self.responses()
+
+        with mock.patch.object(sharding, "_call", wraps=sharding._call) as call:
+            self.assertEqual(self.responses(), expected)
+        self.assertTrue(call.called)
@@ -0,0 +1,160 @@
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import datetime
+import io
+import uuid
+
+from measurements import keys
+from measurements.bench import synthetic_records
+from measurements.models import Measurement, MeasurementRecord, MeasurementRollup
+
+
+@override_settings(MEASUREMENTS_CACHE_ENABLED=False)
+class StorageTests(TestCase):
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+        # 2 dataloggers, one record every 17 minutes over ~1.8 days
+        self.records = list(
+            synthetic_records(2, 300, start=self.start, interval=1020, seed=7)
+        )
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.datalogger = self.records[0]["datalogger"]
+
+    def paginate(self, url, params):
+        results = []
+        params = dict(params, limit=7)
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            results.extend(response.data["results"])
+            if response.data["next"] is None:
+                return results
+            params["cursor"] = response.data["next"]
+
+    def responses(self):
+        data_url = reverse("fetch_data_raw")
+        summary_url = reverse("fetch_data_aggregates")
+        window = {
+            "datalogger": self.datalogger,
+            "since": (self.start + datetime.timedelta(hours=2, minutes=5)).isoformat(),
+            "before": (self.start + datetime.timedelta(days=1, hours=9)).isoformat(),
+        }
+        responses = {
+            "data": self.client.get(data_url, {"datalogger": self.datalogger}).data,
+            "data_window": self.client.get(data_url, window).data,
+            "data_pages": self.paginate(data_url, window),
+            "data_ndjson": b"".join(
+                self.client.get(
+                    data_url, dict(window, format="ndjson")
+                ).streaming_content
+            ),
+            "summary_raw": self.client.get(summary_url, window).data,
+            "summary_pages": self.paginate(summary_url, dict(window, span="hour")),
+        }
+        for span in ["hour", "day"]:
+            responses[f"summary_{span}"] = self.client.get(
+                summary_url, dict(window, span=span)
+            ).data
+        return responses
+
+    def test_layouts_serve_the_same_responses(self):
+        expected = self.responses()
+        self.assertEqual(len(expected["data"]), 150 * 3)
+
+        out = io.StringIO()
+        call_command("convert_storage", "wide", "--chunk-size", 50, stdout=out)
+        self.assertIn("900 measurements moved to the wide layout", out.getvalue())
+        self.assertIn("MEASUREMENTS_STORAGE = 'wide'", out.getvalue())
+        self.assertEqual(Measurement.objects.count(), 0)
+        self.assertEqual(MeasurementRecord.objects.count(), 300)
+
+        with self.settings(MEASUREMENTS_STORAGE="wide"):
+            self.assertEqual(self.responses(), expected)
+
+        call_command("convert_storage", "narrow", stdout=io.StringIO())
+        self.assertEqual(Measurement.objects.count(), 900)
+        self.assertEqual(MeasurementRecord.objects.count(), 0)
+        self.assertEqual(self.responses(), expected)
+
+    @override_settings(MEASUREMENTS_STORAGE="wide")
+    def test_wide_ingest(self):
+        datalogger = uuid.uuid4()
+        at = self.start + datetime.timedelta(minutes=10)
+        records = [
+            {
+                "at": at.isoformat(),
+                "datalogger": str(datalogger),
+                "location": {"lat": 1, "lng": 1},
+                "measurements": [
+                    {"label": "temp", "value": 10},
+                    {"label": "hum", "value": 60},
+                    {"label": "temp", "value": 12},
+                ],
+            },
+            {
+                "at": (at + datetime.timedelta(minutes=10)).isoformat(),
+                "datalogger": str(datalogger),
+                "location": {"lat": 1, "lng": 1},
+                "measurements": [{"label": "rain", "value": 0.4}],
+            },
+        ]
+        response = self.client.post(
+            reverse("ingest_data_batch"), records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # A label repeated within a record keeps its last value
+        self.assertEqual(response.data, {"records": 2, "measurements": 3})
+        self.assertEqual(
+            list(
+                MeasurementRecord.objects.filter(datalogger__uuid=datalogger)
+                .order_by("recorded_at")
+                .values_list("temp", "rain", "hum")
+            ),
+            [(12, None, 60), (None, 0.4, None)],
+        )
+        rollup = MeasurementRollup.objects.get(
+            datalogger__uuid=datalogger, span="hour", label="temp"
+        )
+        self.assertEqual((rollup.count, rollup.total), (1, 12))
+
+        response = self.client.get(
+            reverse("fetch_data_raw"), {"datalogger": str(datalogger)}
+        )
+        self.assertEqual(
+            [(item["label"], item["value"]) for item in response.data],
+            [("temp", 12), ("hum", 60), ("rain", 0.4)],
+        )
+
+    def test_rebuild_rollups_from_wide_layout(self):
+        expected = sorted(
+            MeasurementRollup.objects.values_list(
+                "datalogger", "span", "bucket", "label", "count", "minimum", "maximum"
+            )
+        )
+        call_command("convert_storage", "wide", stdout=io.StringIO())
+
+        with self.settings(MEASUREMENTS_STORAGE="wide"):
+            call_command("rebuild_rollups", stdout=io.StringIO())
+        self.assertEqual(
+            sorted(
+                MeasurementRollup.objects.values_list(
+                    "datalogger",
+                    "span",
+                    "bucket",
+                    "label",
+                    "count",
+                    "minimum",
+                    "maximum",
+                )
+            ),
+            expected,
+        )
@@ -0,0 +1,153 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import csv
+import datetime
+import io
+import os
+import tempfile
+
+from measurements import keys
+from measurements.bench import synthetic_records
+from measurements.models import Measurement, MeasurementRecord, MeasurementRollup
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+        self.start = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+        self.records = list(
+            synthetic_records(3, 300, start=self.start, interval=900, seed=4)
+        )
+        response = self.client.post(
+            reverse("ingest_data_batch"), self.records, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.dataloggers = sorted({record["datalogger"] for record in self.records})
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def snapshot(self):
+        url = reverse("fetch_data_raw")
+        data = {
+            datalogger: [
+                (item["label"], item["recorded_at"], item["value"])
+                for item in self.client.get(url, {"datalogger": datalogger}).data
+            ]
+            for datalogger in self.dataloggers
+        }
+        rollups = sorted(
+            MeasurementRollup.objects.values_list(
+                "datalogger__uuid", "span", "bucket", "label", "count", "minimum"
+            )
+        )
+        return data, rollups
+
+    def export(self, name, *args):
+        path = os.path.join(self.directory, name)
+        call_command("export_measurements", path, *args, stderr=io.StringIO())
+        return path
+
+    def clear(self):
+        Measurement.objects.all().delete()
+        MeasurementRecord.objects.all().delete()
+        MeasurementRollup.objects.all().delete()
+
+    def test_round_trip(self):
+        expected = self.snapshot()
+        for name, workers in [("all.csv", 1), ("all.ndjson", 1), ("all.ndjson", 2)]:
+            with self.subTest(name=name, workers=workers):
+                path = self.export(name)
+                self.clear()
+                out = io.StringIO()
+                call_command(
+                    "import_measurements",
+                    path,
+                    workers=workers,
+                    batch_size=70,
+                    stdout=out,
+                    stderr=io.StringIO(),
+                )
+                self.assertIn(f"{len(self.records)} records", out.getvalue())
+                self.assertEqual(self.snapshot(), expected)
+
+        # Both layouts export the same readings
+        with open(self.export("narrow.csv")) as export:
+            narrow = sorted(csv.reader(export))
+        with self.settings(MEASUREMENTS_STORAGE="wide"):
+            call_command("convert_storage", "wide", stdout=io.StringIO())
+            with open(self.export("wide.csv")) as export:
+                self.assertEqual(sorted(csv.reader(export)), narrow)
+
+    def test_blank_csv_rows(self):
+        expected = self.snapshot()
+        path = self.export("all.csv")
+        with open(path) as export:
+            lines = export.read().splitlines()
+        with open(path, "w") as export:
+            export.write("\n".join(lines[:40] + ["", " "] + lines[40:] + ["", ""]))
+        self.clear()
+
+        out = io.StringIO()
+        call_command("import_measurements", path, stdout=out, stderr=io.StringIO())
+        self.assertIn(f"{len(self.records)} records", out.getvalue())
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_export_filters(self):
+        since = self.start + datetime.timedelta(hours=10)
+        out = io.StringIO()
+        call_command(
+            "export_measurements",
+            format="ndjson",
+            datalogger=[self.dataloggers[0]],
+            since=since.isoformat(),
+            stdout=out,
+            stderr=io.StringIO(),
+        )
+        expected = [
+            record
+            for record in self.records
+            if record["datalogger"] == self.dataloggers[0]
+            and datetime.datetime.fromisoformat(record["at"]) > since
+        ]
+        self.assertEqual(len(out.getvalue().splitlines()), len(expected))
+
+        for options in [{"datalogger": ["logger"]}, {"before": "tomorrow"}]:
+            with self.subTest(options=options):
+                with self.assertRaises(CommandError):
+                    call_command("export_measurements", stdout=io.StringIO(), **options)
+
+    def test_invalid_records(self):
+        path = self.export("all.csv")
+        with open(path, newline="") as export:
+            rows = list(csv.reader(export))
+        # Errors are reported on the first line of their record
+        rows[1][4] = "wind"
+        with open(path, "w", newline="") as export:
+            csv.writer(export).writerows(rows)
+        record_rows = [row for row in rows if row[:4] == rows[1][:4]]
+        self.clear()
+
+        err = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command("import_measurements", path, stdout=io.StringIO(), stderr=err)
+        self.assertIn("Line 2:", err.getvalue())
+        self.assertFalse(Measurement.objects.exists())
+
+        out = io.StringIO()
+        call_command(
+            "import_measurements",
+            path,
+            skip_invalid=True,
+            stdout=out,
+            stderr=io.StringIO(),
+        )
+        self.assertIn("1 invalid records skipped", out.getvalue())
+        self.assertEqual(Measurement.objects.count(), len(rows) - 1 - len(record_rows))
@@ -0,0 +1,141 @@
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
+
+import copy
+import json
+
+from measurements import keys
+from measurements.bench import synthetic_records
+from measurements.models import Measurement
+from measurements.validation import validate_record
+
+
+def _json(value):
+    # Errors hold ErrorDetail strings and validated data UUIDs and datetimes
+    return json.loads(json.dumps(value, default=str))
+
+
+class ValidationTests(SimpleTestCase):
+    def setUp(self):
+        self.record = next(synthetic_records(1, 1, seed=3))
+
+    def variant(self, path, value):
+        record = copy.deepcopy(self.record)
+        *parents, key = path
+        target = record
+        for parent in parents:
+            target = target[parent]
+        if value is KeyError:
+            del target[key]
+        else:
+            target[key] = value
+        return record
+
+    def assertSamePaths(self, data):
+        fast = validate_record(data, fast=True)
+        slow = validate_record(data, fast=False)
+        self.assertEqual(_json(fast), _json(slow))
+        return fast
+
+    def test_valid_records(self):
+        for record in synthetic_records(3, 30, seed=8):
+            with self.subTest(record=record):
+                validated, errors = self.assertSamePaths(record)
+                self.assertIsNone(errors)
+                self.assertEqual(validated["at"].utcoffset().total_seconds(), 0)
+
+        for path, value in [
+            (["at"], "2024-05-01T12:00:00+02:00"),
+            (["at"], "2024-05-01T12:00:00"),
+            (["at"], "2024-05-01 12:00Z"),
+            (["datalogger"], "c4a1b2c3d4e5f60718293a4b5c6d7e8f"),
+            (["datalogger"], 5),
+            (["location", "lat"], 0),
+            (["location", "lng"], "1.5"),
+            (["location", "extra"], 1),
+            (["measurements"], []),
+            (["measurements", 0, "value"], True),
+            (["measurements", 0, "value"], "12"),
+            (["unknown"], None),
+        ]:
+            with self.subTest(path=path, value=value):
+                _, errors = self.assertSamePaths(self.variant(path, value))
+                self.assertIsNone(errors)
+
+    def test_invalid_records(self):
+        for path, value in [
+            (["at"], KeyError),
+            (["at"], None),
+            (["at"], "yesterday"),
+            (["at"], 12),
+            (["datalogger"], "logger"),
+            (["location"], "string"),
+            (["location"], {"key": 5.6}),
+            (["location", "lat"], -2.5),
+            (["location", "lng"], None),
+            (["location", "lng"], "x" * 1001),
+            (["location", "lat"], 10**400),
+            (["measurements"], "string"),
+            (["measurements"], {"label": "temp"}),
+            (["measurements", 0], "temp"),
+            (["measurements", 0], {"key": 5.6}),
+            (["measurements", 0, "label"], "wind"),
+            (["measurements", 0, "label"], None),
+            (["measurements", 0, "value"], KeyError),
+            (["measurements", 0, "value"], 500),
+            (["measurements", 1, "value"], -0.2),
+            (["measurements", 2, "value"], 0),
+            (["measurements", 2, "value"], 8),
+        ]:
+            with self.subTest(path=path, value=value):
+                validated, errors = self.assertSamePaths(self.variant(path, value))
+                self.assertIsNone(validated)
+                self.assertTrue(errors)
+
+        for data in [None, [], "record"]:
+            with self.subTest(data=data):
+                self.assertIsNone(self.assertSamePaths(data)[0])
+
+    def test_range_errors(self):
+        _, errors = validate_record(self.variant(["measurements", 0, "value"], 41))
+        self.assertEqual(
+            errors,
+            {"measurements": ["Temperature must be between -20 and 40, got 41.0"]},
+        )
+
+
+class ValidationSettingTests(TestCase):
+    # Ingest answers and stores the same whichever validator runs first
+    def setUp(self):
+        self.addCleanup(keys.clear)
+        self.client = APIClient()
+
+    def ingest(self, records, fast):
+        with self.settings(MEASUREMENTS_FAST_VALIDATION=fast):
+            response = self.client.post(
+                reverse("ingest_data_batch"), records, format="json"
+            )
+        return response.status_code, _json(response.data)
+
+    def test_same_responses(self):
+        records = list(synthetic_records(2, 6, seed=4))
+        invalid = copy.deepcopy(records)
+        invalid[1]["location"] = "string"
+        invalid[4]["measurements"][0]["value"] = 500
+        self.assertEqual(self.ingest(invalid, True), self.ingest(invalid, False))
+        self.assertFalse(Measurement.objects.exists())
+
+        status_code, body = self.ingest(records[:3], False)
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual((status_code, body), self.ingest(records[3:], True))
+        stored = Measurement.objects.values_list("recorded_at", "label", "value")
+        self.assertEqual(
+            sorted((row[0].isoformat(), *row[1:]) for row in stored),
+            sorted(
+                (record["at"], measurement["label"], measurement["value"])
+                for record in records
+                for measurement in record["measurements"]
+            ),
+        )
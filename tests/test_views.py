@@ -10,46 +10,43 @@ import uuid
 
 from datetime import datetime, timedelta
 
-from measurements.models import Measurement
+from measurements import columnar
+from measurements.models import Datalogger, Location, Measurement
+from measurements.pagination import encode_cursor
+from measurements.streaming import format_datetime
 
 
 class MeasurementAPITests(TestCase):
     def setUp(self):
         self.client = APIClient()
         self.datalogger = uuid.uuid4()
+        datalogger = Datalogger.objects.create(uuid=self.datalogger)
 
         for i in range(10):
+            location = Location.objects.create(lat=0.5 + i, lng=0.5 + i)
+
             Measurement.objects.create(
                 label="temp",
                 value=20.5 + i,
                 recorded_at=timezone.now() - timedelta(hours=i),
-                datalogger=self.datalogger,
-                location={
-                    "lat": 0.5 + i,
-                    "lng": 0.5 + i,
-                },
+                datalogger=datalogger,
+                location=location,
             )
 
             Measurement.objects.create(
                 label="rain",
                 value=0.2 * i,
                 recorded_at=timezone.now() - timedelta(hours=i),
-                datalogger=self.datalogger,
-                location={
-                    "lat": 0.5 + i,
-                    "lng": 0.5 + i,
-                },
+                datalogger=datalogger,
+                location=location,
             )
 
             Measurement.objects.create(
                 label="hum",
                 value=50.0 + i,
                 recorded_at=timezone.now() - timedelta(hours=i),
-                datalogger=self.datalogger,
-                location={
-                    "lat": 0.5 + i,
-                    "lng": 0.5 + i,
-                },
+                datalogger=datalogger,
+                location=location,
             )
 
     def test_measurement_repr(self):
@@ -80,7 +77,7 @@ class MeasurementAPITests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
         self.assertTrue(
-            Measurement.objects.filter(datalogger=data["datalogger"]).exists()
+            Measurement.objects.filter(datalogger__uuid=data["datalogger"]).exists()
         )
 
         # Errors
@@ -237,11 +234,8 @@ class MeasurementAPITests(TestCase):
                 label="temp",
                 value=temp_value,
                 recorded_at=timezone.now(),
-                datalogger=datalogger,
-                location={
-                    "lat": 0.5 + i,
-                    "lng": 0.5 + i,
-                },
+                datalogger=Datalogger.objects.get_or_create(uuid=datalogger)[0],
+                location=Location.objects.get_or_create(lat=0.5 + i, lng=0.5 + i)[0],
             )
         url = reverse("fetch_data_aggregates")
         response = self.client.get(url, {"datalogger": str(datalogger), "span": "day"})
@@ -266,3 +260,293 @@ class MeasurementAPITests(TestCase):
         )
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ingest_data_batch(self):
+        url = reverse("ingest_data_batch")
+        datalogger = str(uuid.uuid4())
+        records = [
+            {
+                "at": (timezone.now() - timedelta(minutes=i)).isoformat(),
+                "datalogger": datalogger,
+                "location": {
+                    "lat": 47.56321,
+                    "lng": 1.524568,
+                },
+                "measurements": [
+                    {
+                        "label": "temp",
+                        "value": 10.5,
+                    },
+                    {
+                        "label": "hum",
+                        "value": 60,
+                    },
+                ],
+            }
+            for i in range(5)
+        ]
+
+        response = self.client.post(url, records, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"records": 5, "measurements": 10})
+        self.assertEqual(
+            Measurement.objects.filter(datalogger__uuid=datalogger).count(), 10
+        )
+
+        # NDJSON body
+        datalogger = str(uuid.uuid4())
+        body = "\n".join(
+            json.dumps(dict(record, datalogger=datalogger)) for record in records
+        )
+        response = self.client.post(
+            url, body + "\n\n", content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            Measurement.objects.filter(datalogger__uuid=datalogger).count(), 10
+        )
+
+        # Errors are reported per record and nothing is stored
+        datalogger = str(uuid.uuid4())
+        error_records = [dict(record, datalogger=datalogger) for record in records]
+        error_records[1] = dict(error_records[1], location="string")
+        error_records[3] = dict(
+            error_records[3], measurements=[{"label": "temp", "value": 500}]
+        )
+        response = self.client.post(url, error_records, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([error["index"] for error in response.data["errors"]], [1, 3])
+        self.assertIn("location", response.data["errors"][0]["errors"])
+        self.assertIn("measurements", response.data["errors"][1]["errors"])
+        self.assertFalse(
+            Measurement.objects.filter(datalogger__uuid=datalogger).exists()
+        )
+
+        response = self.client.post(url, records[0], format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            url, "{not json}\n", content_type="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with self.settings(MEASUREMENTS_BATCH_MAX_RECORDS=2):
+            response = self.client.post(url, records, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_fetch_data_raw_streaming(self):
+        url = reverse("fetch_data_raw")
+        json_response = self.client.get(url, {"datalogger": str(self.datalogger)})
+
+        response = self.client.get(
+            url,
+            {"datalogger": str(self.datalogger)},
+            HTTP_ACCEPT="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 30)
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [dict(item) for item in json_response.data],
+        )
+
+        response = self.client.get(
+            url,
+            {"datalogger": str(self.datalogger), "format": "csv"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "label,recorded_at,value")
+        self.assertEqual(len(lines), 31)
+        first = json_response.data[0]
+        self.assertEqual(
+            lines[1], f"{first['label']},{first['recorded_at']},{first['value']}"
+        )
+
+        # Errors are rendered in the requested format
+        response = self.client.get(
+            url, {"datalogger": "logger"}, HTTP_ACCEPT="application/x-ndjson"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            json.loads(response.content), {"error": "Invalid datalogger ID format"}
+        )
+
+        response = self.client.get(url, HTTP_ACCEPT="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.content.decode().splitlines(),
+            ["error", "Missing required datalogger parameter"],
+        )
+
+    def test_fetch_data_raw_columnar(self):
+        url = reverse("fetch_data_raw")
+        json_response = self.client.get(url, {"datalogger": str(self.datalogger)})
+
+        response = self.client.get(
+            url,
+            {"datalogger": str(self.datalogger)},
+            HTTP_ACCEPT="application/x-measurements-columnar",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response["Content-Type"], "application/x-measurements-columnar"
+        )
+        columns = columnar.decode(response.content)
+        self.assertEqual(sorted(columns["labels"]), ["hum", "rain", "temp"])
+        self.assertEqual(len(columns["value"]), 30)
+        self.assertEqual(
+            [
+                {
+                    "label": label,
+                    "recorded_at": format_datetime(recorded_at),
+                    "value": value,
+                }
+                for label, recorded_at, value in columnar.iter_rows(response.content)
+            ],
+            [dict(item) for item in json_response.data],
+        )
+
+        response = self.client.get(
+            url, {"datalogger": str(uuid.uuid4()), "format": "columnar"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(columnar.iter_rows(response.content)), [])
+
+        # Errors have no columnar form and are sent as JSON
+        response = self.client.get(url, {"format": "columnar"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(
+            json.loads(response.content),
+            {"error": "Missing required datalogger parameter"},
+        )
+
+        with self.assertRaises(ValueError):
+            columnar.decode(b"\0" * 16)
+
+        # Whole windows only, like the streamed formats
+        for fmt in ["columnar", "ndjson", "csv"]:
+            for params in [{"limit": 5}, {"cursor": "x"}]:
+                with self.subTest(format=fmt, params=params):
+                    response = self.client.get(
+                        url,
+                        dict(params, datalogger=str(self.datalogger), format=fmt),
+                    )
+                    self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                    self.assertEqual(
+                        response.data,
+                        {"error": f"Pagination is not supported with format {fmt}"},
+                    )
+
+    def test_fetch_data_raw_paginated(self):
+        url = reverse("fetch_data_raw")
+        expected = sorted(
+            Measurement.objects.filter(datalogger__uuid=self.datalogger).values_list(
+                "recorded_at", "id"
+            )
+        )
+
+        seen = []
+        params = {"datalogger": str(self.datalogger), "limit": 7}
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data["results"]), 7)
+            seen.extend(item["recorded_at"] for item in response.data["results"])
+            if response.data["next"] is None:
+                break
+            params["cursor"] = response.data["next"]
+
+        self.assertEqual(len(seen), 30)
+        self.assertEqual(seen, sorted(seen))
+
+        # Ties on recorded_at are broken by id so no row is skipped, the
+        # labels of each hour share their time
+        for label in ["temp", "rain", "hum"]:
+            rows = Measurement.objects.filter(label=label).order_by("recorded_at")
+            for hours, measurement in enumerate(rows):
+                measurement.recorded_at = expected[0][0] + timedelta(hours=hours)
+                measurement.save(update_fields=["recorded_at"])
+        ids = []
+        params = {"datalogger": str(self.datalogger), "limit": 4}
+        while True:
+            response = self.client.get(url, params)
+            ids.extend(response.data["results"])
+            if response.data["next"] is None:
+                break
+            params["cursor"] = response.data["next"]
+        self.assertEqual(len(ids), 30)
+
+        # Page size is capped and defaulted
+        with self.settings(MEASUREMENTS_MAX_PAGE_SIZE=5, MEASUREMENTS_PAGE_SIZE=3):
+            response = self.client.get(
+                url, {"datalogger": str(self.datalogger), "limit": 50}
+            )
+            self.assertEqual(len(response.data["results"]), 5)
+            response = self.client.get(
+                url,
+                {"datalogger": str(self.datalogger), "cursor": response.data["next"]},
+            )
+            self.assertEqual(len(response.data["results"]), 3)
+
+        # Errors
+        for params in [
+            {"limit": "ten"},
+            {"limit": 0},
+            {"cursor": "not-a-cursor"},
+            {"cursor": "WyJub3QgYSBkYXRlIiwgMV0"},
+            # Without an offset
+            {"cursor": encode_cursor(datetime(2024, 1, 1), 1)},
+        ]:
+            response = self.client.get(
+                url, dict(params, datalogger=str(self.datalogger))
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_fetch_data_aggregates_paginated(self):
+        url = reverse("fetch_data_aggregates")
+        full = self.client.get(
+            url, {"datalogger": str(self.datalogger), "span": "hour"}
+        )
+
+        results = []
+        params = {"datalogger": str(self.datalogger), "span": "hour", "limit": 4}
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            results.extend(response.data["results"])
+            if response.data["next"] is None:
+                break
+            params["cursor"] = response.data["next"]
+
+        key = lambda item: (item["time_slot"], item["label"])
+        self.assertEqual(len(results), len(full.data))
+        self.assertEqual(results, sorted(full.data, key=key))
+
+        # Raw mode is paginated like /api/data
+        response = self.client.get(
+            url, {"datalogger": str(self.datalogger), "limit": 25}
+        )
+        self.assertEqual(len(response.data["results"]), 25)
+        self.assertIsNotNone(response.data["next"])
+
+        response = self.client.get(
+            url, {"datalogger": str(self.datalogger), "span": "day", "cursor": "x"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Cursors without an offset, read from the rollups and from the raw
+        # readings
+        cursor = encode_cursor(datetime(2024, 1, 1), "temp")
+        for span in ["hour", "15m"]:
+            response = self.client.get(
+                url,
+                {"datalogger": str(self.datalogger), "span": span, "cursor": cursor},
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data, {"error": "Invalid cursor parameter"})